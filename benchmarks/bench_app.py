@@ -0,0 +1,90 @@
+'''
+Headless cold-start and interaction latency of the Streamlit app's data
+layer (`src.visualization.app_data`), page by page.
+
+For every page a fresh interpreter measures the import of the data layer,
+the first (cold) load of the page's datasets, the median of repeated
+(warm) loads as a rerun sees them, and the reload after its sources are
+touched, as after a new flow run. The whole `st_app.py` script is also
+timed once in Streamlit's bare mode, which is the cold start of the home
+page. Build the map cells first, then run from the repository root:
+
+    python -m src.features.map_cells
+    python -m benchmarks.bench_app
+'''
+import argparse
+import json
+import subprocess
+import sys
+import time
+
+from src.visualization.app_data import PAGE_DATASETS
+
+CHILD = '''
+import json, os, statistics, sys, time
+start = time.perf_counter()
+from src.visualization import app_data
+imported = time.perf_counter() - start
+
+page, repeat = sys.argv[1], int(sys.argv[2])
+start = time.perf_counter()
+app_data.load_page(page)
+cold = time.perf_counter() - start
+
+warm = []
+for _ in range(repeat):
+    start = time.perf_counter()
+    app_data.load_page(page)
+    warm.append(time.perf_counter() - start)
+
+# bump the sources' mtime by 1 ns (restored below) to force a reload
+paths = [app_data.CELLS_DB] if app_data.PAGE_DATASETS[page] else []
+stats = {path: os.stat(path) for path in paths if os.path.exists(path)}
+for path, stat in stats.items():
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+try:
+    start = time.perf_counter()
+    app_data.load_page(page)
+    reload = time.perf_counter() - start
+finally:
+    for path, stat in stats.items():
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+print(json.dumps({'import_s': imported, 'cold_s': cold,
+                  'warm_ms': statistics.median(warm) * 1000, 'reload_s': reload}))
+'''
+
+
+def measure_page(page, repeat):
+    out = subprocess.run([sys.executable, '-c', CHILD, page, str(repeat)],
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def measure_script():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'st_app.py'], capture_output=True, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    results = {page: measure_page(page, args.repeat) for page in PAGE_DATASETS}
+    script = measure_script()
+
+    if args.json:
+        print(json.dumps({'pages': results, 'script_cold_s': script}, indent=2))
+        return
+    print(f'st_app.py cold start (bare mode, Home page): {script:.2f} s')
+    print(f'{"page":30s} {"import":>8s} {"cold":>8s} {"warm":>9s} {"reload":>8s}')
+    for page, r in results.items():
+        print(f'{page:30s} {r["import_s"]:7.2f}s {r["cold_s"] * 1000:6.1f}ms '
+              f'{r["warm_ms"]:7.3f}ms {r["reload_s"] * 1000:6.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
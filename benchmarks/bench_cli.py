@@ -0,0 +1,96 @@
+'''
+Startup time of every `python -m src` subcommand.
+
+Each subcommand is measured in fresh interpreters, `--repeat` times: the
+wall time of `python -m src <command> --help` (the interpreter and the
+argument parser), the import of the module the subcommand runs, and which
+heavy libraries that import pulled in. `-X importtime` then names the
+slowest top-level packages of one import. Run from the repository root:
+
+    python -m benchmarks.bench_cli
+    python -m benchmarks.bench_cli --commands score serve --repeat 10
+'''
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from src.cli import COMMANDS
+
+HEAVY = ['pandas', 'sklearn', 'mlflow', 'prefect', 'geopandas', 'shapely', 'pyarrow']
+
+CHILD = '''
+import importlib, json, sys, time
+start = time.perf_counter()
+import src.cli
+cli = time.perf_counter() - start
+start = time.perf_counter()
+importlib.import_module(src.cli.COMMANDS[sys.argv[1]])
+command = time.perf_counter() - start
+heavy = [name for name in json.loads(sys.argv[2]) if name in sys.modules]
+print(json.dumps({'cli': cli, 'import': command, 'heavy': heavy}))
+'''
+
+
+def help_seconds(command):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-m', 'src', command, '--help'], check=True,
+                   stdout=subprocess.DEVNULL)
+    return time.perf_counter() - start
+
+
+def import_times(command):
+    output = subprocess.run([sys.executable, '-c', CHILD, command, json.dumps(HEAVY)],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output)
+
+
+def _importtime(statement):
+    '''(indent, module, cumulative ms) of every import `-X importtime` reports.'''
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', statement],
+                            check=True, capture_output=True, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((len(name) - len(name.lstrip()), name.strip(), int(cumulative) / 1000))
+    return rows
+
+
+def slowest_packages(command, top=5):
+    '''Top-level packages of the command's import by cumulative import time (ms).'''
+    # left out: what the interpreter imports at startup anyway
+    startup = {name for _, name, _ in _importtime('pass')}
+    rows = _importtime(f'import {COMMANDS[command]}')
+    # nested imports are indented deeper than the ones the statement triggered
+    outer = min(indent for indent, _, _ in rows)
+    packages = {}
+    for indent, name, ms in rows:
+        if indent == outer and name not in startup:
+            package = name.split('.')[0]
+            packages[package] = packages.get(package, 0) + ms
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--commands', nargs='+', default=list(COMMANDS), choices=list(COMMANDS))
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'command':10s} {'--help':>9s} {'cli':>8s} {'import':>9s}  heavy libraries")
+    for command in args.commands:
+        helps = [help_seconds(command) for _ in range(args.repeat)]
+        runs = [import_times(command) for _ in range(args.repeat)]
+        print(f'{command:10s} {statistics.median(helps) * 1000:7.0f} ms '
+              f"{statistics.median(run['cli'] for run in runs) * 1000:6.1f} ms "
+              f"{statistics.median(run['import'] for run in runs) * 1000:7.0f} ms  "
+              f"{', '.join(runs[-1]['heavy']) or '-'}")
+        print(' ' * 11 + '  '.join(f'{name} {ms:.0f} ms' for name, ms in slowest_packages(command)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+'''
+Throughput and peak memory of the feature pipeline on a scaled-up copy of
+the raw break table, against the previous loop-and-copy implementation.
+
+The table is tiled `--scale` times, giving every copy its own asset IDs so
+the per-asset break counts stay realistic. Run from the repository root:
+
+    python -m benchmarks.bench_features --scale 100
+'''
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from src.data.storage import read_table
+from src.features.process_data import RAW_COLUMNS, BINARY_COLS, CAT_COLS, process_data
+
+
+def scaled_breaks(scale):
+    df = read_table('Water_Main_Breaks', 'raw', columns=RAW_COLUMNS,
+                    parse_dates=['INCIDENT_DATE'])
+    parts = []
+    offset = int(df['ASSETID'].max()) + 1
+    for i in range(scale):
+        part = df.copy()
+        part['ASSETID'] = part['ASSETID'] + i * offset
+        parts.append(part)
+    return pd.concat(parts, ignore_index=True)
+
+
+def plain_dtypes(df):
+    '''
+    `df` with its categorical and nullable columns as plain objects, as the
+    previous implementation read them (before the compact dtypes of
+    `src.data.schema`): it fills them with new values and compares the
+    flags with 'Y'.
+    '''
+    extension = [col for col in df.columns if pd.api.types.is_extension_array_dtype(df[col])]
+    plain = df.astype({col: object for col in extension})
+    for col in extension:
+        plain[col] = plain[col].where(df[col].notna(), np.nan)
+        if pd.api.types.is_bool_dtype(df[col]):
+            plain[col] = plain[col].map({True: 'Y', False: 'N'})
+    return plain
+
+
+def legacy_process(df):
+    # the previous implementation: a copy per step, a dict loop to count the
+    # breaks and get_dummies for the flags
+    df = df.copy()
+    df.columns = df.columns.str.lower()
+    df_copy = df.copy()
+    for col in ['break_apparent_cause', 'break_nature', 'break_categorization', 'street']:
+        df_copy[col] = df_copy[col].fillna('UNKNOWN')
+    df_copy['asset_size'] = df_copy['asset_size'].fillna(df_copy['asset_size'].mode()[0])
+    df_copy['break_nature'] = df_copy['break_nature'].replace('OTHER', 'UNKNOWN')
+    df_copy['break_nature'] = df_copy['break_nature'].replace('OTHER: WATER SERVICE', 'WATER SERVICE')
+
+    num_breaks = {}
+    for pipe in df_copy['assetid']:
+        if pipe in num_breaks:
+            num_breaks[pipe] += 1
+        else:
+            num_breaks[pipe] = 1
+    df_copy['num_breaks'] = df_copy['assetid'].map(num_breaks)
+
+    df_copy = df_copy.dropna(subset=['asset_year_installed'])
+    installed = pd.to_datetime(df_copy['asset_year_installed'].astype(int).astype(str), format='%Y')
+    df_copy['age_at_break'] = np.floor(
+        (df_copy['incident_date'].dt.tz_convert(None) - installed).dt.days / 365.25)
+
+    df_copy = pd.get_dummies(df_copy, columns=[c for c in BINARY_COLS], drop_first=True)
+    for feature in CAT_COLS:
+        df_copy[feature] = df_copy[feature].astype('category').cat.codes
+    return df_copy.copy()
+
+
+def measure(func, df):
+    tracemalloc.start()
+    start = time.perf_counter()
+    func(df)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=100)
+    args = parser.parse_args()
+
+    base = scaled_breaks(args.scale)
+    print(f'{len(base)} break rows ({args.scale}x)')
+    # each implementation gets the dtypes it was written for
+    for name, func, df in [('loops + copies', legacy_process, plain_dtypes(base)),
+                           ('vectorized pipeline', lambda df: process_data(df, write=False),
+                            base)]:
+        elapsed, peak = measure(func, df.copy())
+        print(f'{name:22s} {elapsed:7.2f} s  {len(base) / elapsed:12,.0f} rows/s  '
+              f'peak {peak / 1e6:8.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+'''
+Runtime and memory of the hazard model (`src.features.exposure` and
+`src.models.hazard`) on the synthetic break and main tables of
+`benchmarks.synthetic` at 1x/10x/100x the Kitchener-Waterloo inventory.
+
+Every stage reports its wall time and its peak traced memory, next to the
+size a dense main x year panel of the same window would take. At 1x the
+panel is also built the naive way, one row per main and year in Python
+loops, for reference and as a check of the exposure and break totals.
+Run from the repository root:
+
+    python -m benchmarks.bench_hazard
+    python -m benchmarks.bench_hazard --db water_data.db   # the full real inventory
+'''
+import argparse
+import resource
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import generate
+from src.data.schema import apply_schema
+from src.features.exposure import MAX_AGE, MAX_PRIOR_BREAKS, exposure_panel, lengths_km, years
+from src.models.hazard import fit_hazard
+
+SCALES = [1, 10, 100]
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(func, *args, **kwargs):
+    '''Result, seconds and peak traced MB of `func(*args, **kwargs)`.'''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def loop_panel(mains, breaks, start_year, end_year):
+    '''One row per main and year, as a straightforward implementation would build it.'''
+    break_years = {}
+    for asset, year in zip(breaks['ASSETID'], years(breaks['INCIDENT_DATE'])):
+        if not np.isnan(year):
+            break_years.setdefault(asset, []).append(int(year))
+
+    rows = []
+    installed = years(mains['INSTALLATION_DATE'])
+    for main_id, install, length in zip(mains['WATMAINID'], installed, lengths_km(mains)):
+        if np.isnan(install):
+            continue
+        prior = 0
+        main_breaks = break_years.get(main_id, [])
+        for year in range(max(int(install), start_year), end_year + 1):
+            age = year - int(install)
+            if age > MAX_AGE:
+                break
+            n = sum(1 for y in main_breaks if y == year)
+            rows.append({'WATMAINID': main_id, 'year': year, 'age': age,
+                         'prior_breaks': min(prior, MAX_PRIOR_BREAKS),
+                         'exposure': length, 'breaks': n})
+            prior += n
+    return pd.DataFrame(rows)
+
+
+def run_scale(scale, loop=False):
+    breaks, mains, _ = generate(scale)
+    mains = apply_schema(mains[['WATMAINID', 'MATERIAL', 'PIPE_SIZE', 'INSTALLATION_DATE',
+                                'Shape__Length']].copy())
+    breaks = apply_schema(breaks[['ASSETID', 'INCIDENT_DATE']].copy())
+
+    panel, panel_s, panel_mb = measure(exposure_panel, mains, breaks)
+    n_years = panel.end_year - panel.start_year + 1
+    dense_mb = mains.shape[0] * n_years * (8 + 4) / 1024 ** 2
+    model, fit_s, fit_mb = measure(fit_hazard, panel)
+    counts = breaks.groupby('ASSETID', sort=False).size()
+    scores, score_s, score_mb = measure(model.score, mains, counts, panel.end_year)
+
+    print(f'{scale:>4d}x {mains.shape[0]:>10,d} mains {breaks.shape[0]:>9,d} breaks '
+          f'{n_years} years')
+    print(f'      panel {panel_s:7.2f} s {panel_mb:8.1f} MB peak  '
+          f'{int((panel.exposure > 0).sum()):,d} cells ({panel.nbytes / 1024 ** 2:.1f} MB) '
+          f'against a dense panel of {dense_mb:,.0f} MB')
+    print(f'      fit   {fit_s:7.2f} s {fit_mb:8.1f} MB peak')
+    print(f'      score {score_s:7.2f} s {score_mb:8.1f} MB peak  '
+          f'{scores.shape[0] / score_s:>12,.0f} mains/s  peak RSS {peak_rss_mb():7.0f} MB')
+
+    if loop:
+        start = time.perf_counter()
+        rows = loop_panel(mains, breaks, panel.start_year, panel.end_year)
+        elapsed = time.perf_counter() - start
+        print(f'      per-main loop panel {elapsed:7.2f} s  {rows.shape[0]:,d} rows  '
+              f'{rows.memory_usage(deep=True).sum() / 1024 ** 2:.0f} MB')
+        # same totals, up to the float rounding of the exposure
+        print(f'      exposure {rows["exposure"].sum():.1f} vs {panel.exposure.sum():.1f} '
+              f'km-years, breaks {int(rows["breaks"].sum())} vs {int(panel.breaks.sum())}')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=SCALES)
+    parser.add_argument('--db', default=None, help='also train and score on this database')
+    args = parser.parse_args()
+
+    if args.db:
+        from src.models.hazard import train_hazard
+
+        summary = train_hazard(args.db, holdout_years=0, log=False)
+        print(f"real data: {summary['mains']} mains, {summary['breaks']} breaks, "
+              f"panel {summary['panel_seconds']:.2f} s, fit {summary['fit_seconds']:.2f} s, "
+              f"score {summary['score_seconds']:.2f} s, peak RSS {peak_rss_mb():.0f} MB")
+
+    for scale in args.scales:
+        run_scale(scale, loop=scale == 1)
+
+
+if __name__ == '__main__':
+    main()
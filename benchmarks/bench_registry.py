@@ -0,0 +1,101 @@
+'''
+Load time and prediction throughput of a failure rate model as the pickled
+pipeline MLflow logs and as the compact export of `src.models.registry`.
+
+A forest of the training grid's largest size is fitted on the processed
+model data (or random data of its shape when it hasn't been built), saved
+both ways in a temporary directory, loaded `--repeat` times each way and
+used to score `--rows` rows. The two must predict the same values. Run
+from the repository root:
+
+    python -m benchmarks.bench_registry
+    python -m benchmarks.bench_registry --trees 150 --rows 1000000
+'''
+import argparse
+import os
+import pickle
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+from src.features.process_data import FEATURE_COLS, TARGET_COL
+from src.models.registry import CompactForest
+
+
+def training_data(rows=5000, seed=0):
+    try:
+        from src.data.storage import read_table
+
+        data = read_table('model_data', 'processed')
+        return data[FEATURE_COLS].to_numpy(dtype=np.float64), data[TARGET_COL].to_numpy()
+    except (FileNotFoundError, KeyError):
+        rng = np.random.default_rng(seed)
+        X = rng.integers(0, 20, size=(rows, len(FEATURE_COLS))).astype(np.float64)
+        return X, X[:, 6] / (X[:, 7] + 1) + rng.random(rows)
+
+
+def timed(func, repeat):
+    '''Result of the last call and the median seconds of `repeat` calls.'''
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        times.append(time.perf_counter() - start)
+    return result, statistics.median(times)
+
+
+def directory_mb(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path) / 1024 ** 2
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path)) / 1024 ** 2
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--trees', type=int, default=150)
+    parser.add_argument('--max-depth', type=int, default=None)
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    X, y = training_data()
+    model = make_pipeline(StandardScaler(), RandomForestRegressor(
+        n_estimators=args.trees, max_depth=args.max_depth, n_jobs=-1, random_state=42))
+    model.fit(X, y)
+    X_score = X[np.random.default_rng(1).integers(0, X.shape[0], args.rows)]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        pickle_path = os.path.join(tmp, 'model.pkl')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+        compact_dir = os.path.join(tmp, 'compact')
+        start = time.perf_counter()
+        CompactForest.from_pipeline(model, run_id='bench').save(compact_dir)
+        export_s = time.perf_counter() - start
+
+        def load_pickle():
+            with open(pickle_path, 'rb') as f:
+                return pickle.load(f)
+
+        pickled, pickle_load_s = timed(load_pickle, args.repeat)
+        compact, compact_load_s = timed(lambda: CompactForest.load(compact_dir), args.repeat)
+        expected, pickle_predict_s = timed(lambda: pickled.predict(X_score), 1)
+        predicted, compact_predict_s = timed(lambda: compact.predict(X_score), 1)
+
+        print(f"{compact.metadata['n_trees']} trees, {compact.metadata['n_nodes']:,d} nodes, "
+              f"max depth {compact.max_depth}, exported in {export_s:.2f} s")
+        for name, path, load_s, predict_s in [
+                ('pickle', pickle_path, pickle_load_s, pickle_predict_s),
+                ('compact', compact_dir, compact_load_s, compact_predict_s)]:
+            print(f'{name:8s} {directory_mb(path):8.1f} MB  load {load_s * 1000:9.2f} ms  '
+                  f'predict {args.rows / predict_s:>12,.0f} rows/s')
+        print(f'max abs difference of the predictions {np.abs(predicted - expected).max():.3g}')
+
+
+if __name__ == '__main__':
+    main()
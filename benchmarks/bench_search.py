@@ -0,0 +1,70 @@
+'''
+Wall-clock comparison of the hyperparameter search: the original serial
+grid loop (a fresh StandardScaler + forest pipeline per combination)
+against the process-pool search, with the full grid and with successive
+halving. MLflow logging is left out of every variant so only the fitting is
+timed. Run from the repository root:
+
+    python -m benchmarks.bench_search --workers 4
+'''
+import argparse
+import itertools
+import os
+import time
+
+from sklearn.model_selection import train_test_split
+from sklearn.preprocessing import StandardScaler
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.pipeline import make_pipeline
+
+from src.data.storage import read_table
+from src.models.search import available_cpus, search
+
+N_ESTIMATORS = [10, 50, 100, 150]
+MAX_DEPTH = [1, 3, 5, 7]
+MIN_SAMPLES_SPLIT = [2, 5, 10, 15]
+MIN_SAMPLES_LEAF = [1, 2, 4, 6]
+
+
+def serial_grid(X_train, X_test, y_train, y_test):
+    best = None
+    for n, d, s, l in itertools.product(N_ESTIMATORS, MAX_DEPTH,
+                                        MIN_SAMPLES_SPLIT, MIN_SAMPLES_LEAF):
+        rf = RandomForestRegressor(n_estimators=n, max_depth=d, min_samples_split=s,
+                                   min_samples_leaf=l, random_state=42)
+        pipeline = make_pipeline(StandardScaler(), rf)
+        pipeline.fit(X_train, y_train)
+        score = pipeline.score(X_test, y_test)
+        best = score if best is None else max(best, score)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    data = read_table('model_data', 'processed')
+    X = data.drop('failure_rate', axis=1)
+    y = data['failure_rate']
+    split = train_test_split(X, y, test_size=0.2, random_state=42)
+    grid = (N_ESTIMATORS, MAX_DEPTH, MIN_SAMPLES_SPLIT, MIN_SAMPLES_LEAF)
+    # the pool can't beat the serial loop by more than the CPUs it really has
+    print(f'{args.workers or available_cpus()} workers, {available_cpus()} CPUs available '
+          f'to this process ({os.cpu_count()} on the host)')
+
+    start = time.perf_counter()
+    best = serial_grid(*split)
+    print(f'serial grid          {time.perf_counter() - start:7.1f} s  '
+          f'256 trials  best score {best:.4f}')
+
+    for name, halving in [('parallel grid', False), ('parallel halving', True)]:
+        start = time.perf_counter()
+        results = search(*split, *grid, max_workers=args.workers,
+                         halving=halving, log=False)
+        print(f'{name:20s} {time.perf_counter() - start:7.1f} s  '
+              f'{len(results):3d} trials  best score {results["score"].iloc[0]:.4f}')
+
+
+if __name__ == '__main__':
+    main()
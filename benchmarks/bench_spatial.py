@@ -0,0 +1,112 @@
+'''
+Scaling of the spatial break-to-main matching (`src.data.spatial_match`),
+from the size of the Kitchener-Waterloo data (~2.7k breaks x 16k mains) to
+a synthetic 100k breaks x 1M mains.
+
+The synthetic mains are short polylines spread at the density of the real
+network (the area grows with the number of mains), and every break lies a
+few metres off a random main. Coordinates are generated in metres, so the
+projection isn't part of the timings. The smallest case is also run with a
+per-break loop of nearest-neighbour queries, for reference. Run from the
+repository root:
+
+    python -m benchmarks.bench_spatial
+    python -m benchmarks.bench_spatial --db water_data.db   # also the real data
+'''
+import argparse
+import resource
+import time
+
+import numpy as np
+import shapely
+
+from src.data.spatial_match import MATCH_TOLERANCE, build_index, nearest_mains
+
+CASES = [(2_700, 16_000), (10_000, 100_000), (100_000, 1_000_000)]
+
+# Side of the square the real network fits in, and its number of mains
+NETWORK_SIDE = 20_000.0
+NETWORK_MAINS = 16_000
+
+
+def synthetic_network(n_breaks, n_mains, seed=0):
+    '''Random mains (3-vertex lines of ~100 m segments) and breaks near them.'''
+    rng = np.random.default_rng(seed)
+    side = NETWORK_SIDE * np.sqrt(n_mains / NETWORK_MAINS)
+
+    start = rng.uniform(0, side, size=(n_mains, 1, 2))
+    steps = rng.normal(0, 70, size=(n_mains, 2, 2))
+    vertices = np.concatenate([start, start + np.cumsum(steps, axis=1)], axis=1)
+    lines = shapely.linestrings(vertices)
+
+    # a break sits at a random point of a random main, moved by a few metres
+    on_main = rng.integers(0, n_mains, n_breaks)
+    along = shapely.line_interpolate_point(lines[on_main], rng.uniform(0, 1, n_breaks),
+                                           normalized=True)
+    x = shapely.get_x(along) + rng.normal(0, 5, n_breaks)
+    y = shapely.get_y(along) + rng.normal(0, 5, n_breaks)
+    return shapely.points(x, y), lines, on_main
+
+
+def loop_match(tree, lines, points, tolerance):
+    '''Per-break loop, as a straightforward implementation would do it.'''
+    matches = []
+    for point in points:
+        i = tree.nearest(point)
+        distance = shapely.distance(point, lines[i])
+        matches.append(i if distance <= tolerance else -1)
+    return np.asarray(matches)
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_case(points, lines, tolerance, loop=False, expected=None):
+    start = time.perf_counter()
+    tree = build_index(lines)
+    indexed = time.perf_counter()
+    main_index, _ = nearest_mains(tree, points, tolerance)
+    queried = time.perf_counter()
+
+    line = (f'{len(points):>8,d} x {len(lines):>9,d}  index {indexed - start:6.2f} s  '
+            f'query {queried - indexed:6.2f} s  '
+            f'{len(points) / (queried - indexed):>10,.0f} breaks/s  '
+            f'matched {np.mean(main_index >= 0):6.1%}')
+    if expected is not None:
+        line += f'  on the right main {np.mean(main_index == expected):6.1%}'
+    line += f'  peak RSS {peak_rss_mb():7.0f} MB'
+    print(line)
+
+    if loop:
+        start = time.perf_counter()
+        loop_match(tree, lines, points, tolerance)
+        elapsed = time.perf_counter() - start
+        print(f'{"":22s} per-break loop query {elapsed:6.2f} s  '
+              f'{len(points) / elapsed:>10,.0f} breaks/s')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--db', default=None, help='also match the breaks of this database')
+    parser.add_argument('--tolerance', type=float, default=MATCH_TOLERANCE)
+    parser.add_argument('--max-mains', type=int, default=None,
+                        help='skip the synthetic cases with more mains')
+    args = parser.parse_args()
+
+    if args.db:
+        from src.data.spatial_match import match_breaks
+
+        summary = match_breaks(args.db, args.tolerance)
+        print(f"real data: {summary['breaks']} breaks, {summary['matched']} matched, "
+              f"index {summary['index_seconds']:.2f} s, query {summary['query_seconds']:.2f} s")
+
+    for i, (n_breaks, n_mains) in enumerate(CASES):
+        if args.max_mains and n_mains > args.max_mains:
+            continue
+        points, lines, on_main = synthetic_network(n_breaks, n_mains)
+        run_case(points, lines, args.tolerance, loop=i == 0, expected=on_main)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+'''
+Compare loading and joining the bundled `data/raw` CSVs with the old
+`to_sql` + `SELECT *` approach against the typed, indexed schema in
+`src.data.database`.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_sqlite
+'''
+import os
+import sqlite3
+import tempfile
+import time
+
+import pandas as pd
+
+from src.data.database import load_table, connect, merge_query
+
+BREAKS_CSV = 'data/raw/Water_Main_Breaks.csv'
+MAINS_CSV = 'data/raw/Water_Mains.csv'
+
+
+def read_raw():
+    # the CSV exports carry the point geometry as X/Y and the dates as text,
+    # make them look like the frames the Prefect flow loads
+    breaks = pd.read_csv(BREAKS_CSV, encoding='utf-8-sig')
+    breaks = breaks.rename(columns={'X': 'longitude', 'Y': 'latitude'})
+    breaks['INCIDENT_DATE'] = pd.to_datetime(breaks['INCIDENT_DATE'].str[:19])
+    mains = pd.read_csv(MAINS_CSV, encoding='utf-8-sig')
+    mains['INSTALLATION_DATE'] = pd.to_datetime(mains['INSTALLATION_DATE'].str[:19])
+    return breaks, mains
+
+
+def old_approach(breaks, mains, db_name):
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_name)
+    breaks.to_sql('breaks', conn, if_exists='replace', index=False)
+    mains.to_sql('mains', conn, if_exists='replace', index=False)
+    conn.close()
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_name)
+    merged = pd.read_sql('SELECT * FROM breaks LEFT JOIN mains '
+                         'ON breaks.ROADSEGMENTID = mains.ROADSEGMENTID', conn)
+    conn.close()
+    join_time = time.perf_counter() - start
+    return load_time, join_time, merged.shape
+
+
+def new_approach(breaks, mains, db_name):
+    start = time.perf_counter()
+    load_table(breaks, 'breaks', db_name)
+    load_table(mains, 'mains', db_name)
+    load_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    conn = connect(db_name)
+    merged = pd.read_sql(merge_query(conn), conn)
+    conn.close()
+    join_time = time.perf_counter() - start
+    return load_time, join_time, merged.shape
+
+
+def main(repeat=5):
+    breaks, mains = read_raw()
+    print(f'breaks: {breaks.shape}, mains: {mains.shape}')
+    for name, approach in [('to_sql + SELECT *', old_approach),
+                           ('typed schema + projected join', new_approach)]:
+        loads, joins = [], []
+        for _ in range(repeat):
+            with tempfile.TemporaryDirectory() as tmp:
+                load_time, join_time, shape = approach(
+                    breaks, mains, os.path.join(tmp, 'bench.db'))
+            loads.append(load_time)
+            joins.append(join_time)
+        print(f'{name:32s} load {min(loads) * 1000:8.1f} ms   '
+              f'join {min(joins) * 1000:8.1f} ms   result {shape}')
+
+
+if __name__ == '__main__':
+    main()
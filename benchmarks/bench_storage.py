@@ -0,0 +1,82 @@
+'''
+Compare read time and peak memory of the CSV files the pipeline exchanges
+against their Parquet counterparts written by `src.data.storage`.
+
+Every read runs in a fresh interpreter so the peak RSS of one case doesn't
+leak into the next. Run from the repository root:
+
+    python -m benchmarks.bench_storage
+'''
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import pandas as pd
+
+from src.data.storage import write_table
+
+# (table, stage, date columns, projected columns for the narrow read)
+CASES = [
+    ('Water_Main_Breaks', 'raw', ['INCIDENT_DATE'],
+     ['X', 'Y', 'ASSETID', 'INCIDENT_DATE', 'ASSET_EXISTS']),
+    ('Water_Mains', 'raw', ['INSTALLATION_DATE'],
+     ['WATMAINID', 'MATERIAL', 'PIPE_SIZE', 'INSTALLATION_DATE']),
+    ('cleaned_break_data', 'processed', ['INCIDENT_DATE'],
+     ['LATITUDE', 'LONGITUDE', 'INCIDENT_DATE', 'ASSETID', 'ASSET_EXISTS']),
+    ('model_data', 'processed', [], ['asset_size', 'age_at_break', 'failure_rate']),
+]
+
+# Executed in the child process: read the file, report wall time and the
+# peak RSS above what the interpreter and imports already used
+CHILD = '''
+import json, resource, sys, time
+import pandas as pd
+import pyarrow.parquet as pq
+args = json.loads(sys.argv[1])
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if args['fmt'] == 'csv':
+    df = pd.read_csv(args['path'], usecols=args['columns'],
+                     parse_dates=args['parse_dates'] or False)
+else:
+    df = pq.read_table(args['path'], columns=args['columns']).to_pandas()
+elapsed = time.perf_counter() - start
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+print(json.dumps({'seconds': elapsed, 'peak_kb': peak, 'rows': len(df)}))
+'''
+
+
+def measure(fmt, path, columns, parse_dates, repeat=3):
+    results = []
+    for _ in range(repeat):
+        args = json.dumps({'fmt': fmt, 'path': path, 'columns': columns,
+                           'parse_dates': parse_dates})
+        out = subprocess.run([sys.executable, '-c', CHILD, args],
+                             capture_output=True, text=True, check=True)
+        results.append(json.loads(out.stdout))
+    return min(results, key=lambda r: r['seconds'])
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmp:
+        for name, stage, dates, narrow in CASES:
+            csv_path = os.path.join('data', stage, f'{name}.csv')
+            df = pd.read_csv(csv_path, parse_dates=dates or False)
+            parquet_path = write_table(df, name, stage, data_dir=tmp)
+            print(f'{name} ({len(df)} rows): csv {os.path.getsize(csv_path) / 1e6:.2f} MB, '
+                  f'parquet {os.path.getsize(parquet_path) / 1e6:.2f} MB')
+
+            for label, columns in [('all columns', None), ('projected', narrow)]:
+                csv_dates = [c for c in dates if columns is None or c in columns]
+                csv = measure('csv', csv_path, columns, csv_dates)
+                parquet = measure('parquet', parquet_path, columns, [])
+                print(f'  {label:12s} csv {csv["seconds"] * 1000:7.1f} ms '
+                      f'{csv["peak_kb"] / 1024:6.1f} MB peak   '
+                      f'parquet {parquet["seconds"] * 1000:7.1f} ms '
+                      f'{parquet["peak_kb"] / 1024:6.1f} MB peak')
+
+
+if __name__ == '__main__':
+    main()
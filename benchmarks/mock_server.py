@@ -0,0 +1,167 @@
+'''
+A mock ArcGIS FeatureServer serving the synthetic break and main layers of
+`benchmarks.synthetic`, for benchmarking the fetch without the network.
+
+It answers the requests `src.data.fetch_engine` makes: the layer
+definition (`?f=pjson`), the object ID list (`returnIdsOnly`) and GeoJSON
+pages selected by an ObjectID range, an `OBJECTID > n` where clause or an
+`objectIds` list (GET or POST), truncated with `exceededTransferLimit`
+beyond `maxRecordCount`. Every response can be delayed to mimic the
+network. The server runs in its own process so serving doesn't compete
+with the client for the GIL:
+
+    python -m benchmarks.mock_server --scale 10 --port 8765
+'''
+import argparse
+import json
+import re
+import subprocess
+import sys
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import generate
+
+MAX_RECORD_COUNT = 2000
+
+RANGE_WHERE = re.compile(r'(\w+)\s*>=\s*(\d+)\s+and\s+\w+\s*<=\s*(\d+)', re.I)
+GREATER_WHERE = re.compile(r'(\w+)\s*>\s*(\d+)', re.I)
+
+
+class Layer:
+    def __init__(self, df, geometry):
+        # served in object ID order, with dates as epoch milliseconds like ArcGIS
+        order = np.argsort(df['OBJECTID'].values, kind='stable')
+        self.df = df.iloc[order].reset_index(drop=True)
+        for col in self.df.columns:
+            if pd.api.types.is_datetime64_any_dtype(self.df[col]):
+                ms = self.df[col].astype('int64') // 10 ** 6
+                self.df[col] = ms.where(self.df[col].notna())
+        self.geometry = geometry[order]
+        self.ids = self.df['OBJECTID'].values.astype(np.int64)
+
+    def select(self, params):
+        if params.get('objectIds'):
+            ids = np.asarray([int(i) for i in params['objectIds'].split(',')], dtype=np.int64)
+            rows = np.searchsorted(self.ids, ids)
+            rows = rows[(rows < len(self.ids)) & (self.ids[np.minimum(rows, len(self.ids) - 1)] == ids)]
+            return rows
+        where = params.get('where', '')
+        match = RANGE_WHERE.search(where)
+        if match:
+            start, end = int(match.group(2)), int(match.group(3))
+            return np.arange(np.searchsorted(self.ids, start, 'left'),
+                             np.searchsorted(self.ids, end, 'right'))
+        match = GREATER_WHERE.search(where)
+        if match:
+            return np.arange(np.searchsorted(self.ids, int(match.group(2)), 'right'), len(self.ids))
+        return np.arange(len(self.ids))
+
+    def features(self, rows):
+        page = self.df.iloc[rows]
+        records = page.astype(object).where(page.notna(), None).to_dict('records')
+        return [{'type': 'Feature', 'id': int(self.ids[row]), 'properties': record,
+                 'geometry': self.geometry_json(row)}
+                for row, record in zip(rows, records)]
+
+    def geometry_json(self, row):
+        coords = self.geometry[row].tolist()
+        if isinstance(coords[0], list):
+            return {'type': 'LineString', 'coordinates': coords}
+        return {'type': 'Point', 'coordinates': coords}
+
+
+def make_handler(layers, latency=0.0, max_record_count=MAX_RECORD_COUNT):
+    class FeatureServerHandler(BaseHTTPRequestHandler):
+        def _send(self, payload):
+            if latency:
+                time.sleep(latency)
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _handle(self, params):
+            parts = [p for p in urlparse(self.path).path.split('/') if p]
+            if not parts or parts[0] not in layers:
+                return self._send({'error': {'code': 400, 'message': 'Invalid URL'}})
+            layer = layers[parts[0]]
+            if parts[-1] != 'query':
+                return self._send({'objectIdField': 'OBJECTID',
+                                   'maxRecordCount': max_record_count,
+                                   'fields': [{'name': col} for col in layer.df.columns]})
+
+            rows = layer.select(params)
+            if params.get('returnIdsOnly') == 'true':
+                return self._send({'objectIdFieldName': 'OBJECTID',
+                                   'objectIds': layer.ids[rows].tolist()})
+            payload = {'type': 'FeatureCollection',
+                       'features': layer.features(rows[:max_record_count])}
+            if len(rows) > max_record_count:
+                payload['exceededTransferLimit'] = True
+            self._send(payload)
+
+        def do_GET(self):
+            query = parse_qs(urlparse(self.path).query)
+            self._handle({k: v[0] for k, v in query.items()})
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            form = parse_qs(self.rfile.read(length).decode())
+            self._handle({k: v[0] for k, v in form.items()})
+
+        def log_message(self, format, *args):
+            pass
+
+    return FeatureServerHandler
+
+
+def synthetic_layers(scale=1, seed=0):
+    breaks, mains, lines = generate(scale, seed)
+    return {'breaks': Layer(breaks, breaks[['X', 'Y']].values),
+            'mains': Layer(mains, lines)}
+
+
+def start_server(scale=1, seed=0, latency_ms=20.0):
+    '''
+    Start the server in a subprocess and wait until it serves. Returns the
+    process and the URL of every layer; terminate the process when done.
+    '''
+    proc = subprocess.Popen([sys.executable, '-m', 'benchmarks.mock_server',
+                             '--scale', str(scale), '--seed', str(seed),
+                             '--latency-ms', str(latency_ms), '--port', '0'],
+                            stdout=subprocess.PIPE, text=True)
+    port = int(proc.stdout.readline().strip())
+    base = f'http://127.0.0.1:{port}'
+    return proc, {name: f'{base}/{name}/FeatureServer/0/' for name in ['breaks', 'mains']}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scale', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    layers = synthetic_layers(args.scale, args.seed)
+    server = ThreadingHTTPServer(('127.0.0.1', args.port),
+                                 make_handler(layers, args.latency_ms / 1000))
+    # the port on the first line tells `start_server` the layers are ready
+    print(server.server_address[1], flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,219 @@
+'''
+End-to-end benchmark suite: fetch (from the mock FeatureServer), load,
+spatial match, merge, features, training and scoring, on synthetic data
+shaped like the raw exports at 1x/10x/100x their size.
+
+Every scale runs in a fresh interpreter so peak memory figures don't leak
+between scales. The timings of each run are appended to
+`benchmarks/results/history.jsonl` with the commit they were measured on,
+and compared with the stored baseline: a stage slower than its baseline by
+more than `--tolerance` is flagged and the exit status is 1. Run from the
+repository root:
+
+    python -m benchmarks.suite --scales 1 10        # compare with the baseline
+    python -m benchmarks.suite --scales 1 10 100 --save-baseline
+'''
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+RESULTS_DIR = os.path.join('benchmarks', 'results')
+HISTORY_PATH = os.path.join(RESULTS_DIR, 'history.jsonl')
+BASELINE_PATH = os.path.join(RESULTS_DIR, 'baseline.json')
+
+# A stage only regresses when it's both `tolerance` and this much slower,
+# so sub-second stages don't flap on timer noise
+MIN_REGRESSION_SECONDS = 0.05
+
+# Small grid so the training stage measures the search machinery, not the
+# size of the grid
+GRID = ([10, 50], [3, 7], [2, 10], [1, 4])
+
+
+def run_scale(scale, workers=4, latency_ms=20.0):
+    '''Run every stage at `scale` in this process and return their measurements.'''
+    import numpy as np
+    import pandas as pd
+    import shapely
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    from benchmarks.mock_server import start_server
+    from benchmarks.synthetic import generate
+    from src.data.database import connect, load_table, merge_query
+    from src.data.fetch_engine import fetch_features
+    from src.data.spatial_match import match_breaks
+    from src.features.process_data import (RAW_COLUMNS, CAT_COLS, FEATURE_COLS, TARGET_COL,
+                                           encode_cat_cols, process_data)
+    from src.instrumentation import stage
+    from src.models.score import category_codes, mains_frames, score_frames
+    from src.models.search import search
+
+    results = {}
+
+    def record(current):
+        results[current.name] = {
+            'seconds': current.extra['wall_seconds'],
+            'rows_in': current.rows_in,
+            'rows_out': current.rows_out,
+            'peak_rss_mb': current.extra['peak_rss_mb'],
+            **current.counters,
+        }
+
+    breaks, mains, lines = generate(scale)
+
+    proc, urls = start_server(scale, latency_ms=latency_ms)
+    try:
+        for layer in ['breaks', 'mains']:
+            with stage(f'fetch.{layer}') as current:
+                fetched, _, _ = fetch_features(urls[layer], max_workers=workers)
+                current.rows_out = fetched.shape[0]
+            record(current)
+            del fetched
+    finally:
+        proc.terminate()
+        proc.wait()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = os.path.join(tmp, 'bench.db')
+        loaded_breaks = breaks.rename(columns={'X': 'longitude', 'Y': 'latitude'})
+        loaded_mains = mains.assign(geometry_wkb=shapely.to_wkb(shapely.linestrings(lines)))
+        with stage('load', breaks.shape[0] + mains.shape[0]) as current:
+            load_table(loaded_breaks, 'breaks', db_name)
+            load_table(loaded_mains, 'mains', db_name)
+        record(current)
+
+        with stage('match', breaks.shape[0]) as current:
+            current.rows_out = match_breaks(db_name)['matched']
+        record(current)
+
+        with stage('merge') as current:
+            conn = connect(db_name)
+            merged = pd.read_sql(merge_query(conn, matches='break_matches'), conn)
+            conn.close()
+            current.rows_out = merged.shape[0]
+        record(current)
+        del merged
+
+        with stage('features', breaks.shape[0]) as current:
+            model_data = process_data(breaks[RAW_COLUMNS].copy(), write=False)
+            current.rows_out = model_data.shape[0]
+        record(current)
+
+        X = model_data[FEATURE_COLS].to_numpy(dtype=np.float64)
+        y = model_data[TARGET_COL].to_numpy()
+        test = np.arange(len(y)) % 5 == 0
+        with stage('train', int((~test).sum())) as current:
+            trials = search(X[~test], X[test], y[~test], y[test], *GRID,
+                            max_workers=workers, log=False)
+            current.rows_out = trials.shape[0]
+        record(current)
+
+        # score the whole mains inventory with the best configuration
+        best = trials.iloc[0]
+        model = make_pipeline(StandardScaler(), RandomForestRegressor(
+            n_estimators=int(best['n_estimators']), max_depth=int(best['max_depth']),
+            random_state=42)).fit(X, y)
+        raw = breaks[[col.upper() for col in CAT_COLS]].copy()
+        raw.columns = CAT_COLS
+        _, encodings = encode_cat_cols(raw.fillna('UNKNOWN'))
+        with stage('score', mains.shape[0]) as current:
+            scored = 0
+            frames = mains_frames(db_name, chunk_rows=20_000, encodings=encodings)
+            for frame, _ in score_frames(model, frames, category_codes(encodings)):
+                scored += frame.shape[0]
+            current.rows_out = scored
+        record(current)
+
+    return results
+
+
+def measure(scale, workers, latency_ms):
+    out = subprocess.run([sys.executable, '-m', 'benchmarks.suite', '--run-scale', str(scale),
+                          '--workers', str(workers), '--latency-ms', str(latency_ms)],
+                         capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(f'{scale}x run failed:\n{out.stderr}')
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(timings, baseline, tolerance):
+    '''Stages slower than their baseline by more than `tolerance`.'''
+    regressions = []
+    for key, seconds in timings.items():
+        reference = baseline.get(key)
+        if reference is None:
+            continue
+        if seconds > reference * (1 + tolerance) and seconds - reference > MIN_REGRESSION_SECONDS:
+            regressions.append((key, reference, seconds))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--scales', type=int, nargs='+', default=[1, 10])
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--latency-ms', type=float, default=20.0,
+                        help='delay of every mock FeatureServer response')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown flagged as a regression')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store these timings as the new baseline')
+    parser.add_argument('--run-scale', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_scale:
+        # child process: print the measurements of one scale as JSON
+        print(json.dumps(run_scale(args.run_scale, args.workers, args.latency_ms)))
+        return 0
+
+    results = {}
+    for scale in args.scales:
+        results[f'{scale}x'] = measure(scale, args.workers, args.latency_ms)
+        for name, r in results[f'{scale}x'].items():
+            print(f'{scale:>4d}x {name:14s} {r["seconds"]:9.2f} s  rows {r["rows_in"]} -> '
+                  f'{r["rows_out"]}  peak RSS {r["peak_rss_mb"]:7.0f} MB'
+                  + (f'  {r["http_requests"]} requests' if 'http_requests' in r else ''))
+
+    timings = {f'{scale}/{name}': r['seconds']
+               for scale, stages in results.items() for name, r in stages.items()}
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    with open(HISTORY_PATH, 'a') as f:
+        f.write(json.dumps({'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                            'commit': git_commit(), 'python': platform.python_version(),
+                            'machine': platform.machine(), 'workers': args.workers,
+                            'latency_ms': args.latency_ms, 'results': results}) + '\n')
+
+    baseline = {}
+    if os.path.exists(BASELINE_PATH):
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+    regressions = compare(timings, baseline, args.tolerance)
+    for key, reference, seconds in regressions:
+        print(f'REGRESSION {key}: {seconds:.2f} s against a baseline of {reference:.2f} s')
+
+    if args.save_baseline:
+        with open(BASELINE_PATH, 'w') as f:
+            json.dump(dict(baseline, **timings), f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {BASELINE_PATH}')
+    elif not baseline:
+        print('No baseline yet, store one with --save-baseline')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
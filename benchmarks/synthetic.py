@@ -0,0 +1,95 @@
+'''
+Synthetic break and main tables shaped like `data/raw/Water_Main_Breaks.csv`
+and `data/raw/Water_Mains.csv`, at any multiple of their size.
+
+The bundled tables are tiled `scale` times side by side: every copy gets
+its own IDs and is shifted east by the width of the city, so the value
+distributions, the break/main relationships and the spatial density stay
+those of the real data. The raw main export has no coordinates, so every
+main gets a straight line of its `Shape__Length`, through one of its breaks
+when it has some.
+'''
+import numpy as np
+import pandas as pd
+
+BREAKS_CSV = 'data/raw/Water_Main_Breaks.csv'
+MAINS_CSV = 'data/raw/Water_Mains.csv'
+
+# ID columns that must stay unique (or consistent) across the copies
+BREAK_ID_COLS = ['OBJECTID', 'WATBREAKINCIDENTID', 'ROADSEGMENTID', 'ASSETID']
+MAIN_ID_COLS = ['OBJECTID', 'WATMAINID', 'ROADSEGMENTID']
+
+# Metres per degree of latitude, and of longitude around Kitchener
+M_PER_DEG_LAT = 111_320.0
+M_PER_DEG_LON = 80_800.0
+
+
+def _read_raw():
+    breaks = pd.read_csv(BREAKS_CSV, encoding='utf-8-sig')
+    mains = pd.read_csv(MAINS_CSV, encoding='utf-8-sig')
+    for df, col in [(breaks, 'INCIDENT_DATE'), (mains, 'INSTALLATION_DATE')]:
+        df[col] = pd.to_datetime(df[col], utc=True, errors='coerce')
+    return breaks, mains
+
+
+def _main_lines(breaks, mains, rng):
+    '''(n_mains, 2, 2) array of line end points (lon, lat).'''
+    n = mains.shape[0]
+    x_min, x_max = breaks['X'].min(), breaks['X'].max()
+    y_min, y_max = breaks['Y'].min(), breaks['Y'].max()
+
+    center = np.column_stack([rng.uniform(x_min, x_max, n), rng.uniform(y_min, y_max, n)])
+    # mains that broke go through one of their breaks
+    first_break = breaks.drop_duplicates('ASSETID').set_index('ASSETID')[['X', 'Y']]
+    located = first_break.reindex(mains['WATMAINID'].values)
+    has_break = located['X'].notna().values
+    center[has_break] = located.values[has_break]
+
+    length = mains['Shape__Length'].fillna(50).clip(lower=1).values
+    angle = rng.uniform(0, np.pi, n)
+    half = np.column_stack([np.cos(angle) * length / 2 / M_PER_DEG_LON,
+                            np.sin(angle) * length / 2 / M_PER_DEG_LAT])
+    return np.stack([center - half, center + half], axis=1)
+
+
+def generate(scale=1, seed=0):
+    '''
+    Synthetic raw tables at `scale` times the size of the bundled ones.
+
+    Returns
+    -------
+    breaks : pd.DataFrame
+        Columns of the raw break export, INCIDENT_DATE parsed.
+    mains : pd.DataFrame
+        Columns of the raw main export, INSTALLATION_DATE parsed.
+    lines : np.ndarray
+        (n_mains, 2, 2) end points of every main, in the order of `mains`.
+    '''
+    rng = np.random.default_rng(seed)
+    breaks, mains = _read_raw()
+    lines = _main_lines(breaks, mains, rng)
+    width = breaks['X'].max() - breaks['X'].min()
+
+    offsets = {col: int(max(breaks[col].max() if col in breaks else 0,
+                            mains[col].max() if col in mains else 0)) + 1
+               for col in set(BREAK_ID_COLS + MAIN_ID_COLS)}
+    # break ASSETIDs are the WATMAINIDs of the mains
+    offsets['ASSETID'] = offsets['WATMAINID'] = max(offsets['ASSETID'], offsets['WATMAINID'])
+
+    break_parts, main_parts, line_parts = [], [], []
+    for i in range(scale):
+        b = breaks.copy()
+        m = mains.copy()
+        for df, cols in [(b, BREAK_ID_COLS), (m, MAIN_ID_COLS)]:
+            for col in cols:
+                df[col] = df[col] + i * offsets[col]
+        b['X'] = b['X'] + i * width
+        shifted = lines.copy()
+        shifted[:, :, 0] += i * width
+        break_parts.append(b)
+        main_parts.append(m)
+        line_parts.append(shifted)
+
+    return (pd.concat(break_parts, ignore_index=True),
+            pd.concat(main_parts, ignore_index=True),
+            np.concatenate(line_parts))
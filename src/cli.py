@@ -0,0 +1,166 @@
+'''
+Command-line entry point of the pipeline stages.
+
+    python -m src fetch [--incremental [--full-refresh]] [--sources [CONFIG]]
+    python -m src load [--city CITY]
+    python -m src features [--refresh] [--map-cells]
+    python -m src train [--out-of-core] [--promote]
+    python -m src score [--network]
+    python -m src serve [http|stdin]
+
+Only this module and argparse are imported to parse the command line. A
+subcommand then imports the one module it runs (`COMMANDS`), so e.g.
+`score` never pays for Prefect and geopandas, nor `fetch` for
+scikit-learn and MLflow. `benchmarks/bench_cli.py` measures the startup of
+every subcommand.
+'''
+import argparse
+import importlib
+import json
+import sys
+
+# Module each subcommand runs, imported only once it's chosen
+COMMANDS = {
+    'fetch': 'src.data.fetch_data',
+    'load': 'src.data.fetch_data',
+    'features': 'src.features.feature_store',
+    'train': 'src.models.train',
+    'score': 'src.models.score',
+    'serve': 'src.models.score',
+}
+
+
+def fetch(args, fetch_data):
+    if args.sources is not None:
+        results = fetch_data.fetch_and_load_sources(args.sources or fetch_data.SOURCES_PATH,
+                                                    args.max_requests, args.max_per_host,
+                                                    args.workers, args.db)
+        for result in results:
+            print(f"{result['city']:20s} {result['layer']:8s} {result['rows']:>10,d} rows")
+    else:
+        df = fetch_data.fetch_and_load_data(args.incremental, args.full_refresh)
+        print(f'Loaded {df.shape[0]} merged breaks')
+
+
+def load(args, fetch_data):
+    df = fetch_data.load_data(args.db, args.city)
+    print(f'Loaded {df.shape[0]} merged breaks')
+
+
+def features(args, feature_store):
+    model_data = feature_store.load_features(refresh=args.refresh)
+    print(f'{model_data.shape[0]} rows of model data')
+    if args.map_cells:
+        from src.features.map_cells import build_cells
+
+        build_cells()
+
+
+def train(args, train_module):
+    if args.out_of_core:
+        summary = train_module.train_out_of_core(
+            memory_budget_mb=args.memory_budget_mb or train_module.MEMORY_BUDGET_MB,
+            n_jobs=args.workers)
+        print(f"score: {summary['score']:.4f} on {summary['test_rows']} test rows, "
+              f"{summary['train_rows']} training rows")
+    else:
+        train_module.main(halving=not args.no_halving, max_workers=args.workers)
+
+    if args.promote:
+        from src.models.registry import best_run_id, promote
+
+        run_id = best_run_id()
+        promote(run_id)
+        print(f'Promoted {run_id}')
+
+
+def score(args, score_module):
+    if args.network:
+        from src.models.risk import score_network
+
+        summary = score_network(args.db, args.chunk_rows, args.run_id)
+    else:
+        summary = score_module.score_batch(args.source, chunk_rows=args.chunk_rows,
+                                           run_id=args.run_id, db_name=args.db)
+    print(json.dumps(summary))
+
+
+def serve(args, score_module):
+    batcher = score_module.MicroBatcher(score_module.load_model(args.run_id),
+                                        score_module.load_codes(),
+                                        args.max_batch, args.max_wait_ms / 1000)
+    if args.mode == 'stdin':
+        score_module.serve_stdin(batcher)
+    else:
+        score_module.serve_http(batcher, args.host, args.port)
+    print(json.dumps(batcher.stats.summary()), file=sys.stderr)
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='python -m src',
+                                     description='Run a stage of the water main pipeline.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    parser_fetch = commands.add_parser('fetch', help='fetch the layers and load them')
+    parser_fetch.add_argument('--incremental', action='store_true',
+                              help='only fetch new or edited features')
+    parser_fetch.add_argument('--full-refresh', action='store_true',
+                              help='with --incremental, also remove features deleted upstream')
+    parser_fetch.add_argument('--sources', nargs='?', const='', default=None, metavar='CONFIG',
+                              help='ingest every city of a sources file (config/sources.json)')
+    parser_fetch.add_argument('--max-requests', type=int, default=8)
+    parser_fetch.add_argument('--max-per-host', type=int, default=4)
+    parser_fetch.add_argument('--workers', type=int, default=4)
+    parser_fetch.add_argument('--db', default='water_data.db')
+    parser_fetch.set_defaults(handler=fetch)
+
+    parser_load = commands.add_parser('load', help='match and merge the stored layers')
+    parser_load.add_argument('--db', default='water_data.db')
+    parser_load.add_argument('--city', default=None)
+    parser_load.set_defaults(handler=load)
+
+    parser_features = commands.add_parser('features', help='build the model data')
+    parser_features.add_argument('--refresh', action='store_true',
+                                 help='rebuild it even if the cached one is current')
+    parser_features.add_argument('--map-cells', action='store_true',
+                                 help="also precompute the app's map cells")
+    parser_features.set_defaults(handler=features)
+
+    parser_train = commands.add_parser('train', help='train the failure rate model')
+    parser_train.add_argument('--out-of-core', action='store_true',
+                              help='stream the model data instead of loading it')
+    parser_train.add_argument('--memory-budget-mb', type=float, default=None)
+    parser_train.add_argument('--workers', type=int, default=None)
+    parser_train.add_argument('--no-halving', action='store_true')
+    parser_train.add_argument('--promote', action='store_true',
+                              help='export the best run to the model registry')
+    parser_train.set_defaults(handler=train)
+
+    parser_score = commands.add_parser('score', help='score the mains with the current model')
+    parser_score.add_argument('--network', action='store_true',
+                              help='rank every main of the network (the main_risk table)')
+    parser_score.add_argument('--source', default='mains',
+                              help="'mains' for the whole inventory, or a processed table")
+    parser_score.add_argument('--chunk-rows', type=int, default=5000)
+    parser_score.add_argument('--run-id', default=None)
+    parser_score.add_argument('--db', default='water_data.db')
+    parser_score.set_defaults(handler=score)
+
+    parser_serve = commands.add_parser('serve', help='serve predictions over HTTP or stdin')
+    parser_serve.add_argument('mode', nargs='?', choices=['http', 'stdin'], default='http')
+    parser_serve.add_argument('--host', default='127.0.0.1')
+    parser_serve.add_argument('--port', type=int, default=8080)
+    parser_serve.add_argument('--run-id', default=None)
+    parser_serve.add_argument('--max-batch', type=int, default=256)
+    parser_serve.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser_serve.set_defaults(handler=serve)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.handler(args, importlib.import_module(COMMANDS[args.command]))
+
+
+if __name__ == '__main__':
+    main()
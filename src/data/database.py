@@ -0,0 +1,238 @@
+import re
+import sqlite3
+
+import pandas as pd
+
+# Declared SQLite types for the columns we know about. Columns that aren't
+# listed get a type inferred from their pandas dtype, so a new field on the
+# feature server still loads. The flags of `src.data.schema` are booleans,
+# stored as 1/0.
+BREAKS_COLUMNS = {
+    'OBJECTID': 'INTEGER PRIMARY KEY',
+    'WATBREAKINCIDENTID': 'INTEGER',
+    'INCIDENT_DATE': 'TEXT',
+    'BREAK_TYPE': 'TEXT',
+    'STATUS': 'TEXT',
+    'BREAK_NATURE': 'TEXT',
+    'BREAK_APPARENT_CAUSE': 'TEXT',
+    'POSITIVE_PRESSURE_MAINTANED': 'INTEGER',
+    'AIR_GAP_MAINTANED': 'INTEGER',
+    'MECHANICAL_REMOVAL': 'INTEGER',
+    'FLUSHING_EXCAVATION': 'INTEGER',
+    'HIGHER_VELOCITY_FLUSHING': 'INTEGER',
+    'ANODE_INSTALLED': 'INTEGER',
+    'BREAK_CATEGORIZATION': 'TEXT',
+    'ROADSEGMENTID': 'INTEGER',
+    'STREET': 'TEXT',
+    'ASSETID': 'INTEGER',
+    'ASSET_DEPTH': 'REAL',
+    'FROST_DEPTH': 'REAL',
+    'ASSET_SIZE': 'REAL',
+    'ASSET_YEAR_INSTALLED': 'INTEGER',
+    'ASSET_MATERIAL': 'TEXT',
+    'ASSET_EXISTS': 'INTEGER',
+    'GLOBALID': 'TEXT',
+    'longitude': 'REAL',
+    'latitude': 'REAL',
+}
+
+MAINS_COLUMNS = {
+    'OBJECTID': 'INTEGER PRIMARY KEY',
+    'WATMAINID': 'INTEGER',
+    'STATUS': 'TEXT',
+    'PRESSURE_ZONE': 'TEXT',
+    'ROADSEGMENTID': 'INTEGER',
+    'CATEGORY': 'TEXT',
+    'PIPE_SIZE': 'REAL',
+    'MATERIAL': 'TEXT',
+    'LINED': 'INTEGER',
+    'INSTALLATION_DATE': 'TEXT',
+    'CRITICALITY': 'INTEGER',
+    'CONDITION_SCORE': 'REAL',
+    'GlobalID': 'TEXT',
+    'Shape__Length': 'REAL',
+    # the line geometry, kept for the spatial matching of the breaks
+    'geometry_wkb': 'BLOB',
+}
+
+# Nearest main of every break, written by `src.data.spatial_match`
+BREAK_MATCHES_COLUMNS = {
+    'OBJECTID': 'INTEGER PRIMARY KEY',
+    'MAIN_OBJECTID': 'INTEGER',
+    'WATMAINID': 'INTEGER',
+    'ROADSEGMENTID': 'INTEGER',
+    'match_distance': 'REAL',
+}
+
+TABLE_COLUMNS = {'breaks': BREAKS_COLUMNS, 'mains': MAINS_COLUMNS,
+                 'break_matches': BREAK_MATCHES_COLUMNS}
+
+# Columns used to join and filter the tables
+TABLE_INDEXES = {
+    'breaks': ['ROADSEGMENTID', 'ASSETID', 'INCIDENT_DATE'],
+    'mains': ['ROADSEGMENTID', 'WATMAINID'],
+    'break_matches': ['MAIN_OBJECTID', 'WATMAINID'],
+}
+
+# Tables of one municipality are partitions named `<table>__<city>`, e.g.
+# `breaks__waterloo`, with the columns and indexes of `<table>`
+PARTITION_SEP = '__'
+
+# Columns left out of the merged break data
+GEOMETRY_COLUMNS = {'geometry_wkb'}
+
+# Dates are stored as ISO text, which sorts (and therefore indexes)
+# chronologically and reads back the same way pandas' `to_sql` wrote them
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'temp_store': 'MEMORY',
+    'cache_size': -64000,
+    'mmap_size': 268435456,
+}
+
+
+def connect(db_name='water_data.db'):
+    '''Open `db_name` with the pragmas used for bulk loading and querying.'''
+    conn = sqlite3.connect(db_name)
+    for pragma, value in PRAGMAS.items():
+        conn.execute(f'PRAGMA {pragma} = {value}')
+    return conn
+
+
+def city_key(city):
+    '''`city` as it appears in table names: lower case letters, digits and _.'''
+    key = re.sub(r'[^0-9a-z]+', '_', str(city).strip().lower()).strip('_')
+    if not key:
+        raise ValueError(f'Invalid city name {city!r}')
+    return key
+
+
+def partition_table(table_name, city=None):
+    '''Name of the partition of `table_name` holding `city`, `table_name` itself without one.'''
+    if city is None:
+        return table_name
+    return f'{table_name}{PARTITION_SEP}{city_key(city)}'
+
+
+def base_table(table_name):
+    '''Table a partition belongs to: 'breaks' for 'breaks__waterloo'.'''
+    return table_name.split(PARTITION_SEP, 1)[0]
+
+
+def _sqlite_type(series):
+    if pd.api.types.is_bool_dtype(series) or pd.api.types.is_integer_dtype(series):
+        return 'INTEGER'
+    if pd.api.types.is_float_dtype(series):
+        return 'REAL'
+    return 'TEXT'
+
+
+def column_types(df, table_name):
+    '''Declared type of every column of `df` when stored as `table_name`.'''
+    declared = TABLE_COLUMNS.get(base_table(table_name), {})
+    return {col: declared.get(col, _sqlite_type(df[col])) for col in df.columns}
+
+
+def _to_sqlite_values(series):
+    '''Convert a column to a list of Python values sqlite3 can bind.'''
+    if pd.api.types.is_datetime64_any_dtype(series):
+        series = series.dt.strftime(DATE_FORMAT)
+    elif not pd.api.types.is_extension_array_dtype(series) and series.dtype.kind in 'biuf':
+        # NaN floats are stored as NULL by SQLite
+        return series.tolist()
+    # categoricals and nullable booleans: missing values (NaN, pd.NA) become NULL
+    return series.astype(object).where(series.notna(), None).tolist()
+
+
+def _rows(df):
+    return zip(*(_to_sqlite_values(df[col]) for col in df.columns))
+
+
+def create_table(conn, df, table_name):
+    '''(Re)create `table_name` with declared column types for `df`.'''
+    types = column_types(df, table_name)
+    columns_sql = ',\n    '.join(f'"{col}" {typ}' for col, typ in types.items())
+    conn.execute(f'DROP TABLE IF EXISTS {table_name}')
+    conn.execute(f'CREATE TABLE {table_name} (\n    {columns_sql}\n)')
+
+
+def create_indexes(conn, table_name):
+    '''Create the indexes listed in `TABLE_INDEXES` for the existing columns.'''
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')}
+    for col in TABLE_INDEXES.get(base_table(table_name), []):
+        if col in columns:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{table_name}_{col.lower()} '
+                         f'ON {table_name} ("{col}")')
+
+
+def insert_rows(conn, df, table_name):
+    '''
+    Insert `df` into `table_name` with a single `executemany`. Rows whose
+    primary key already exists are replaced, which makes this an upsert.
+    '''
+    if df.shape[0] == 0:
+        return
+    columns = ', '.join(f'"{col}"' for col in df.columns)
+    placeholders = ', '.join('?' * df.shape[1])
+    conn.executemany(f'INSERT OR REPLACE INTO {table_name} ({columns}) '
+                     f'VALUES ({placeholders})', _rows(df))
+
+
+def load_table(df, table_name, db_name='water_data.db'):
+    '''
+    Replace `table_name` with the contents of `df`: create the typed table,
+    bulk insert every row and build the indexes, all in one transaction.
+    Indexes are built after the insert, which is much cheaper than keeping
+    them up to date row by row.
+    '''
+    conn = connect(db_name)
+    try:
+        with conn:
+            create_table(conn, df, table_name)
+            insert_rows(conn, df, table_name)
+            create_indexes(conn, table_name)
+        conn.execute('ANALYZE')
+    finally:
+        conn.close()
+
+
+def merge_query(conn, left='breaks', right='mains', on='ROADSEGMENTID', matches=None):
+    '''
+    Build the `left LEFT JOIN right` query with an explicit projection: every
+    column of `left`, then the columns of `right` except the join key and
+    the geometry, with the ones whose name clashes with `left` (SQLite names
+    are case insensitive) prefixed by `MAIN_`.
+
+    With `matches`, the name of a table of `src.data.spatial_match`, the
+    rows of `left` are joined to the main they were matched to instead of
+    on `on`, and the match distance is added.
+    '''
+    left_cols = [row[1] for row in conn.execute(f'PRAGMA table_info({left})')]
+    right_cols = [row[1] for row in conn.execute(f'PRAGMA table_info({right})')]
+    taken = {col.upper() for col in left_cols}
+
+    projection = [f'{left}."{col}"' for col in left_cols]
+    for col in right_cols:
+        if col in GEOMETRY_COLUMNS or (matches is None and col.upper() == on.upper()):
+            continue
+        if col.upper() in taken:
+            projection.append(f'{right}."{col}" AS "MAIN_{col}"')
+        else:
+            projection.append(f'{right}."{col}"')
+
+    if matches is not None:
+        projection.append(f'{matches}."match_distance"')
+        return (f'SELECT {", ".join(projection)}\n'
+                f'FROM {left}\n'
+                f'LEFT JOIN {matches}\n'
+                f'ON {matches}."OBJECTID" = {left}."OBJECTID"\n'
+                f'LEFT JOIN {right}\n'
+                f'ON {right}."OBJECTID" = {matches}."MAIN_OBJECTID"')
+
+    return (f'SELECT {", ".join(projection)}\n'
+            f'FROM {left}\n'
+            f'LEFT JOIN {right}\n'
+            f'ON {left}."{on}" = {right}."{on}"')
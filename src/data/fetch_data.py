@@ -1,17 +1,25 @@
-import numpy as np
 import pandas as pd
 import geopandas as gpd
-import urllib.parse
-import requests
-import sqlite3
-import datetime
+import argparse
+import threading
 
 from prefect import task, flow
-from prefect.server.schemas.schedules import CronSchedule
+from prefect.task_runners import ConcurrentTaskRunner
+
+from src.data.fetch_engine import (fetch_features, verify_features, clear_checkpoint,
+                                   RequestLimiter)
+from src.data.sync_data import sync_layer
+from src.data.sources import SOURCES_PATH, load_sources, cities
+from src.data.database import load_table, connect, merge_query, partition_table
+from src.data.schema import apply_schema
+from src.data.storage import write_table
+from src.data.spatial_match import match_breaks, MATCHES_TABLE
+from src.instrumentation import instrumented, stage, count, active_stages, attach
 
 # formerly called query_arcgis_feature_server
 @task
-def fetch_data(url_feature_server=''):
+@instrumented()
+def fetch_data(url_feature_server='', max_workers=4, checkpoint_dir=None):
     '''
     This function downloads all of the features available on a given ArcGIS 
     feature server. The function is written to bypass the limitations imposed
@@ -24,12 +32,19 @@ def fetch_data(url_feature_server=''):
         Sting containing the URL of the service API you want to query. It should 
         end in a forward slash and look something like this:
         'https://services.arcgis.com/P3ePLMYs2RVChkJx/arcgis/rest/services/USA_Counties/FeatureServer/0/'
+    max_workers : int
+        Number of pages requested concurrently over a shared HTTP session.
+    checkpoint_dir : string, optional
+        Directory used to checkpoint finished pages. If a previous run was
+        interrupted, the ObjectID ranges it completed are loaded from here
+        instead of being downloaded again.
 
     Returns
     -------
     geodata_final : gpd.GeoDataFrame
         This is a GeoDataFrame that contains all of the features from the 
-        Feature Server. After calling this function, the `geodata_final` object 
+        Feature Server, once each and sorted by ObjectID. Its
+        `attrs['integrity']` holds the `IntegrityReport` of the download. After calling this function, the `geodata_final` object 
         can be used to store the data on disk in several different formats 
         including, but not limited to, Shapefile (.shp), GeoJSON (.geojson), 
         GeoPackage (.gpkg), or PostGIS.
@@ -45,156 +60,75 @@ def fetch_data(url_feature_server=''):
     # forward slash
     if url_feature_server[-1] != '/':
         url_feature_server = url_feature_server + '/'
-    
-    # Getting the layer definitions. This contains important info such as the 
-    # name of the column used as feature_ids/object_ids, among other things.
-    layer_def = requests.get(url_feature_server + '?f=pjson').json()
-    
-    # The `objectIdField` is the column name used for the 
-    # feature_ids/object_ids
-    fid_colname = layer_def['objectIdField']
-    
-    # The `maxRecordCount` tells us the maximum number of records this REST 
-    # API service can return at once. The code below is written such that we 
-    # perform multiple calls to the API, each one being short enough never to 
-    # go beyond this limit.
-    record_count_max = layer_def['maxRecordCount']
-    
-    # Part of the URL that specifically requests only the object IDs
-    url_query_get_ids = (f'query?f=geojson&returnIdsOnly=true'
-                         f'&where={fid_colname}+is+not+null')
-    
-    url_comb = url_feature_server + url_query_get_ids
-    
-    # Getting all the object IDs
-    service_request = requests.get(url_comb)
-    all_objectids = np.sort(service_request.json()['properties']['objectIds'])
-    
-    # This variable will store all the parts of the multiple queries. These 
-    # parts will, at the end, be concatenated into one large GeoDataFrame.
-    geodata_parts = []
-    
-    # This part of the query is fixed and never actually changes
-    url_query_fixed = ('query?f=geojson&outFields=*&where=')
-    
-    # Identifying the largest query size allowed per request. This will dictate 
-    # how many queries will need to be made. We start the search at
-    # the max record count, but that generates errors sometimes - the query 
-    # might time out because it's too big. If the test query times out, we try 
-    # shrink the query size until the test query goes through without 
-    # generating a time-out error.
-    block_size = min(record_count_max, len(all_objectids))
-    worked = False
-    while not worked:
-        # Moving the "cursors" to their appropriate locations
-        id_start = all_objectids[0]
-        id_end = all_objectids[block_size-1]
-
-        readable_query_string = (f'{fid_colname}>={id_start} '
-                                 f'and {fid_colname}<={id_end}')
-        
-        url_query_variable =  urllib.parse.quote(readable_query_string)
-    
-        url_comb = url_feature_server + url_query_fixed + url_query_variable
-        
-        url_get = requests.get(url_comb)
-        
-        if 'error' in url_get.json():
-            block_size = int(block_size/2)+1
-        else:
-            geodata_part = gpd.read_file(url_get.text)
-            
-            geodata_parts.append(geodata_part.copy())
-            worked = True
-    
-    # Performing the actual query to the API multiple times. This skips the 
-    # first few rows/features in the data because those rows were already 
-    # captured in the query performed in the code chunk above.
-    for i in range(block_size, len(all_objectids), block_size):
-        # Moving the "cursors" to their appropriate locations and finding the 
-        # limits of each block
-        sub_list = all_objectids[i:i + block_size]
-        id_start = sub_list[0]
-        id_end = sub_list[-1]
-
-        readable_query_string = (f'{fid_colname}>={id_start} '
-                                 f'and {fid_colname}<={id_end}')
-        
-        # Encoding from readable text to URL
-        url_query_variable =  urllib.parse.quote(readable_query_string)
-    
-        # Constructing the full request URL
-        url_comb = url_feature_server + url_query_fixed + url_query_variable
-        
-        # Actually performing the query and storing its results in a 
-        # GeoDataFrame
-        geodata_part =  (gpd.read_file(url_comb, 
-                                       driver='GeoJSON'))
-        
-        # Appending the result to `geodata_parts`
-        if geodata_part.shape[0] > 0:
-            geodata_parts.append(geodata_part)
-
-    # Concatenating all of the query parts into one large GeoDataFrame
-    geodata_final = (pd.concat(geodata_parts, 
-                               ignore_index=True)
-                     .sort_values(by=fid_colname)
-                     .reset_index(drop=True))
-    
-    # Checking if any object ID is missing
-    ids_queried = set(geodata_final[fid_colname])
-    for i,this_id in enumerate(all_objectids):
-        if this_id not in ids_queried:
-            print('WARNING! The following ObjectID is missing from the final '
-                  f'GeoDataFrame: ObjectID={this_id}')
-            pass
-    
-    # Checking if any object ID is included twice
-    geodata_temp = geodata_final[[fid_colname]].copy()
-    geodata_temp['temp'] = 1
-    geodata_temp = (geodata_temp
-                    .groupby(fid_colname)
-                    .agg({'temp':'sum'})
-                    .reset_index())
-    geodata_temp = geodata_temp.loc[geodata_temp['temp']>1].copy()
-    for i,this_id in enumerate(geodata_temp[fid_colname].values):
-        n_times = geodata_temp['temp'].values[i]
-        print('WARNING! The following ObjectID is included multiple times in'
-              f'the final GeoDataFrame: ObjectID={this_id}\tOccurrences={n_times}')
-        
+
+    # Downloading the pages concurrently. The engine reads the layer
+    # definition (the `objectIdField` and `maxRecordCount`), pulls the list
+    # of object IDs and then requests ObjectID ranges that never go beyond
+    # the record limit, shrinking and growing the range size as the server
+    # allows. Finished pages are checkpointed so a failed run can resume.
+    geodata_final, fid_colname, all_objectids = fetch_features(
+        url_feature_server,
+        max_workers=max_workers,
+        checkpoint_dir=checkpoint_dir)
+
+    if geodata_final.shape[0] == 0:
+        return geodata_final
+
+    # Checking that every object ID is there exactly once: duplicates are
+    # dropped, missing IDs are refetched, and what's left is summarized in
+    # the integrity report rather than printed ID by ID
+    geodata_final, report = verify_features(geodata_final, fid_colname, all_objectids,
+                                            url_feature_server, max_workers=max_workers)
+    count('missing_ids', report.missing)
+    count('duplicate_rows', report.duplicate_rows)
+    count('refetched_rows', report.refetched)
+    if not report.ok or report.duplicate_rows:
+        print(f'WARNING! {url_feature_server}: {report}')
+    geodata_final.attrs['integrity'] = report.as_dict()
+
     # # drop geometry column
     # geodata_final = geodata_final.drop(columns='geometry')
+
+    # The download finished, so the checkpoint is no longer needed
+    clear_checkpoint(checkpoint_dir)
     
     return geodata_final
 
 
 @task
+@instrumented()
 def load_data_to_sqlite(df, table_name, db_name='water_data.db'):
-    # create a SQLite database and connect to it
-    conn = sqlite3.connect(db_name)
-    df.to_sql(table_name, conn, if_exists='replace', index=False)
-    conn.close()
+    # create the typed, indexed table and bulk load it in one transaction
+    load_table(df, table_name, db_name)
 
 @task
-def merge_data(db_name='water_data.db'):
-    conn = sqlite3.connect(db_name)
-    # query the database to perform a left join on the "ROADSEGMENTID" column
-    query = """
-    SELECT *
-    FROM breaks
-    LEFT JOIN mains
-    ON breaks.ROADSEGMENTID = mains.ROADSEGMENTID
-    """
-    merged_data = pd.read_sql(query, conn)
+@instrumented()
+def merge_data(db_name='water_data.db', city=None):
+    conn = connect(db_name)
+    # query the database to join every break to the main it was matched to,
+    # or, before the breaks have been matched, on the "ROADSEGMENTID" column.
+    # The columns are listed explicitly so the mains columns that share a name
+    # with a breaks column don't come back as duplicates
+    matches = partition_table(MATCHES_TABLE, city)
+    has_matches = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                               "AND name = ?", (matches,)).fetchone()
+    query = merge_query(conn, partition_table('breaks', city), partition_table('mains', city),
+                        matches=matches if has_matches else None)
+    # SQLite gives back TEXT, INTEGER and REAL: restore the compact dtypes
+    merged_data = apply_schema(pd.read_sql(query, conn))
     conn.close()
 
-
+    if city is not None:
+        merged_data['city'] = pd.Series(city, index=merged_data.index, dtype='category')
     return merged_data
 
 @task
-def convert_data(merged_data):
-    # convert data to csv file and move it to data/raw
-    merged_data.to_csv('data/raw/water_data.csv', index=False)
+@instrumented()
+def convert_data(merged_data, city=None):
+    # store the merged data in data/raw as parquet (one table per city),
+    # keeping the csv export for anything that still reads it
+    write_table(merged_data, partition_table('water_data', city), 'raw', csv=True)
+    return merged_data
 
 # url_breaks = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Main_Breaks/FeatureServer/0/'
 # breaks = fetch_data(url_breaks)
@@ -202,35 +136,204 @@ def convert_data(merged_data):
 # url_mains = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Mains/FeatureServer/0/'
 # mains = fetch_data(url_mains)
 
-# schedule = CronSchedule("0 0 * * SUN")
+def prepare_breaks(breaks_data):
+    # pull the coordinates out of the point geometry before dropping it
+    breaks_data['longitude'] = breaks_data['geometry'].apply(lambda p: p.x)
+    breaks_data['latitude'] = breaks_data['geometry'].apply(lambda p: p.y)
+    breaks_data = pd.DataFrame(breaks_data.drop(columns=['geometry']))
+    breaks_data['INCIDENT_DATE'] = pd.to_datetime(breaks_data['INCIDENT_DATE'], unit='ms')
+    return apply_schema(breaks_data)
+
+def prepare_mains(mains_data):
+    # keep the line geometry as WKB for the spatial matching of the breaks
+    mains_data['geometry_wkb'] = mains_data['geometry'].to_wkb()
+    mains_data = pd.DataFrame(mains_data.drop(columns=['geometry']))
+    mains_data['INSTALLATION_DATE'] = pd.to_datetime(mains_data['INSTALLATION_DATE'], unit='ms')
+    return apply_schema(mains_data)
+
+@task
+@instrumented()
+def sync_table(url_feature_server, table_name, prepare, full_refresh=False,
+               db_name='water_data.db'):
+    summary = sync_layer(url_feature_server, table_name, db_name=db_name,
+                         prepare=prepare, full_refresh=full_refresh,
+                         checkpoint_dir=f'data/interim/checkpoints/{table_name}')
+    count('rows_upserted', summary['upserted'])
+    count('rows_deleted', summary['deleted'])
+    print(f"Synced {summary['table']}: {summary['upserted']} rows upserted, "
+          f"{summary['deleted']} rows deleted"
+          f"{' (table rebuilt)' if summary['rebuilt'] else ''}")
+    return summary
+
+@task
+@instrumented()
+def match_breaks_to_mains(db_name='water_data.db', city=None):
+    try:
+        summary = match_breaks(db_name, breaks_table=partition_table('breaks', city),
+                               mains_table=partition_table('mains', city),
+                               output_table=partition_table(MATCHES_TABLE, city))
+    except LookupError as e:
+        # the merge falls back to joining on ROADSEGMENTID
+        print(e)
+        return None
+    print(f"Matched {summary['matched']} of {summary['breaks']} breaks to a main")
+    return summary
+
+PREPARE = {'breaks': prepare_breaks, 'mains': prepare_mains}
+
+# SQLite takes one writer at a time: the sources are fetched concurrently
+# but loaded one after the other
+_load_lock = threading.Lock()
+
+@task
+def ingest_source(source, limiter, max_workers=4, db_name='water_data.db', stages=()):
+    '''
+    Fetch one source of `config/sources.json` and replace the partition of
+    its layer for its city (e.g. `breaks__kitchener`) with it.
+
+    The requests go through `limiter`, shared by every source fetched at the
+    same time, so the servers never see more than its limits in total. The
+    source is measured as stage `ingest.<city>.<layer>`, nested in `stages`
+    (those of the flow, which runs in another thread).
+    '''
+    table_name = partition_table(source['layer'], source['city'])
+    checkpoint_dir = f"data/interim/checkpoints/{source['city']}/{source['layer']}"
+    with attach(stages), stage(f"ingest.{source['city']}.{source['layer']}") as current:
+        geodata, fid_colname, all_objectids = fetch_features(
+            source['url'], max_workers=max_workers, checkpoint_dir=checkpoint_dir,
+            limiter=limiter)
+        current.rows_in = geodata.shape[0]
+        if geodata.shape[0] == 0:
+            # nothing to build the table from: keep whatever was loaded before
+            print(f"WARNING! {source['url']} returned no features, {table_name} left as is")
+            current.rows_out = 0
+            return dict(source, table=table_name, rows=0, integrity=None)
+
+        geodata, report = verify_features(geodata, fid_colname, all_objectids, source['url'],
+                                          max_workers=max_workers, limiter=limiter)
+        count('missing_ids', report.missing)
+        count('duplicate_rows', report.duplicate_rows)
+        count('refetched_rows', report.refetched)
+        if not report.ok or report.duplicate_rows:
+            print(f"WARNING! {table_name}: {report}")
+        geodata = PREPARE[source['layer']](geodata)
+
+        with _load_lock:
+            load_table(geodata, table_name, db_name)
+        clear_checkpoint(checkpoint_dir)
+        current.rows_out = geodata.shape[0]
+    print(f"Loaded {geodata.shape[0]} rows of {source['url']} into {table_name}")
+    return dict(source, table=table_name, rows=int(geodata.shape[0]),
+                integrity=report.as_dict())
+
+@flow(name='water-main-breaks-sources', task_runner=ConcurrentTaskRunner())
+def fetch_and_load_sources(config_path=SOURCES_PATH, max_requests=8, max_per_host=4,
+                           max_workers=4, db_name='water_data.db'):
+    '''
+    Ingest every (city, layer, URL) source of `config_path` into per-city
+    partitions, then match, merge and store the break data of every city
+    that has both layers as the raw `water_data__<city>` table.
+
+    All the sources are fetched at once, as concurrent Prefect tasks, but
+    share one `RequestLimiter`: at most `max_requests` requests are in flight
+    overall and `max_per_host` on any one server. A source that fails is
+    reported and its city skipped; the others still load.
+    '''
+    sources = load_sources(config_path)
+    limiter = RequestLimiter(max_requests, max_per_host)
+    with stage('fetch_and_load_sources', len(sources)) as run:
+        with stage('sources.fetch', len(sources)) as current:
+            # the tasks run in worker threads: pass them the stages to nest in
+            futures = [ingest_source.submit(source, limiter, max_workers, db_name,
+                                            active_stages())
+                       for source in sources]
+            results = [future.result(raise_on_failure=False) for future in futures]
+            loaded = []
+            for source, result in zip(sources, results):
+                if isinstance(result, BaseException):
+                    print(f"FAILED {source['layer']} of {source['city']} ({source['url']}): "
+                          f"{result}")
+                else:
+                    loaded.append(result)
+            current.rows_out = sum(result['rows'] for result in loaded)
+
+        merged_rows = 0
+        for city in cities(sources):
+            layers = {result['layer'] for result in loaded
+                      if result['city'] == city and result['rows']}
+            missing = sorted({'breaks', 'mains'} - layers)
+            if missing:
+                print(f"Skipping the merge of {city}: no {' or '.join(missing)}")
+                continue
+            match_breaks_to_mains(db_name, city)
+            merged_rows += convert_data(merge_data(db_name, city), city).shape[0]
+        run.rows_out = merged_rows
+
+    return loaded
+
+URL_BREAKS = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Main_Breaks/FeatureServer/0/'
+URL_MAINS = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Mains/FeatureServer/0/'
 
 @flow(name='water-main-breaks')
-def fetch_and_load_data():
-    # fetch data from the two data sources
-    url_breaks = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Main_Breaks/FeatureServer/0/'
-    url_mains = 'https://services1.arcgis.com/qAo1OsXi67t7XgmS/arcgis/rest/services/Water_Mains/FeatureServer/0/'
-    breaks_data = fetch_data(url_breaks)
-    mains_data = fetch_data(url_mains)
+def fetch_and_load_data(incremental=False, full_refresh=False):
+    # every task below is also recorded as a stage of this run, with its
+    # time, rows, HTTP requests/bytes and memory (see src/instrumentation.py)
+    with stage('fetch_and_load_data') as run:
+        if incremental:
+            # only ask the servers for new or edited features and upsert them.
+            # `full_refresh` additionally diffs the object ID lists to remove
+            # features that were deleted upstream
+            sync_table(URL_BREAKS, 'breaks', prepare_breaks, full_refresh=full_refresh)
+            sync_table(URL_MAINS, 'mains', prepare_mains, full_refresh=full_refresh)
+        else:
+            # fetch data from the two data sources
+            with stage('layer.breaks'):
+                breaks_data = fetch_data(URL_BREAKS, checkpoint_dir='data/interim/checkpoints/breaks')
+            with stage('layer.mains'):
+                mains_data = fetch_data(URL_MAINS, checkpoint_dir='data/interim/checkpoints/mains')
 
-    breaks_data['longitude'] = breaks_data['geometry'].apply(lambda p: p.x)
-    breaks_data['latitude'] = breaks_data['geometry'].apply(lambda p: p.y)
+            breaks_data = prepare_breaks(breaks_data)
+            mains_data = prepare_mains(mains_data)
 
-    breaks_data.drop(columns=['geometry'], inplace=True)
-    mains_data.drop(columns=['geometry'], inplace=True)
+            # Load the fetched data into a SQLite database
+            load_data_to_sqlite(breaks_data, 'breaks')
+            load_data_to_sqlite(mains_data, 'mains')
 
-    breaks_data['INCIDENT_DATE'] = pd.to_datetime(breaks_data['INCIDENT_DATE'], unit='ms')
-    mains_data['INSTALLATION_DATE'] = pd.to_datetime(mains_data['INSTALLATION_DATE'], unit='ms')
+        # Snap every break to its nearest main
+        match_breaks_to_mains()
 
-    # Load the fetched data into a SQLite database
-    load_data_to_sqlite(breaks_data, 'breaks')
-    load_data_to_sqlite(mains_data, 'mains')
+        # Merge the data
+        merged_data = merge_data()
 
-    # Merge the data
-    merged_data = merge_data()
+        # Convert the merged data to a DataFrame
+        df = convert_data(merged_data)
+        run.rows_out = df.shape[0]
 
-    # Convert the merged data to a DataFrame
-    df = convert_data(merged_data)
+    return df
 
+@flow(name='water-main-breaks-load')
+def load_data(db_name='water_data.db', city=None):
+    '''
+    Match, merge and store the breaks and mains already in `db_name` (of
+    `city`, or the unpartitioned tables) without fetching anything.
+    '''
+    with stage('load_data') as run:
+        match_breaks_to_mains(db_name, city)
+        df = convert_data(merge_data(db_name, city), city)
+        run.rows_out = df.shape[0]
     return df
 
-fetch_and_load_data()
\ No newline at end of file
+
+def main():
+    parser = argparse.ArgumentParser(description='Fetch the water main layers and load them.')
+    parser.add_argument('--incremental', action='store_true',
+                        help='only fetch new or edited features')
+    parser.add_argument('--full-refresh', action='store_true',
+                        help='with --incremental, also remove features deleted upstream')
+    args = parser.parse_args()
+
+    fetch_and_load_data(args.incremental, args.full_refresh)
+
+
+if __name__ == '__main__':
+    main()
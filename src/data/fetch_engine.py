@@ -0,0 +1,486 @@
+import os
+import json
+import time
+import random
+import contextlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlparse
+
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import requests
+from requests.adapters import HTTPAdapter
+
+from src.instrumentation import bind, count
+
+# HTTP status codes that are worth retrying. Anything else (e.g. a 404 for a
+# mistyped layer URL) is raised straight away.
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+
+class _PageTooLarge(Exception):
+    '''Raised when the server refuses or truncates a page of features.'''
+
+
+class RequestLimiter:
+    '''
+    Bounds the requests in flight across every fetch sharing it: at most
+    `max_requests` overall and `max_per_host` to any one server, however many
+    layers are fetched at once and however many workers each of them has
+    (several municipalities often publish on the same ArcGIS host).
+    '''
+
+    def __init__(self, max_requests=8, max_per_host=4):
+        self.max_requests = max_requests
+        self.max_per_host = max_per_host
+        self._total = threading.BoundedSemaphore(max_requests)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host(self, url):
+        host = urlparse(url).netloc
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._hosts[host]
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        '''Hold a request slot for `url` for the duration of the block.'''
+        host = self._host(url)
+        start = time.perf_counter()
+        # always host then total, so two requests can't wait on each other
+        with host, self._total:
+            count('limiter_wait_seconds', time.perf_counter() - start)
+            yield
+
+
+def make_session(max_workers=4):
+    '''
+    Create a `requests.Session` whose connection pool is large enough for
+    `max_workers` concurrent page requests, so every page reuses an already
+    open connection to the feature server instead of doing a new TLS
+    handshake.
+    '''
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_workers)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def request_json(session, url, params, timeout=60, max_retries=4, backoff=0.5,
+                 method='GET', limiter=None):
+    '''
+    Request `url` and decode the JSON body, retrying connection errors,
+    timeouts and retryable HTTP status codes with exponential backoff (plus a
+    little jitter so concurrent workers don't retry in lock step). POST
+    requests send `params` as form data, which keeps long object ID lists
+    out of the URL. With a `RequestLimiter`, every attempt waits for a slot
+    (the backoff doesn't hold one).
+    '''
+    for attempt in range(max_retries + 1):
+        try:
+            with limiter.slot(url) if limiter is not None else contextlib.nullcontext():
+                if method == 'POST':
+                    response = session.post(url, data=params, timeout=timeout)
+                else:
+                    response = session.get(url, params=params, timeout=timeout)
+            if response.status_code in RETRY_STATUS_CODES:
+                raise requests.HTTPError(f'{response.status_code} for {response.url}',
+                                         response=response)
+            response.raise_for_status()
+            count('http_requests')
+            count('http_bytes', len(response.content))
+            return response.json()
+        except (requests.ConnectionError, requests.Timeout,
+                requests.HTTPError, ValueError) as err:
+            retryable = not (isinstance(err, requests.HTTPError) and
+                             err.response is not None and
+                             err.response.status_code not in RETRY_STATUS_CODES)
+            count('http_errors')
+            if not retryable or attempt == max_retries:
+                raise
+            time.sleep(backoff * 2 ** attempt * (1 + random.random() / 2))
+
+
+def get_layer_definition(session, url_feature_server, **retry_kwargs):
+    '''Return the layer definition (objectIdField, maxRecordCount, fields, ...).'''
+    return request_json(session, url_feature_server, {'f': 'pjson'}, **retry_kwargs)
+
+
+def get_object_ids(session, url_feature_server, fid_colname, where=None,
+                   **retry_kwargs):
+    '''
+    Return a sorted array with every object ID matching `where` (by default
+    every feature in the layer).
+    '''
+    params = {'f': 'geojson',
+              'returnIdsOnly': 'true',
+              'where': where or f'{fid_colname} is not null'}
+    payload = request_json(session, url_feature_server + 'query', params,
+                           **retry_kwargs)
+    # Depending on the output format the IDs are either at the top level or
+    # nested under `properties`
+    object_ids = payload.get('objectIds')
+    if object_ids is None:
+        object_ids = payload.get('properties', {}).get('objectIds')
+    return np.sort(np.asarray(object_ids or [], dtype=np.int64))
+
+
+def fetch_page(session, url_feature_server, fid_colname, page_ids,
+               **retry_kwargs):
+    '''
+    Fetch the features whose object IDs are in `page_ids` (sorted) and
+    return the list of GeoJSON features. Dense pages are requested as an
+    ObjectID range; sparse ones (e.g. the changed features of a delta sync)
+    list their IDs explicitly so the range doesn't drag in everything in
+    between. Raises `_PageTooLarge` when the server answers with an error
+    payload or flags the page as truncated, which is how ArcGIS signals that
+    the block was too big.
+    '''
+    id_start, id_end = int(page_ids[0]), int(page_ids[-1])
+    params = {'f': 'geojson', 'outFields': '*'}
+    if id_end - id_start + 1 <= 2 * len(page_ids):
+        params['where'] = (f'{fid_colname}>={id_start} '
+                           f'and {fid_colname}<={id_end}')
+        method = 'GET'
+    else:
+        params['objectIds'] = ','.join(str(int(i)) for i in page_ids)
+        method = 'POST'
+    payload = request_json(session, url_feature_server + 'query', params,
+                           method=method, **retry_kwargs)
+    if 'error' in payload:
+        raise _PageTooLarge(payload['error'])
+    if (payload.get('exceededTransferLimit') or
+            payload.get('properties', {}).get('exceededTransferLimit')):
+        raise _PageTooLarge('exceededTransferLimit')
+    return payload.get('features', [])
+
+
+def _load_checkpoint(checkpoint_dir, url_feature_server):
+    '''
+    Read the checkpoint manifest and the pages it lists. A manifest written
+    for a different layer URL is ignored so that stale checkpoints are never
+    mixed into another layer.
+    '''
+    manifest_path = os.path.join(checkpoint_dir, 'checkpoint.json')
+    if not os.path.exists(manifest_path):
+        return [], []
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get('url') != url_feature_server:
+        return [], []
+
+    completed, features = [], []
+    for id_start, id_end in manifest['completed']:
+        page_path = os.path.join(checkpoint_dir, f'{id_start}-{id_end}.json')
+        if not os.path.exists(page_path):
+            continue
+        with open(page_path) as f:
+            features.extend(json.load(f))
+        completed.append((id_start, id_end))
+    return completed, features
+
+
+def _save_checkpoint(checkpoint_dir, url_feature_server, completed,
+                     id_start, id_end, page_features):
+    '''Persist one finished page and atomically rewrite the manifest.'''
+    page_path = os.path.join(checkpoint_dir, f'{id_start}-{id_end}.json')
+    with open(page_path + '.tmp', 'w') as f:
+        json.dump(page_features, f)
+    os.replace(page_path + '.tmp', page_path)
+
+    manifest_path = os.path.join(checkpoint_dir, 'checkpoint.json')
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump({'url': url_feature_server,
+                   'completed': [[int(s), int(e)] for s, e in completed]}, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _pending_spans(object_ids, completed):
+    '''
+    Split the object IDs that still need fetching into contiguous spans of
+    array positions. A span never straddles a range that was already
+    completed, otherwise the range query `start <= id <= end` would download
+    those features a second time.
+    '''
+    if completed:
+        starts = np.array([s for s, _ in completed], dtype=np.int64)
+        ends = np.array([e for _, e in completed], dtype=np.int64)
+        order = np.argsort(starts)
+        starts, ends = starts[order], ends[order]
+        # Index of the last completed range starting at or before each ID
+        pos = np.searchsorted(starts, object_ids, side='right') - 1
+        done = (pos >= 0) & (object_ids <= ends[np.clip(pos, 0, None)])
+    else:
+        pos = np.full(len(object_ids), -1)
+        done = np.zeros(len(object_ids), dtype=bool)
+
+    remaining = np.flatnonzero(~done)
+    if len(remaining) == 0:
+        return object_ids[remaining], []
+
+    # A new span starts wherever the "segment" between completed ranges
+    # changes
+    segment = pos[remaining]
+    breaks = np.flatnonzero(np.diff(segment)) + 1
+    bounds = np.concatenate(([0], breaks, [len(remaining)]))
+    spans = [(int(lo), int(hi)) for lo, hi in zip(bounds[:-1], bounds[1:])]
+    return object_ids[remaining], spans
+
+
+def fetch_features(url_feature_server, object_ids=None, max_workers=4,
+                   block_size=None, min_block_size=1, grow_after=3,
+                   checkpoint_dir=None, session=None, **retry_kwargs):
+    '''
+    Download every feature of an ArcGIS feature server layer with a bounded
+    pool of worker threads sharing one HTTP session.
+
+    Pages are ObjectID ranges. The block size starts at the server's
+    `maxRecordCount` and adapts for the whole run: a page the server refuses
+    (or that times out after all retries) is split in half and the block
+    size is halved for the pages that haven't been requested yet, and after
+    `grow_after` successful pages in a row it grows again, up to the server
+    maximum.
+
+    Parameters
+    ----------
+    url_feature_server : string
+        Layer URL ending in a forward slash.
+    object_ids : array-like, optional
+        Only fetch these object IDs (e.g. the new and edited features of an
+        incremental sync). By default every ID in the layer is fetched.
+    max_workers : int
+        Maximum number of page requests in flight at once.
+    block_size : int, optional
+        Initial number of object IDs per page. Defaults to `maxRecordCount`.
+    min_block_size : int
+        The block size never shrinks below this value.
+    grow_after : int
+        Number of consecutive successful pages before the block size grows.
+    checkpoint_dir : string, optional
+        Directory where every finished page is saved together with a
+        manifest of the completed ObjectID ranges. If a previous run for the
+        same layer was interrupted, those ranges are loaded from disk and
+        only the rest is requested.
+    session : requests.Session, optional
+        Session to use, by default a new one sized for `max_workers`.
+    **retry_kwargs
+        `timeout`, `max_retries` and `backoff` for every request, and a
+        `limiter` (`RequestLimiter`) shared with other concurrent fetches.
+
+    Returns
+    -------
+    geodata : gpd.GeoDataFrame
+        One row per feature, in no particular order.
+    fid_colname : string
+        Name of the object ID column.
+    all_objectids : np.ndarray
+        Sorted object IDs that were requested.
+    '''
+    if session is None:
+        session = make_session(max_workers)
+
+    layer_def = get_layer_definition(session, url_feature_server, **retry_kwargs)
+    fid_colname = layer_def['objectIdField']
+    record_count_max = layer_def['maxRecordCount']
+
+    if object_ids is None:
+        all_objectids = get_object_ids(session, url_feature_server, fid_colname,
+                                       **retry_kwargs)
+    else:
+        all_objectids = np.unique(np.asarray(object_ids, dtype=np.int64))
+
+    completed, features = [], []
+    if checkpoint_dir is not None:
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        completed, features = _load_checkpoint(checkpoint_dir, url_feature_server)
+
+    remaining, pending = _pending_spans(all_objectids, completed)
+    pending = deque(pending)
+
+    max_block_size = max(min_block_size, record_count_max)
+    block_size = min(block_size or record_count_max, max_block_size)
+    block_size = max(block_size, min_block_size)
+    streak = 0
+
+    # the workers' requests count towards the stages of the calling thread
+    fetch = bind(fetch_page)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+        while pending or in_flight:
+            # Keep the pool busy, carving the next page off the front of the
+            # queue with whatever the current block size is
+            while pending and len(in_flight) < max_workers:
+                lo, hi = pending.popleft()
+                end = min(hi, lo + block_size)
+                if end < hi:
+                    pending.appendleft((end, hi))
+                future = executor.submit(fetch, session, url_feature_server,
+                                         fid_colname, remaining[lo:end],
+                                         **retry_kwargs)
+                in_flight[future] = (lo, end)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                lo, hi = in_flight.pop(future)
+                try:
+                    page_features = future.result()
+                except (_PageTooLarge, requests.Timeout):
+                    if hi - lo <= min_block_size:
+                        raise
+                    # Split the failed page and shrink the pages still to come
+                    mid = (lo + hi) // 2
+                    pending.appendleft((mid, hi))
+                    pending.appendleft((lo, mid))
+                    block_size = max(min_block_size, (hi - lo) // 2)
+                    streak = 0
+                    continue
+
+                features.extend(page_features)
+                id_start, id_end = int(remaining[lo]), int(remaining[hi - 1])
+                completed.append((id_start, id_end))
+                if checkpoint_dir is not None:
+                    _save_checkpoint(checkpoint_dir, url_feature_server,
+                                     completed, id_start, id_end, page_features)
+
+                streak += 1
+                if streak >= grow_after and block_size < max_block_size:
+                    block_size = min(max_block_size, block_size * 2)
+                    streak = 0
+
+    geodata = gpd.GeoDataFrame.from_features(features, crs='EPSG:4326')
+    return geodata, fid_colname, all_objectids
+
+
+def clear_checkpoint(checkpoint_dir):
+    '''Remove the pages and manifest written by `fetch_features`.'''
+    if checkpoint_dir is None or not os.path.isdir(checkpoint_dir):
+        return
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.json') or name.endswith('.tmp'):
+            os.remove(os.path.join(checkpoint_dir, name))
+    if not os.listdir(checkpoint_dir):
+        os.rmdir(checkpoint_dir)
+
+
+class IntegrityReport:
+    '''
+    Outcome of `verify_features`: how many object IDs were expected and
+    fetched, which were missing (as compact ID ranges) and how many
+    duplicate rows were dropped.
+    '''
+
+    def __init__(self, expected, fetched):
+        self.expected = expected
+        self.fetched = fetched
+        self.missing = 0
+        self.refetched = 0
+        self.missing_ranges = []
+        self.duplicate_rows = 0
+        self.duplicate_ids = 0
+        self.unexpected = 0
+
+    @property
+    def ok(self):
+        return self.missing == 0
+
+    def as_dict(self):
+        return dict(vars(self), ok=self.ok)
+
+    def __str__(self):
+        text = (f'{self.fetched}/{self.expected} features, '
+                f'{self.refetched} refetched, {self.missing} missing, '
+                f'{self.duplicate_rows} duplicate rows dropped ({self.duplicate_ids} IDs)')
+        if self.missing_ranges:
+            shown = ', '.join(f'{lo}-{hi}' if lo != hi else str(lo)
+                              for lo, hi in self.missing_ranges[:5])
+            more = len(self.missing_ranges) - 5
+            text += f'; missing IDs {shown}' + (f' and {more} more ranges' if more > 0 else '')
+        return text
+
+
+def missing_ids(expected, fetched):
+    '''
+    IDs of the sorted, unique `expected` array that aren't in `fetched`,
+    by binary search of the sorted fetched IDs.
+    '''
+    fetched = np.unique(np.asarray(fetched, dtype=np.int64))
+    if fetched.size == 0:
+        return expected
+    position = np.minimum(np.searchsorted(fetched, expected), fetched.size - 1)
+    return expected[fetched[position] != expected]
+
+
+def id_ranges(ids):
+    '''Runs of consecutive values of the sorted `ids` as (first, last) pairs.'''
+    if len(ids) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(ids) != 1)
+    starts = np.concatenate([[0], breaks + 1])
+    ends = np.concatenate([breaks, [len(ids) - 1]])
+    return [(int(ids[s]), int(ids[e])) for s, e in zip(starts, ends)]
+
+
+def _ids(geodata, fid_colname):
+    # a download without any feature doesn't even have the ID column
+    if fid_colname not in geodata.columns:
+        return np.empty(0, dtype=np.int64)
+    return geodata[fid_colname].values.astype(np.int64)
+
+
+def drop_duplicate_ids(geodata, fid_colname, report):
+    '''Drop every row whose object ID was already seen, counting them in `report`.'''
+    if fid_colname not in geodata.columns:
+        return geodata
+    duplicated = geodata[fid_colname].duplicated(keep='first').values
+    if duplicated.any():
+        report.duplicate_rows += int(duplicated.sum())
+        report.duplicate_ids += int(geodata.loc[duplicated, fid_colname].nunique())
+        geodata = geodata.loc[~duplicated]
+    return geodata
+
+
+def verify_features(geodata, fid_colname, all_objectids, url_feature_server=None,
+                    max_rounds=2, **fetch_kwargs):
+    '''
+    Check a download against the object ID list it was made from, with
+    vectorized operations only: duplicated rows are dropped, and the
+    missing object IDs are refetched (up to `max_rounds` times) when
+    `url_feature_server` is given.
+
+    Returns
+    -------
+    geodata : gpd.GeoDataFrame
+        The features sorted by object ID, one row per ID.
+    report : IntegrityReport
+    '''
+    report = IntegrityReport(len(all_objectids), geodata.shape[0])
+    geodata = drop_duplicate_ids(geodata, fid_colname, report)
+    missing = missing_ids(all_objectids, _ids(geodata, fid_colname))
+
+    for _ in range(max_rounds if url_feature_server else 0):
+        if missing.size == 0:
+            break
+        refetched, _, _ = fetch_features(url_feature_server, object_ids=missing, **fetch_kwargs)
+        if refetched.shape[0] == 0:
+            break
+        report.refetched += refetched.shape[0]
+        geodata = drop_duplicate_ids(pd.concat([geodata, refetched], ignore_index=True),
+                                     fid_colname, report)
+        missing = missing_ids(all_objectids, _ids(geodata, fid_colname))
+
+    ids = np.sort(_ids(geodata, fid_colname))
+    position = np.minimum(np.searchsorted(all_objectids, ids), max(len(all_objectids) - 1, 0))
+    report.unexpected = int((all_objectids[position] != ids).sum()) if len(all_objectids) else len(ids)
+    report.missing = int(missing.size)
+    report.missing_ranges = id_ranges(missing)
+    report.fetched = geodata.shape[0]
+
+    if fid_colname in geodata.columns:
+        geodata = geodata.sort_values(by=fid_colname).reset_index(drop=True)
+    return geodata, report
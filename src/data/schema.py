@@ -0,0 +1,220 @@
+'''
+Compact dtypes of the break and main columns, applied wherever the tables
+enter the pipeline (the feature server, the SQLite database, the raw CSV
+exports) so every later stage works on the same small frames.
+
+Text columns with a handful of distinct values are categoricals, Y/N (and
+YES/NO) flags are booleans, ids and small integers are int32/int16/int8
+and measurements are float32. The coordinates stay float64: float32 only
+resolves longitudes to about a metre.
+
+Integer columns with missing values can't be numpy integers; they are
+kept as float32 (small integers) or float64 (ids, exact up to 2**53)
+rather than pandas' nullable integers, which numpy and scikit-learn don't
+take. Flags are nullable booleans, which SQLite stores as 1/0/NULL and
+Parquet as booleans.
+
+    python -m src.data.schema    # memory report of the bundled tables
+'''
+import numpy as np
+import pandas as pd
+
+CATEGORY = 'category'
+FLAG = 'boolean'
+
+BREAKS_DTYPES = {
+    'OBJECTID': 'int32',
+    'WATBREAKINCIDENTID': 'int32',
+    'BREAK_TYPE': CATEGORY,
+    'ROAD_CLOSED': CATEGORY,
+    'SIDEWALK_CLOSED': CATEGORY,
+    'HOUR_IMPACTED': CATEGORY,
+    'UNITS_IMPACTED': CATEGORY,
+    'STATUS': CATEGORY,
+    'BREAK_NATURE': CATEGORY,
+    'BREAK_APPARENT_CAUSE': CATEGORY,
+    'REPAIR_TYPE': CATEGORY,
+    'NEW_SECTION_LENGTH': 'float32',
+    'POSITIVE_PRESSURE_MAINTANED': FLAG,
+    'AIR_GAP_MAINTANED': FLAG,
+    'DISINFECTED': FLAG,
+    'MECHANICAL_REMOVAL': FLAG,
+    'FLUSHING_EXCAVATION': FLAG,
+    'HIGHER_VELOCITY_FLUSHING': FLAG,
+    'ANODE_INSTALLED': FLAG,
+    'BREAK_CATEGORIZATION': CATEGORY,
+    'BWA_DWA': FLAG,
+    'PROCEEDURES_FOLLOWED': FLAG,
+    'RECORD_CHANGE_REQD': FLAG,
+    'ROADSEGMENTID': 'int32',
+    'STREET': CATEGORY,
+    'ASSETID': 'int32',
+    'ASSET_DEPTH': 'float32',
+    'FROST_DEPTH': 'float32',
+    'ASSET_SIZE': 'float32',
+    'ASSET_YEAR_INSTALLED': 'int16',
+    'ASSET_MATERIAL': CATEGORY,
+    'ASSET_EXISTS': FLAG,
+}
+
+MAINS_DTYPES = {
+    'OBJECTID': 'int32',
+    'WATMAINID': 'int32',
+    'STATUS': CATEGORY,
+    'PRESSURE_ZONE': CATEGORY,
+    'ROADSEGMENTID': 'int32',
+    'CATEGORY': CATEGORY,
+    'PIPE_SIZE': 'float32',
+    'MATERIAL': CATEGORY,
+    'LINED': FLAG,
+    'LINED_MATERIAL': CATEGORY,
+    'ACQUISITION': CATEGORY,
+    'CONSULTANT': CATEGORY,
+    'OWNERSHIP': CATEGORY,
+    'BRIDGE_MAIN': FLAG,
+    'CRITICALITY': 'int8',
+    'REL_CLEANING_AREA': 'int8',
+    'REL_CLEANING_SUBAREA': 'int16',
+    'UNDERSIZED': FLAG,
+    'SHALLOW_MAIN': FLAG,
+    'CONDITION_SCORE': 'float32',
+    'OVERSIZED': FLAG,
+    'CLEANED': FLAG,
+    'Shape__Length': 'float32',
+}
+
+# Columns of `src.data.spatial_match`, as joined into the merged break data
+MATCHES_DTYPES = {
+    'MAIN_OBJECTID': 'int32',
+    'match_distance': 'float32',
+}
+
+# Every known column; the merged break data prefixes the main columns
+# whose name clashes with a break column with MAIN_
+COLUMN_DTYPES = {**MAINS_DTYPES, **BREAKS_DTYPES, **MATCHES_DTYPES}
+
+FLAG_VALUES = {'Y': True, 'N': False, 'YES': True, 'NO': False,
+               'TRUE': True, 'FALSE': False, '1': True, '0': False}
+
+
+def column_dtype(col, dtypes=None):
+    '''Compact dtype of column `col`, None when it isn't a known column.'''
+    dtypes = COLUMN_DTYPES if dtypes is None else dtypes
+    if col in dtypes:
+        return dtypes[col]
+    if col.startswith('MAIN_'):
+        return dtypes.get(col[len('MAIN_'):])
+    return None
+
+
+def to_flag(series):
+    '''
+    Nullable boolean version of a flag column holding Y/N or YES/NO text,
+    1/0 numbers or booleans. Anything else is missing.
+    '''
+    if isinstance(series.dtype, pd.BooleanDtype):
+        return series
+    if pd.api.types.is_bool_dtype(series):
+        return series.astype(FLAG)
+    if pd.api.types.is_numeric_dtype(series):
+        values = series.to_numpy(dtype='float64', na_value=np.nan)
+        flags = pd.arrays.BooleanArray(values != 0, np.isnan(values))
+        return pd.Series(flags, index=series.index, name=series.name)
+
+    # look up each distinct value once; the extra entry is for code -1 (NaN)
+    categorical = series if isinstance(series.dtype, pd.CategoricalDtype) else series.astype(CATEGORY)
+    keys = [str(c).strip().upper() for c in categorical.cat.categories]
+    truth = np.array([FLAG_VALUES.get(k, False) for k in keys] + [False])
+    known = np.array([k in FLAG_VALUES for k in keys] + [False])
+    codes = categorical.cat.codes.to_numpy()
+    flags = pd.arrays.BooleanArray(truth[codes], ~known[codes])
+    return pd.Series(flags, index=series.index, name=series.name)
+
+
+def _to_integer(series, dtype):
+    if series.dtype == dtype:
+        return series
+    values = pd.to_numeric(series, errors='coerce')
+    info = np.iinfo(dtype)
+    if values.isna().any():
+        # float32 holds the small integers exactly, float64 the ids
+        return values.astype('float32' if info.bits <= 16 else 'float64')
+    if len(values) and (values.min() < info.min or values.max() > info.max):
+        return values.astype('int64')
+    return values.astype(dtype)
+
+
+def convert_column(series, dtype):
+    '''`series` converted to the compact `dtype` of `COLUMN_DTYPES`.'''
+    if dtype == CATEGORY:
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            return series
+        return series.astype(CATEGORY)
+    if dtype == FLAG:
+        return to_flag(series)
+    if dtype.startswith('int'):
+        return _to_integer(series, dtype)
+    if series.dtype == dtype:
+        return series
+    return pd.to_numeric(series, errors='coerce').astype(dtype)
+
+
+def apply_schema(df, dtypes=None):
+    '''
+    Convert the known columns of `df` to their compact dtype, in place.
+    Columns that aren't in `dtypes` (by default `COLUMN_DTYPES`), like the
+    dates and the coordinates, are left alone. Converting a frame that
+    already has the compact dtypes is a no-op.
+    '''
+    for col in df.columns:
+        dtype = column_dtype(col, dtypes)
+        if dtype is not None:
+            df[col] = convert_column(df[col], dtype)
+    return df
+
+
+def memory_usage(df):
+    '''Bytes used by `df`, the Python strings of object columns included.'''
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+def memory_report(frames, dtypes=None):
+    '''
+    Memory of each frame of `frames` ({name: DataFrame}) before and after
+    `apply_schema`, the frames themselves being left unchanged.
+
+    Returns
+    -------
+    report : pd.DataFrame
+        One row per frame: rows, columns converted, MB before and after and
+        the share of the memory saved.
+    '''
+    rows = []
+    for name, df in frames.items():
+        before = memory_usage(df)
+        compact = apply_schema(df.copy(), dtypes)
+        after = memory_usage(compact)
+        rows.append({
+            'frame': name,
+            'rows': df.shape[0],
+            'converted': int(sum(compact[col].dtype != df[col].dtype for col in df.columns)),
+            'before_mb': before / 1024 ** 2,
+            'after_mb': after / 1024 ** 2,
+            'saved': 1 - after / before if before else 0.0,
+        })
+        del compact
+    return pd.DataFrame(rows, columns=['frame', 'rows', 'converted', 'before_mb',
+                                       'after_mb', 'saved'])
+
+
+if __name__ == '__main__':
+    # the tables as pandas reads them by default, against their compact dtypes
+    frames = {
+        'Water_Main_Breaks': pd.read_csv('data/raw/Water_Main_Breaks.csv', encoding='utf-8-sig'),
+        'Water_Mains': pd.read_csv('data/raw/Water_Mains.csv', encoding='utf-8-sig'),
+        'cleaned_break_data': pd.read_csv('data/processed/cleaned_break_data.csv'),
+    }
+    report = memory_report(frames)
+    for r in report.itertuples():
+        print(f'{r.frame:20s} {r.rows:8d} rows  {r.converted:3d} columns converted  '
+              f'{r.before_mb:8.2f} MB -> {r.after_mb:8.2f} MB  ({r.saved:.0%} saved)')
@@ -0,0 +1,55 @@
+'''
+The ArcGIS layers the ingestion flow fetches, one (city, layer, URL) entry
+per layer in `config/sources.json`:
+
+    [{"city": "kitchener", "layer": "breaks", "url": "https://.../FeatureServer/0/"},
+     {"city": "kitchener", "layer": "mains", "url": "https://.../FeatureServer/0/"}]
+
+Every source is loaded into the partition of its layer for its city (see
+`src.data.database.partition_table`), e.g. `breaks__kitchener`.
+'''
+import json
+
+from src.data.database import city_key
+
+SOURCES_PATH = 'config/sources.json'
+
+# Layers the pipeline knows how to prepare and merge
+LAYERS = ('breaks', 'mains')
+
+
+def load_sources(path=SOURCES_PATH):
+    '''
+    Read and validate the source list at `path`.
+
+    Returns
+    -------
+    sources : list of dict
+        'city', 'layer' and 'url' of every source, the URL ending in a
+        forward slash, in the order of the file.
+    '''
+    with open(path) as f:
+        entries = json.load(f)
+    if not isinstance(entries, list):
+        raise ValueError(f'{path}: expected a list of sources')
+
+    sources, seen = [], set()
+    for i, entry in enumerate(entries):
+        missing = {'city', 'layer', 'url'} - set(entry)
+        if missing:
+            raise ValueError(f'{path}: source {i} has no {", ".join(sorted(missing))}')
+        if entry['layer'] not in LAYERS:
+            raise ValueError(f'{path}: source {i} has unknown layer {entry["layer"]!r}, '
+                             f'expected one of {LAYERS}')
+        key = (city_key(entry['city']), entry['layer'])
+        if key in seen:
+            raise ValueError(f'{path}: {entry["layer"]} of {entry["city"]} is listed twice')
+        seen.add(key)
+        url = entry['url'] if entry['url'].endswith('/') else entry['url'] + '/'
+        sources.append({'city': key[0], 'layer': entry['layer'], 'url': url})
+    return sources
+
+
+def cities(sources):
+    '''Cities of `sources` in order of first appearance.'''
+    return list(dict.fromkeys(source['city'] for source in sources))
@@ -0,0 +1,173 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from src.data.database import connect, create_table, create_indexes, insert_rows
+
+# Breaks are matched in metres, in the UTM zone of Kitchener-Waterloo
+METRIC_CRS = 'EPSG:26917'
+SOURCE_CRS = 'EPSG:4326'
+
+# A break further than this from every main is left unmatched
+MATCH_TOLERANCE = 25.0
+
+MATCHES_TABLE = 'break_matches'
+
+
+def _transformer(source_crs=SOURCE_CRS, target_crs=METRIC_CRS):
+    from pyproj import Transformer
+
+    return Transformer.from_crs(source_crs, target_crs, always_xy=True)
+
+
+def project_points(lon, lat, transformer=None):
+    '''Point geometries in `METRIC_CRS` from longitudes/latitudes.'''
+    import shapely
+
+    transformer = transformer or _transformer()
+    x, y = transformer.transform(np.asarray(lon, dtype=np.float64),
+                                 np.asarray(lat, dtype=np.float64))
+    return shapely.points(x, y)
+
+
+def project_lines(lines, transformer=None):
+    '''Reproject shapely geometries to `METRIC_CRS`, all coordinates at once.'''
+    import shapely
+
+    transformer = transformer or _transformer()
+
+    def transform(coords):
+        x, y = transformer.transform(coords[:, 0], coords[:, 1])
+        return np.column_stack([x, y])
+
+    return shapely.transform(lines, transform)
+
+
+def build_index(lines):
+    '''STRtree over the main geometries; query results index into `lines`.'''
+    import shapely
+
+    return shapely.STRtree(lines)
+
+
+def nearest_mains(tree, points, tolerance=MATCH_TOLERANCE):
+    '''
+    Snap every point to its nearest geometry of `tree` within `tolerance`,
+    with one bulk query.
+
+    Returns
+    -------
+    main_index : np.ndarray
+        Index of the matched geometry for each point, -1 when there's none
+        within `tolerance`.
+    distance : np.ndarray
+        Distance to the matched geometry, NaN when unmatched.
+    '''
+    n = len(points)
+    main_index = np.full(n, -1, dtype=np.int64)
+    distance = np.full(n, np.nan)
+    if n == 0 or len(tree.geometries) == 0:
+        return main_index, distance
+
+    # with all_matches=False a point equidistant to several mains gets one
+    (point_idx, line_idx), dist = tree.query_nearest(points, max_distance=tolerance,
+                                                     return_distance=True,
+                                                     all_matches=False)
+    main_index[point_idx] = line_idx
+    distance[point_idx] = dist
+    return main_index, distance
+
+
+def read_mains_geometry(conn, mains_table='mains'):
+    '''Mains with a stored geometry, as shapely lines in `SOURCE_CRS`.'''
+    import shapely
+
+    columns = {row[1] for row in conn.execute(f'PRAGMA table_info({mains_table})')}
+    if 'geometry_wkb' not in columns:
+        raise LookupError(f'Table {mains_table} has no geometry, it was loaded before the '
+                          f'geometries were kept: reload it to match the breaks')
+    mains = pd.read_sql(f'SELECT OBJECTID, WATMAINID, ROADSEGMENTID, geometry_wkb '
+                        f'FROM {mains_table} WHERE geometry_wkb IS NOT NULL', conn)
+    geometry = shapely.from_wkb(mains.pop('geometry_wkb').values)
+    return mains, geometry
+
+
+def match_breaks(db_name='water_data.db', tolerance=MATCH_TOLERANCE,
+                 breaks_table='breaks', mains_table='mains', output_table=MATCHES_TABLE):
+    '''
+    Match every break of `breaks_table` to the nearest main of `mains_table`
+    and (re)write the matches to `output_table`.
+
+    Breaks are matched on geometry rather than ROADSEGMENTID, so a break on
+    a segment carrying several mains gets the main it's on, and breaks
+    without a segment ID are matched too. Unmatched breaks are stored with
+    NULL main columns.
+
+    Parameters
+    ----------
+    db_name : string
+        SQLite database with the breaks and mains tables. The mains must
+        have been loaded with their geometry (`geometry_wkb`).
+    tolerance : float
+        Largest distance, in metres, between a break and its main.
+
+    Returns
+    -------
+    summary : dict
+        Number of breaks, matched breaks and the timings of the stage.
+    '''
+    conn = connect(db_name)
+    try:
+        start = time.perf_counter()
+        mains, lines = read_mains_geometry(conn, mains_table)
+        breaks = pd.read_sql(f'SELECT OBJECTID, longitude, latitude FROM {breaks_table}', conn)
+
+        transformer = _transformer()
+        tree = build_index(project_lines(lines, transformer))
+        indexed = time.perf_counter()
+
+        located = breaks['longitude'].notna() & breaks['latitude'].notna()
+        main_index = np.full(breaks.shape[0], -1, dtype=np.int64)
+        distance = np.full(breaks.shape[0], np.nan)
+        points = project_points(breaks.loc[located, 'longitude'],
+                                breaks.loc[located, 'latitude'], transformer)
+        main_index[located.values], distance[located.values] = nearest_mains(tree, points, tolerance)
+        queried = time.perf_counter()
+
+        matched = main_index >= 0
+        matches = pd.DataFrame({'OBJECTID': breaks['OBJECTID'].values})
+        for col, source in [('MAIN_OBJECTID', 'OBJECTID'), ('WATMAINID', 'WATMAINID'),
+                            ('ROADSEGMENTID', 'ROADSEGMENTID')]:
+            # NaN is stored as NULL, and as an integer otherwise
+            values = np.full(matches.shape[0], np.nan)
+            values[matched] = mains[source].values[main_index[matched]]
+            matches[col] = values
+        matches['match_distance'] = distance
+
+        with conn:
+            create_table(conn, matches, output_table)
+            insert_rows(conn, matches, output_table)
+            create_indexes(conn, output_table)
+    finally:
+        conn.close()
+
+    return {'breaks': int(breaks.shape[0]), 'matched': int(matched.sum()),
+            'index_seconds': indexed - start, 'query_seconds': queried - indexed}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Match every break to its nearest water main.')
+    parser.add_argument('--db', default='water_data.db')
+    parser.add_argument('--tolerance', type=float, default=MATCH_TOLERANCE)
+    args = parser.parse_args()
+
+    summary = match_breaks(args.db, args.tolerance)
+    print(f"Matched {summary['matched']} of {summary['breaks']} breaks within "
+          f"{args.tolerance:g} m (index {summary['index_seconds']:.2f} s, "
+          f"query {summary['query_seconds']:.2f} s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+import os
+
+import pandas as pd
+
+from src.data.schema import apply_schema
+
+# Every stage of the pipeline reads and writes its tables under
+# `data/<stage>/<name>.parquet`, with the CSV next to it when an export is
+# wanted (or when the table only exists as a CSV so far).
+DATA_DIR = 'data'
+STAGES = ('raw', 'interim', 'processed')
+
+# Text columns where at most this fraction of the values are distinct are
+# stored as categoricals, which Parquet keeps dictionary encoded
+CATEGORY_MAX_RATIO = 0.5
+
+COMPRESSION = 'zstd'
+ROW_GROUP_SIZE = 64_000
+
+
+def table_path(name, stage='processed', fmt='parquet', data_dir=DATA_DIR):
+    '''Path of table `name` of `stage` in format `fmt` ('parquet' or 'csv').'''
+    if stage not in STAGES:
+        raise ValueError(f'Unknown stage {stage!r}, expected one of {STAGES}')
+    return os.path.join(data_dir, stage, f'{name}.{fmt}')
+
+
+def find_table(name, stage='processed', data_dir=DATA_DIR):
+    '''Path of the file `read_table` reads for `name`: the Parquet, else the CSV.'''
+    path = table_path(name, stage, 'parquet', data_dir)
+    if os.path.exists(path):
+        return path
+    return table_path(name, stage, 'csv', data_dir)
+
+
+def _compact_text_columns(df):
+    '''Turn low-cardinality text columns into categoricals.'''
+    converted = {}
+    for col in df.columns:
+        if df[col].dtype != object:
+            continue
+        values = df[col].dropna()
+        if len(values) == 0:
+            continue
+        # mixed object columns (e.g. numbers and text) are left alone
+        if not values.map(type).eq(str).all():
+            continue
+        if values.nunique() <= CATEGORY_MAX_RATIO * len(values):
+            converted[col] = df[col].astype('category')
+    return df.assign(**converted) if converted else df
+
+
+def write_table(df, name, stage='processed', csv=False, parse_dates=None,
+                data_dir=DATA_DIR):
+    '''
+    Write `df` as a compressed Parquet table.
+
+    The compact dtypes of `src.data.schema` (categoricals, booleans, small
+    integers and floats) are kept, other low-cardinality text columns are
+    written as dictionary-encoded categoricals and date columns as
+    timestamps, so reading the table back gives the same dtypes without
+    any parsing.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Table to write. The index is not stored.
+    name : string
+        Table name, e.g. 'model_data'.
+    stage : string
+        One of `STAGES`.
+    csv : bool
+        Also export the table as CSV next to the Parquet file.
+    parse_dates : list, optional
+        Text columns to convert to timestamps before writing.
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    path = table_path(name, stage, 'parquet', data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if parse_dates:
+        df = df.assign(**{col: pd.to_datetime(df[col]) for col in parse_dates})
+    table = pa.Table.from_pandas(_compact_text_columns(df), preserve_index=False)
+    pq.write_table(table, path, compression=COMPRESSION,
+                   row_group_size=ROW_GROUP_SIZE)
+
+    if csv:
+        export_csv(df, name, stage, data_dir)
+    return path
+
+
+def export_csv(df, name, stage='processed', data_dir=DATA_DIR):
+    '''Write `df` as `data/<stage>/<name>.csv`.'''
+    path = table_path(name, stage, 'csv', data_dir)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, index=False)
+    return path
+
+
+_OPERATORS = {
+    '==': lambda s, v: s == v,
+    '=': lambda s, v: s == v,
+    '!=': lambda s, v: s != v,
+    '<': lambda s, v: s < v,
+    '<=': lambda s, v: s <= v,
+    '>': lambda s, v: s > v,
+    '>=': lambda s, v: s >= v,
+    'in': lambda s, v: s.isin(v),
+    'not in': lambda s, v: ~s.isin(v),
+}
+
+
+def _apply_filters(df, filters):
+    '''Apply pyarrow-style `[(column, op, value), ...]` filters in pandas.'''
+    mask = pd.Series(True, index=df.index)
+    for col, op, value in filters:
+        mask &= _OPERATORS[op](df[col], value)
+    return df.loc[mask].reset_index(drop=True)
+
+
+def read_table(name, stage='processed', columns=None, filters=None,
+               parse_dates=None, data_dir=DATA_DIR):
+    '''
+    Read table `name` of `stage`.
+
+    The Parquet file is preferred: only `columns` are read from disk and
+    `filters` are pushed down so row groups whose statistics rule them out
+    are skipped. When the table only exists as a CSV it is read from there
+    instead, with the same projection and filters applied in pandas, and
+    converted to the compact dtypes of `src.data.schema` the Parquet file
+    was written with.
+
+    Parameters
+    ----------
+    name : string
+        Table name, e.g. 'model_data'.
+    stage : string
+        One of `STAGES`.
+    columns : list, optional
+        Columns to read, by default all of them.
+    filters : list, optional
+        Row filters as `(column, op, value)` tuples, e.g.
+        `[('ASSET_EXISTS', '==', True)]`. All of them must hold.
+    parse_dates : list, optional
+        Date columns to parse, only needed for the CSV fallback.
+
+    Returns
+    -------
+    df : pd.DataFrame
+    '''
+    path = find_table(name, stage, data_dir)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        table = pq.read_table(path, columns=columns, filters=filters)
+        return table.to_pandas()
+
+    usecols = None
+    if columns is not None:
+        # the filter columns have to be read too, they're dropped afterwards
+        usecols = list(dict.fromkeys(list(columns) +
+                                     [col for col, _, _ in filters or []]))
+    if parse_dates and usecols is not None:
+        parse_dates = [col for col in parse_dates if col in usecols]
+    df = apply_schema(pd.read_csv(path, usecols=usecols, parse_dates=parse_dates or False))
+    if filters:
+        df = _apply_filters(df, filters)
+    if columns is not None:
+        df = df[list(columns)]
+    return df
+
+
+def iter_table(name, stage='processed', columns=None, batch_rows=50_000,
+               data_dir=DATA_DIR):
+    '''
+    Read table `name` of `stage` in chunks of at most `batch_rows` rows, so
+    tables larger than memory can be processed. Parquet tables are read one
+    record batch at a time, CSV tables with a chunked reader.
+    '''
+    path = find_table(name, stage, data_dir)
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+
+        parquet_file = pq.ParquetFile(path)
+        for batch in parquet_file.iter_batches(batch_size=batch_rows, columns=columns):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=batch_rows):
+            yield apply_schema(chunk)
+
+
+def convert_csv(name, stage='processed', parse_dates=None, data_dir=DATA_DIR,
+                **read_csv_kwargs):
+    '''Convert the existing CSV of table `name` to Parquet, with compact dtypes.'''
+    df = apply_schema(pd.read_csv(table_path(name, stage, 'csv', data_dir), **read_csv_kwargs))
+    return write_table(df, name, stage, parse_dates=parse_dates,
+                       data_dir=data_dir)
+
+
+if __name__ == '__main__':
+    # convert the bundled datasets so every stage can read Parquet
+    convert_csv('Water_Main_Breaks', 'raw', parse_dates=['INCIDENT_DATE'],
+                encoding='utf-8-sig')
+    convert_csv('Water_Mains', 'raw', parse_dates=['INSTALLATION_DATE'],
+                encoding='utf-8-sig')
+    convert_csv('cleaned_break_data', 'processed', parse_dates=['INCIDENT_DATE'])
+    convert_csv('model_data', 'processed')
+    convert_csv('test_predict_data', 'processed')
@@ -0,0 +1,229 @@
+import datetime
+import sqlite3
+
+import numpy as np
+import pandas as pd
+
+from src.data.fetch_engine import (make_session, get_layer_definition,
+                                   get_object_ids, fetch_features, verify_features,
+                                   clear_checkpoint)
+from src.data.database import (connect, create_table, create_indexes,
+                               insert_rows)
+
+# Table holding the high-water marks of every synced layer
+SYNC_STATE_TABLE = 'sync_state'
+
+
+def _create_sync_state(conn):
+    conn.execute(f'''
+    CREATE TABLE IF NOT EXISTS {SYNC_STATE_TABLE} (
+        table_name TEXT PRIMARY KEY,
+        url TEXT,
+        fid_colname TEXT,
+        edit_date_field TEXT,
+        max_objectid INTEGER,
+        max_edit_date INTEGER,
+        row_count INTEGER,
+        synced_at TEXT
+    )
+    ''')
+
+
+def read_sync_state(table_name, db_name='water_data.db'):
+    '''Return the stored high-water marks of `table_name`, or None.'''
+    conn = sqlite3.connect(db_name)
+    try:
+        _create_sync_state(conn)
+        state = pd.read_sql(f'SELECT * FROM {SYNC_STATE_TABLE} WHERE table_name = ?',
+                            conn, params=(table_name,))
+    finally:
+        conn.close()
+    if state.shape[0] == 0:
+        return None
+    return state.iloc[0].to_dict()
+
+
+def _write_sync_state(conn, table_name, url, fid_colname, edit_date_field,
+                      max_objectid, max_edit_date):
+    row_count = conn.execute(f'SELECT COUNT(*) FROM {table_name}').fetchone()[0]
+    conn.execute(f'INSERT OR REPLACE INTO {SYNC_STATE_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                 (table_name, url, fid_colname, edit_date_field,
+                  max_objectid, max_edit_date, row_count,
+                  datetime.datetime.utcnow().isoformat(timespec='seconds')))
+
+
+def _table_exists(conn, table_name):
+    query = "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?"
+    return conn.execute(query, (table_name,)).fetchone() is not None
+
+
+def _stage_ids(conn, object_ids):
+    '''Put `object_ids` in a temp table so they can be used in a join/IN.'''
+    conn.execute('DROP TABLE IF EXISTS temp.sync_ids')
+    conn.execute('CREATE TEMP TABLE sync_ids (id INTEGER PRIMARY KEY)')
+    conn.executemany('INSERT OR IGNORE INTO temp.sync_ids VALUES (?)',
+                     ((int(i),) for i in object_ids))
+
+
+def upsert_rows(conn, df, table_name, fid_colname):
+    '''
+    Replace the rows of `table_name` whose object ID appears in `df` and
+    insert the new ones. Columns the table doesn't know about are dropped so
+    a new field on the server doesn't break the load.
+    '''
+    if df.shape[0] == 0:
+        return
+    columns = [row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')]
+    # The object ID is the primary key of the typed tables, but tables
+    # created by an older `to_sql` load have no key to conflict on
+    delete_rows(conn, table_name, fid_colname, df[fid_colname].values)
+    insert_rows(conn, df.reindex(columns=columns), table_name)
+
+
+def delete_rows(conn, table_name, fid_colname, object_ids):
+    '''Delete the rows of `table_name` with the given object IDs.'''
+    if len(object_ids) == 0:
+        return
+    _stage_ids(conn, object_ids)
+    conn.execute(f'DELETE FROM {table_name} '
+                 f'WHERE {fid_colname} IN (SELECT id FROM temp.sync_ids)')
+
+
+def sync_layer(url_feature_server, table_name, db_name='water_data.db',
+               prepare=None, full_refresh=False, max_workers=4,
+               checkpoint_dir=None):
+    '''
+    Bring `table_name` up to date with a feature server layer without
+    downloading the whole layer again.
+
+    The first sync of a table downloads everything and records a high-water
+    mark (the largest object ID and, if the layer has editor tracking, the
+    latest edit date) in the `sync_state` table. Later syncs only ask the
+    server for features above the object ID mark or edited after the date
+    mark, and upsert them. While the layer is empty, the table isn't
+    created and no mark is recorded.
+
+    Parameters
+    ----------
+    url_feature_server : string
+        Layer URL.
+    table_name : string
+        SQLite table the layer is stored in.
+    db_name : string
+        SQLite database file.
+    prepare : callable, optional
+        Applied to every downloaded GeoDataFrame before it is written (e.g.
+        converting date columns and dropping the geometry).
+    full_refresh : bool
+        Also reconcile the whole object ID list with the table: rows whose
+        ID no longer exists on the server are deleted and any ID missing
+        locally is fetched. Only the ID list is downloaded in full.
+    max_workers, checkpoint_dir
+        Passed to `fetch_features`.
+
+    Returns
+    -------
+    summary : dict
+        Number of rows upserted and deleted, and whether the table was
+        (re)built from scratch.
+    '''
+    if url_feature_server[-1] != '/':
+        url_feature_server = url_feature_server + '/'
+
+    session = make_session(max_workers)
+    layer_def = get_layer_definition(session, url_feature_server)
+    fid_colname = layer_def['objectIdField']
+    edit_date_field = (layer_def.get('editFieldsInfo') or {}).get('editDateField')
+
+    state = read_sync_state(table_name, db_name)
+    conn = sqlite3.connect(db_name)
+    try:
+        initial = (state is None or state['url'] != url_feature_server or
+                   not _table_exists(conn, table_name))
+    finally:
+        conn.close()
+
+    deleted_ids = np.array([], dtype=np.int64)
+    if initial:
+        fetch_ids = None
+    else:
+        # New features (above the object ID mark) and edited ones
+        where = f'{fid_colname} > {int(state["max_objectid"])}'
+        if edit_date_field and pd.notna(state['max_edit_date']):
+            last_edit = pd.to_datetime(int(state['max_edit_date']), unit='ms')
+            where += (f" OR {edit_date_field} > timestamp "
+                      f"'{last_edit:%Y-%m-%d %H:%M:%S}'")
+        fetch_ids = get_object_ids(session, url_feature_server, fid_colname,
+                                   where=where)
+
+        if full_refresh:
+            # Diff the full object ID list against the table to find
+            # features that were deleted on the server or never made it in
+            remote_ids = get_object_ids(session, url_feature_server, fid_colname)
+            conn = sqlite3.connect(db_name)
+            try:
+                local_ids = pd.read_sql(f'SELECT {fid_colname} FROM {table_name}',
+                                        conn)[fid_colname].values.astype(np.int64)
+            finally:
+                conn.close()
+            local_ids = np.unique(local_ids)
+            deleted_ids = np.setdiff1d(local_ids, remote_ids, assume_unique=True)
+            missing_ids = np.setdiff1d(remote_ids, local_ids, assume_unique=True)
+            fetch_ids = np.union1d(fetch_ids, missing_ids)
+
+    if fetch_ids is not None and len(fetch_ids) == 0:
+        geodata = pd.DataFrame()
+    else:
+        geodata, _, requested = fetch_features(url_feature_server, object_ids=fetch_ids,
+                                               max_workers=max_workers,
+                                               checkpoint_dir=checkpoint_dir,
+                                               session=session)
+        # drop duplicated features and refetch any that went missing
+        geodata, report = verify_features(geodata, fid_colname, requested, url_feature_server,
+                                          max_workers=max_workers, session=session)
+        if not report.ok:
+            print(f'WARNING! {table_name}: {report}')
+
+    # High-water marks come from the raw server values, before `prepare`
+    # converts any dates
+    max_objectid = None if initial else state['max_objectid']
+    max_edit_date = None if initial else state['max_edit_date']
+    if geodata.shape[0] > 0:
+        marks = [geodata[fid_colname].max(), max_objectid]
+        max_objectid = int(max(m for m in marks if pd.notna(m)))
+        if edit_date_field in geodata.columns:
+            marks = [m for m in [geodata[edit_date_field].max(), max_edit_date]
+                     if pd.notna(m)]
+            max_edit_date = int(max(marks)) if marks else None
+
+    if initial and geodata.shape[0] == 0:
+        # nothing to build the table from (an empty layer has no columns
+        # either); no high-water mark is recorded, so the next sync is a
+        # first sync again
+        clear_checkpoint(checkpoint_dir)
+        return {'table': table_name, 'rebuilt': False, 'upserted': 0, 'deleted': 0}
+
+    if prepare is not None and geodata.shape[0] > 0:
+        geodata = prepare(geodata)
+
+    conn = connect(db_name)
+    try:
+        with conn:
+            _create_sync_state(conn)
+            if initial:
+                create_table(conn, geodata, table_name)
+                insert_rows(conn, geodata, table_name)
+                create_indexes(conn, table_name)
+            else:
+                delete_rows(conn, table_name, fid_colname, deleted_ids)
+                upsert_rows(conn, geodata, table_name, fid_colname)
+            _write_sync_state(conn, table_name, url_feature_server, fid_colname,
+                              edit_date_field, max_objectid, max_edit_date)
+    finally:
+        conn.close()
+    clear_checkpoint(checkpoint_dir)
+
+    return {'table': table_name,
+            'rebuilt': initial,
+            'upserted': int(geodata.shape[0]),
+            'deleted': int(len(deleted_ids))}
@@ -0,0 +1,264 @@
+import numpy as np
+import pandas as pd
+
+# Pipe diameter bands (mm): below 100, 100-149, ..., 600 and above, plus
+# one band for an unknown size
+SIZE_EDGES = [100, 150, 200, 250, 300, 400, 600]
+N_SIZE_BANDS = len(SIZE_EDGES) + 2
+
+# Earlier breaks of the main are counted up to this many (3 means "3 or more")
+MAX_PRIOR_BREAKS = 3
+
+# Exposure at older ages isn't tabulated
+MAX_AGE = 150
+
+# Mains of an unknown or unseen material
+UNKNOWN_MATERIAL = 'UNKNOWN'
+
+
+def years(dates):
+    """Calendar year of every date (text or datetime), NaN where missing."""
+    dates = pd.to_datetime(dates, errors='coerce', utc=True)
+    return dates.dt.year.to_numpy(dtype='float64', na_value=np.nan)
+
+
+def size_bands(sizes):
+    """Band of `SIZE_EDGES` of every pipe size, the last band for unknown sizes."""
+    sizes = pd.to_numeric(pd.Series(sizes), errors='coerce').to_numpy(dtype='float64')
+    bands = np.digitize(sizes, SIZE_EDGES)
+    bands[np.isnan(sizes)] = N_SIZE_BANDS - 1
+    return bands.astype(np.int8)
+
+
+def material_categories(materials):
+    """Sorted materials of the inventory, with `UNKNOWN_MATERIAL` last."""
+    seen = pd.Series(materials).dropna().astype(str).unique()
+    return sorted(set(seen) - {UNKNOWN_MATERIAL}) + [UNKNOWN_MATERIAL]
+
+
+def material_codes(materials, categories):
+    """Codes of `materials` in `categories`; missing and unseen ones are unknown."""
+    codes = pd.Categorical(pd.Series(materials).astype(object), categories=categories).codes
+    codes = codes.astype(np.int16)
+    codes[codes < 0] = categories.index(UNKNOWN_MATERIAL)
+    return codes
+
+
+def lengths_km(mains):
+    """
+    Length of every main in km from its `Shape__Length` (metres), the median
+    length where it's missing. Without lengths every main counts as 1, i.e.
+    the exposure is in main-years rather than km-years.
+    """
+    if 'Shape__Length' not in mains:
+        return np.ones(mains.shape[0])
+    length = pd.to_numeric(mains['Shape__Length'], errors='coerce').astype('float64')
+    return (length.fillna(length.median()).fillna(1000.0) / 1000).to_numpy()
+
+
+class ExposurePanel:
+    """
+    Asset x year exposure of a main inventory, aggregated into cells.
+
+    A cell is a (material, size band, prior breaks, age) combination and
+    holds the km-years of exposure of every main-year that fell in it and
+    the breaks that happened there. This is all a Poisson rate model of
+    the asset-years needs, at a size that doesn't depend on the number of
+    mains or years.
+
+    Attributes
+    ----------
+    exposure : np.ndarray
+        (materials, size bands, prior breaks, age) km-years.
+    breaks : np.ndarray
+        Breaks, same shape.
+    materials : list
+        Material of every material code.
+    start_year, end_year : int
+        Years of exposure tabulated, both included.
+    n_mains, n_segments, n_breaks : int
+        Mains observed, history segments and breaks tabulated.
+    """
+
+    def __init__(self, exposure, breaks, materials, start_year, end_year,
+                 n_mains, n_segments, n_breaks):
+        self.exposure = exposure
+        self.breaks = breaks
+        self.materials = materials
+        self.start_year = start_year
+        self.end_year = end_year
+        self.n_mains = n_mains
+        self.n_segments = n_segments
+        self.n_breaks = n_breaks
+
+    def cells(self):
+        """The cells with some exposure as a long DataFrame, one row per cell."""
+        index = np.nonzero(self.exposure > 0)
+        return pd.DataFrame({
+            'material': index[0].astype(np.int16),
+            'size_band': index[1].astype(np.int8),
+            'prior_breaks': index[2].astype(np.int8),
+            'age': index[3].astype(np.int16),
+            'exposure': self.exposure[index],
+            'breaks': self.breaks[index],
+        })
+
+    @property
+    def nbytes(self):
+        return self.exposure.nbytes + self.breaks.nbytes
+
+
+def _ranks(first):
+    """Position of every element in its group, given the group starts (sorted data)."""
+    starts = np.flatnonzero(first)
+    sizes = np.diff(np.append(starts, len(first)))
+    return np.arange(len(first)) - np.repeat(starts, sizes)
+
+
+def exposure_panel(mains, breaks, start_year=None, end_year=None, history_start=None,
+                   materials=None):
+    """
+    Build the exposure panel of `mains` over `start_year`-`end_year`.
+
+    Nothing is looped over mains or years. The history of every main is cut
+    at its breaks into segments of constant prior break count (one more
+    segment than breaks), and each segment adds its length to a run of ages
+    through a difference array over the age axis, which a cumulative sum
+    turns into the exposure of every age. The memory used is that of the
+    mains and breaks columns plus the cells.
+
+    Parameters
+    ----------
+    mains : pd.DataFrame
+        WATMAINID, INSTALLATION_DATE, MATERIAL, PIPE_SIZE and optionally
+        Shape__Length. Mains without an installation date are left out.
+    breaks : pd.DataFrame
+        ASSETID (the WATMAINID of the main) and INCIDENT_DATE.
+    start_year, end_year : int, optional
+        Years of exposure, both included. By default the years of the
+        first and last recorded break.
+    history_start : int, optional
+        First year whose breaks count as prior breaks, by default
+        `start_year`. Set it earlier to tabulate a later window (e.g. a
+        holdout) with the breaks before it as history.
+    materials : list, optional
+        Material categories (e.g. those of a fitted model), by default
+        those of `mains`.
+
+    Returns
+    -------
+    panel : ExposurePanel
+    """
+    ids = mains['WATMAINID'].to_numpy()
+    index = pd.Index(ids)
+    if not index.is_unique:
+        raise ValueError('WATMAINID is not unique in the mains')
+    materials = materials or material_categories(mains['MATERIAL'])
+    material = material_codes(mains['MATERIAL'], materials)
+    size = size_bands(mains['PIPE_SIZE'])
+    length = lengths_km(mains)
+    installed = years(mains['INSTALLATION_DATE'])
+
+    break_row = index.get_indexer(breaks['ASSETID'].to_numpy())
+    break_year = years(breaks['INCIDENT_DATE'])
+    if start_year is None:
+        start_year = int(np.nanmin(break_year))
+    if end_year is None:
+        end_year = int(np.nanmax(break_year))
+    history_start = start_year if history_start is None else min(history_start, start_year)
+
+    entry = np.maximum(installed, start_year)
+    observed = ~np.isnan(installed) & (entry <= end_year)
+
+    # breaks of observed mains within their history, sorted by main then year
+    keep = (break_row >= 0) & (break_year >= history_start) & (break_year <= end_year)
+    row, year = break_row[keep], break_year[keep]
+    keep = observed[row] & (year >= installed[row])
+    row, year = row[keep], year[keep].astype(np.int64)
+    order = np.lexsort((year, row))
+    row, year = row[order], year[order]
+
+    n = len(row)
+    new_main = np.ones(n, dtype=bool)
+    new_main[1:] = row[1:] != row[:-1]
+    last_of_main = np.ones(n, dtype=bool)
+    last_of_main[:-1] = new_main[1:]
+    rank = _ranks(new_main)
+    # breaks of the same main in the same year all count the breaks before
+    # that year as their prior breaks
+    new_year = new_main.copy()
+    new_year[1:] |= year[1:] != year[:-1]
+    prior = rank[np.maximum.accumulate(np.where(new_year, np.arange(n), 0))] if n else rank
+
+    # segments: from entry to the first break, then from the year after each
+    # break to the next break (or the end of the window)
+    first_break = np.full(len(ids), end_year, dtype=np.int64)
+    first_break[row[new_main]] = year[new_main]
+    next_year = np.append(year[1:], end_year)
+    obs_rows = np.flatnonzero(observed)
+    seg_row = np.concatenate([obs_rows, row])
+    seg_start = np.concatenate([entry[obs_rows].astype(np.int64), year + 1])
+    seg_end = np.concatenate([first_break[obs_rows],
+                              np.where(last_of_main, end_year, next_year)])
+    seg_prior = np.concatenate([np.zeros(len(obs_rows), dtype=np.int64), rank + 1])
+
+    # only the years of the window are exposure; the history before it only
+    # counts the prior breaks
+    seg_start = np.maximum(seg_start, start_year)
+    valid = seg_start <= seg_end
+    seg_row, seg_start, seg_end, seg_prior = (
+        seg_row[valid], seg_start[valid], seg_end[valid], seg_prior[valid])
+
+    age_start = seg_start - installed[seg_row].astype(np.int64)
+    age_end = np.minimum(seg_end - installed[seg_row].astype(np.int64), MAX_AGE)
+    valid = age_start <= age_end
+    seg_row, age_start, age_end, seg_prior = (
+        seg_row[valid], age_start[valid], age_end[valid], seg_prior[valid])
+
+    shape = (len(materials), N_SIZE_BANDS, MAX_PRIOR_BREAKS + 1, MAX_AGE + 2)
+    m, s = material[seg_row], size[seg_row]
+    p = np.minimum(seg_prior, MAX_PRIOR_BREAKS)
+    size_total = int(np.prod(shape))
+    diff = (np.bincount(np.ravel_multi_index((m, s, p, age_start), shape),
+                        weights=length[seg_row], minlength=size_total)
+            - np.bincount(np.ravel_multi_index((m, s, p, age_end + 1), shape),
+                          weights=length[seg_row], minlength=size_total))
+    exposure = np.cumsum(diff.reshape(shape), axis=-1)[..., :MAX_AGE + 1]
+    # the cumulative sum leaves rounding residue where the exposure ended
+    exposure[exposure < 1e-9] = 0.0
+
+    # breaks of the window, in the cell of the main-year they happened in
+    in_window = year >= start_year
+    age = year[in_window] - installed[row[in_window]].astype(np.int64)
+    tabulated = age <= MAX_AGE
+    event_row = row[in_window][tabulated]
+    event_cells = np.ravel_multi_index(
+        (material[event_row], size[event_row],
+         np.minimum(prior[in_window][tabulated], MAX_PRIOR_BREAKS), age[tabulated]),
+        shape[:-1] + (MAX_AGE + 1,))
+    counts = np.bincount(event_cells, minlength=int(np.prod(shape[:-1])) * (MAX_AGE + 1))
+
+    return ExposurePanel(exposure, counts.reshape(exposure.shape).astype(np.int32),
+                         materials, int(start_year), int(end_year),
+                         n_mains=int(observed.sum()), n_segments=int(len(seg_row)),
+                         n_breaks=int(len(event_cells)))
+
+
+def main_covariates(mains, break_counts, as_of_year, materials):
+    """
+    Covariates of every main at the start of `as_of_year`: material code,
+    size band, prior breaks (capped) and age (NaN without an installation
+    date), with the length in km.
+
+    `break_counts` gives the recorded breaks of each main, indexed by
+    WATMAINID (the ASSETID of the breaks).
+    """
+    counts = mains['WATMAINID'].map(break_counts).fillna(0).to_numpy(dtype=np.int64)
+    return {
+        'material': material_codes(mains['MATERIAL'], materials),
+        'size_band': size_bands(mains['PIPE_SIZE']),
+        'prior_breaks': np.minimum(counts, MAX_PRIOR_BREAKS),
+        'age': as_of_year - years(mains['INSTALLATION_DATE']),
+        'length_km': lengths_km(mains),
+        'num_breaks': counts,
+    }
@@ -0,0 +1,241 @@
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+
+import src.data.schema as schema_module
+import src.data.storage as storage_module
+from src.data.storage import find_table, write_table
+import src.features.process_data as process_data_module
+
+# Bump when the meaning of the features changes in a way the source hash
+# below wouldn't catch (e.g. a change in one of the libraries it relies on)
+PIPELINE_VERSION = 1
+
+# Modules whose source decides the content of the model data: the feature
+# code, and the dtypes and storage of the tables it reads
+PIPELINE_MODULES = [process_data_module, schema_module, storage_module]
+
+CACHE_DIR = 'data/cache/features'
+# Key of the entry the processed model_data table and encodings.json were last
+# written from, with their modification times
+PROCESSED_MARKER = 'processed.json'
+# Parquet metadata key of the category encodings stored with each entry
+ENCODINGS_KEY = b'water_main.encodings'
+# Default upper bound on the total size of the cached matrices
+MAX_CACHE_BYTES = 512 * 1024 ** 2
+
+
+def fingerprint_file(path, block_size=1024 ** 2):
+    '''SHA-256 of the content of `path`.'''
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def fingerprint_sqlite_table(table_name, db_name='water_data.db'):
+    '''
+    Cheap fingerprint of a SQLite table: its sync high-water marks when the
+    table is kept up to date by `sync_layer`, plus its row count and largest
+    rowid. Avoids hashing the whole table on every run.
+    '''
+    conn = sqlite3.connect(db_name)
+    try:
+        parts = list(conn.execute(f'SELECT COUNT(*), MAX(rowid) FROM {table_name}').fetchone())
+        has_state = conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' "
+                                 "AND name = 'sync_state'").fetchone()
+        if has_state:
+            parts += list(conn.execute('SELECT max_objectid, max_edit_date, synced_at '
+                                       'FROM sync_state WHERE table_name = ?',
+                                       (table_name,)).fetchone() or [])
+    finally:
+        conn.close()
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+
+def pipeline_fingerprint():
+    '''Hash of the pipeline version and the source of `PIPELINE_MODULES`.'''
+    digest = hashlib.sha256(str(PIPELINE_VERSION).encode())
+    for module in PIPELINE_MODULES:
+        digest.update(fingerprint_file(module.__file__).encode())
+    return digest.hexdigest()
+
+
+def cache_key(input_fingerprints):
+    '''Cache key for the given input fingerprints and the current pipeline.'''
+    digest = hashlib.sha256(pipeline_fingerprint().encode())
+    for fingerprint in input_fingerprints:
+        digest.update(fingerprint.encode())
+    return digest.hexdigest()[:32]
+
+
+def _entry_path(key, cache_dir=CACHE_DIR):
+    return os.path.join(cache_dir, f'{key}.parquet')
+
+
+def _write_entry(path, model_data, encodings):
+    '''Store the model data with its category encodings in its schema metadata.'''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = pa.Table.from_pandas(model_data, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[ENCODINGS_KEY] = json.dumps(encodings).encode()
+    pq.write_table(table.replace_schema_metadata(metadata), path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
+def _read_entry(path):
+    '''Model data and encodings of an entry; the encodings are None for an older entry.'''
+    import pyarrow.parquet as pq
+
+    table = pq.read_table(path)
+    encodings = (table.schema.metadata or {}).get(ENCODINGS_KEY)
+    return table.to_pandas(), json.loads(encodings) if encodings is not None else None
+
+
+def _processed_state(key):
+    '''Entry `key` with the modification times of the processed files.'''
+    paths = [find_table('model_data', 'processed'), process_data_module.ENCODINGS_PATH]
+    return {'key': key,
+            'mtimes': [os.stat(p).st_mtime_ns if os.path.exists(p) else None for p in paths]}
+
+
+def _mark_processed(key, cache_dir=CACHE_DIR):
+    with open(os.path.join(cache_dir, PROCESSED_MARKER), 'w') as f:
+        json.dump(_processed_state(key), f)
+
+
+def _is_processed(key, cache_dir=CACHE_DIR):
+    '''Whether the processed files are still the ones written for entry `key`.'''
+    try:
+        with open(os.path.join(cache_dir, PROCESSED_MARKER)) as f:
+            return json.load(f) == _processed_state(key)
+    except (FileNotFoundError, ValueError):
+        return False
+
+
+def _entries(cache_dir=CACHE_DIR):
+    '''Cached matrices as (path, size, last use), least recently used first.'''
+    if not os.path.isdir(cache_dir):
+        return []
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith('.parquet'):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((path, stat.st_size, stat.st_mtime))
+    return sorted(entries, key=lambda entry: entry[2])
+
+
+def evict(max_bytes=MAX_CACHE_BYTES, cache_dir=CACHE_DIR, keep=None):
+    '''
+    Delete the least recently used matrices until the cache fits in
+    `max_bytes`. The entry at `keep` is never deleted.
+    '''
+    entries = _entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    removed = []
+    for path, size, _ in entries:
+        if total <= max_bytes:
+            break
+        if path == keep:
+            continue
+        os.remove(path)
+        total -= size
+        removed.append(path)
+    return removed
+
+
+def invalidate(key=None, cache_dir=CACHE_DIR):
+    '''Delete the cached matrix `key`, or every cached matrix.'''
+    if key is not None:
+        paths = [_entry_path(key, cache_dir)]
+    else:
+        paths = [path for path, _, _ in _entries(cache_dir)]
+    removed = []
+    for path in paths:
+        if os.path.exists(path):
+            os.remove(path)
+            removed.append(path)
+    return removed
+
+
+def load_features(input_fingerprints=None, max_bytes=MAX_CACHE_BYTES,
+                  cache_dir=CACHE_DIR, refresh=False):
+    '''
+    Return the model data, building it with `process_data` only when the
+    raw break table or the pipeline changed since it was last built.
+
+    The cache key hashes the content of the raw table together with the
+    pipeline version and source, so a stale matrix is never returned. Each
+    entry keeps the category encodings of its matrix, and on a cache hit
+    the processed `model_data` table and `encodings.json` are restored
+    from it when they were since deleted or overwritten, so the scoring
+    code always encodes the mains like the returned matrix.
+
+    Parameters
+    ----------
+    input_fingerprints : list, optional
+        Fingerprints of the inputs, e.g. `fingerprint_sqlite_table('breaks')`
+        when the raw table is rebuilt from `water_data.db`. By default the
+        content of the raw break table file is hashed.
+    max_bytes : int
+        Size bound of the cache; least recently used matrices are evicted
+        after a new one is stored.
+    cache_dir : string
+        Directory holding the cached matrices.
+    refresh : bool
+        Rebuild the matrix even if it is cached.
+
+    Returns
+    -------
+    model_data : pd.DataFrame
+    '''
+    if input_fingerprints is None:
+        input_fingerprints = [fingerprint_file(find_table('Water_Main_Breaks', 'raw'))]
+    key = cache_key(input_fingerprints)
+    path = _entry_path(key, cache_dir)
+
+    if os.path.exists(path) and not refresh:
+        model_data, encodings = _read_entry(path)
+        # an entry without encodings predates them and is rebuilt
+        if encodings is not None:
+            # touching the entry makes it the most recently used one
+            os.utime(path)
+            if not _is_processed(key, cache_dir):
+                write_table(model_data, 'model_data', 'processed', csv=True)
+                process_data_module.save_encodings(encodings)
+                _mark_processed(key, cache_dir)
+            return model_data
+
+    model_data = process_data_module.process_data()
+    os.makedirs(cache_dir, exist_ok=True)
+    _write_entry(path, model_data, process_data_module.load_encodings())
+    _mark_processed(key, cache_dir)
+    evict(max_bytes, cache_dir, keep=path)
+    return model_data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the feature cache.')
+    parser.add_argument('command', choices=['info', 'invalidate'])
+    parser.add_argument('--key', help='only invalidate this entry')
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+
+    if args.command == 'invalidate':
+        removed = invalidate(args.key, args.cache_dir)
+        print(f'Removed {len(removed)} cached feature matrices')
+    else:
+        entries = _entries(args.cache_dir)
+        for path, size, _ in entries:
+            print(f'{os.path.basename(path)[:-len(".parquet")]}  {size / 1024:10.1f} KB')
+        print(f'{len(entries)} entries, {sum(size for _, size, _ in entries) / 1024 ** 2:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
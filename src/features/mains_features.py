@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+
+from src.features.process_data import FEATURE_COLS, BINARY_COLS, encode_cat_cols, fill_nulls
+
+# The model is trained on break incidents, so a main that is scored as a
+# whole gets the values of a typical incident for the break-specific
+# features (the most common value of each in the break data)
+INCIDENT_DEFAULTS = {
+    'break_type': 'MAIN',
+    'break_nature': 'UNKNOWN',
+    'break_apparent_cause': 'OTHER',
+    'break_categorization': 'CATEGORY 1',
+}
+
+
+def break_stats_query(mains_table='mains', breaks_table='breaks'):
+    """
+    Query joining every main with the aggregates of its breaks. The breaks
+    are aggregated per asset first (using the ASSETID index), so the join
+    produces exactly one row per main.
+    """
+    return f"""
+    SELECT m.OBJECTID, m.WATMAINID, m.ROADSEGMENTID, m.PIPE_SIZE, m.MATERIAL,
+           m.INSTALLATION_DATE,
+           COALESCE(b.num_breaks, 0) AS num_breaks,
+           b.last_break_date
+    FROM {mains_table} AS m
+    LEFT JOIN (
+        SELECT ASSETID, COUNT(*) AS num_breaks, MAX(INCIDENT_DATE) AS last_break_date
+        FROM {breaks_table}
+        GROUP BY ASSETID
+    ) AS b
+    ON b.ASSETID = m.WATMAINID
+    """
+
+
+def iter_mains_with_breaks(conn, chunk_rows=5000, mains_table='mains', breaks_table='breaks'):
+    """Stream `break_stats_query` `chunk_rows` mains at a time."""
+    yield from pd.read_sql(break_stats_query(mains_table, breaks_table), conn,
+                           chunksize=chunk_rows)
+
+
+def mains_features(mains, encodings, break_counts=None, as_of=None):
+    """
+    Model features for every main of `mains`.
+
+    Parameters
+    ----------
+    mains : pd.DataFrame
+        Rows of the mains table, with at least WATMAINID, PIPE_SIZE,
+        MATERIAL and INSTALLATION_DATE.
+    encodings : dict
+        Categories of the encoded columns, as saved by `process_data`.
+    break_counts : pd.Series, optional
+        Number of recorded breaks indexed by asset id (ASSETID in the break
+        data, which is the WATMAINID of the main). By default the breaks are
+        taken from the `num_breaks` column of `mains`, as returned by
+        `break_stats_query`.
+    as_of : datetime-like, optional
+        Date the age of the mains is computed at, by default today.
+
+    Returns
+    -------
+    features : pd.DataFrame
+        `FEATURE_COLS`, one row per main, in the order of `mains`. The age
+        is NaN for the mains without an installation date.
+    """
+    as_of = pd.Timestamp.today() if as_of is None else pd.Timestamp(as_of)
+    n = mains.shape[0]
+
+    features = pd.DataFrame({col: np.repeat(value, n) for col, value in INCIDENT_DEFAULTS.items()},
+                            index=mains.index)
+    features['asset_size'] = pd.to_numeric(mains['PIPE_SIZE'], errors='coerce').astype('float32')
+    features['asset_material'] = mains['MATERIAL']
+    fill_nulls(features, 'asset_material', 'UNKNOWN')
+    if break_counts is None:
+        num_breaks = mains['num_breaks']
+    else:
+        num_breaks = mains['WATMAINID'].map(break_counts)
+    features['num_breaks'] = num_breaks.fillna(0).astype('int32')
+
+    installed = pd.to_datetime(mains['INSTALLATION_DATE'], errors='coerce')
+    if installed.dt.tz is not None:
+        installed = installed.dt.tz_convert(None)
+    features['age_at_break'] = np.floor((as_of - installed).dt.days / 365.25)
+
+    # the flags are 'Y' for almost every incident and every main still exists
+    for col in BINARY_COLS:
+        features[col] = np.int8(1)
+
+    encode_cat_cols(features, encodings=encodings)
+    return features[FEATURE_COLS]
@@ -0,0 +1,251 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from src.data.database import connect, create_table, insert_rows
+from src.data.schema import to_flag
+from src.data.storage import DATA_DIR, iter_table
+
+CELLS_DB = os.path.join(DATA_DIR, 'processed', 'map_cells.db')
+CELLS_TABLE = 'cells'
+
+# Circumradius of the hexagons, in Web Mercator metres, at every map zoom
+# level the app can request. Each level is about a quarter of the previous
+# one, so a cell stays a similar number of pixels on screen.
+ZOOM_RADIUS = {
+    8: 2400,
+    10: 600,
+    12: 150,
+    14: 40,
+}
+
+EARTH_RADIUS = 6378137.0
+
+# Layers binned by `build_cells`: source table, coordinate columns, the
+# value aggregated in every cell and the slices precomputed besides 'all'
+LAYERS = {
+    'breaks': {
+        'table': 'cleaned_break_data',
+        'lon': 'LONGITUDE',
+        'lat': 'LATITUDE',
+        'value': None,
+        'slices': {'year': 'year'},
+    },
+    'predictions': {
+        'table': 'test_predict_data',
+        'lon': 'longitude',
+        'lat': 'latitude',
+        'value': 'predictions',
+        'slices': {'age': 'age_at_break'},
+    },
+}
+
+
+def to_mercator(lon, lat):
+    '''Project longitudes/latitudes (degrees) to Web Mercator metres.'''
+    x = EARTH_RADIUS * np.radians(lon)
+    y = EARTH_RADIUS * np.log(np.tan(np.pi / 4 + np.radians(lat) / 2))
+    return x, y
+
+
+def to_lonlat(x, y):
+    '''Inverse of `to_mercator`.'''
+    lon = np.degrees(x / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(y / EARTH_RADIUS)) - np.pi / 2)
+    return lon, lat
+
+
+def hex_cells(x, y, radius):
+    '''
+    Axial coordinates `(q, r)` of the pointy-top hexagon of circumradius
+    `radius` containing each point, rounded in cube coordinates so every
+    point falls into exactly one cell.
+    '''
+    q = (np.sqrt(3) / 3 * x - y / 3) / radius
+    r = (2 / 3 * y) / radius
+    s = -q - r
+
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def hex_centers(q, r, radius):
+    '''Web Mercator centre of the hexagons with axial coordinates `(q, r)`.'''
+    x = radius * np.sqrt(3) * (q + r / 2)
+    y = radius * 1.5 * r
+    return x, y
+
+
+def bin_points(lon, lat, values=None, slices=None, zoom_radius=ZOOM_RADIUS):
+    '''
+    Count the points (and sum `values`) per hexagon at every zoom level,
+    over all the points and per value of every slice.
+
+    Parameters
+    ----------
+    lon, lat : array-like
+        Point coordinates in degrees.
+    values : array-like, optional
+        Value summed in every cell, e.g. the predictions.
+    slices : dict, optional
+        Slice name -> array-like of the slice value of every point, e.g.
+        `{'year': years}`.
+    zoom_radius : dict
+        Zoom level -> hexagon radius.
+
+    Returns
+    -------
+    cells : pd.DataFrame
+        zoom, slice, slice_value, q, r, count and value_sum, one row per
+        non-empty cell.
+    '''
+    lon = np.asarray(lon, dtype=np.float64)
+    lat = np.asarray(lat, dtype=np.float64)
+    values = np.ones_like(lon) if values is None else np.asarray(values, dtype=np.float64)
+    x, y = to_mercator(lon, lat)
+
+    parts = []
+    for zoom, radius in zoom_radius.items():
+        q, r = hex_cells(x, y, radius)
+        points = pd.DataFrame({'q': q, 'r': r, 'value': values})
+        keys = {'all': np.zeros(len(lon), dtype=np.int64)}
+        keys.update({name: np.asarray(col) for name, col in (slices or {}).items()})
+        for name, slice_values in keys.items():
+            points['slice_value'] = slice_values
+            cells = (points.groupby(['slice_value', 'q', 'r'], sort=False)['value']
+                     .agg(['size', 'sum'])
+                     .rename(columns={'size': 'count', 'sum': 'value_sum'})
+                     .reset_index())
+            cells.insert(0, 'slice', name)
+            cells.insert(0, 'zoom', zoom)
+            parts.append(cells)
+
+    columns = ['zoom', 'slice', 'slice_value', 'q', 'r', 'count', 'value_sum']
+    if not parts:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(parts, ignore_index=True)[columns]
+
+
+def _layer_points(layer, batch):
+    '''Coordinates, values and slices of the valid points of one batch.'''
+    spec = LAYERS[layer]
+    if layer == 'breaks':
+        # same rows as the app: mains that still exist, with a location
+        batch = batch[to_flag(batch['ASSET_EXISTS']).fillna(False).to_numpy(dtype=bool)]
+        batch = batch.assign(year=pd.to_datetime(batch['INCIDENT_DATE'], utc=True).dt.year)
+    batch = batch.dropna(subset=[spec['lon'], spec['lat']] + list(spec['slices'].values()))
+
+    values = batch[spec['value']].values if spec['value'] else None
+    slices = {name: batch[col].values for name, col in spec['slices'].items()}
+    return batch[spec['lon']].values, batch[spec['lat']].values, values, slices
+
+
+def layer_cells(layer, batch_rows=50_000, zoom_radius=ZOOM_RADIUS):
+    '''
+    Bin the whole source table of `layer` one batch at a time. Only the
+    partial per-cell sums are kept between batches, so memory grows with
+    the number of cells, not the number of points.
+    '''
+    spec = LAYERS[layer]
+    columns = [spec['lon'], spec['lat']] + list(spec['slices'].values())
+    if spec['value']:
+        columns.append(spec['value'])
+    if layer == 'breaks':
+        columns = [spec['lon'], spec['lat'], 'INCIDENT_DATE', 'ASSET_EXISTS']
+
+    keys = ['zoom', 'slice', 'slice_value', 'q', 'r']
+    totals = None
+    for batch in iter_table(spec['table'], 'processed', columns=columns, batch_rows=batch_rows):
+        cells = bin_points(*_layer_points(layer, batch), zoom_radius=zoom_radius)
+        totals = cells if totals is None else pd.concat([totals, cells], ignore_index=True)
+        totals = totals.groupby(keys, sort=False, as_index=False)[['count', 'value_sum']].sum()
+
+    if totals is None:
+        totals = bin_points([], [], zoom_radius=zoom_radius)
+    lon, lat = to_lonlat(*hex_centers(totals['q'].values, totals['r'].values,
+                                      totals['zoom'].map(zoom_radius).values))
+    totals['longitude'] = lon
+    totals['latitude'] = lat
+    totals['value_mean'] = totals['value_sum'] / totals['count']
+    totals.insert(0, 'layer', layer)
+    return totals
+
+
+def _table_exists(conn, table_name):
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+                        (table_name,)).fetchone() is not None
+
+
+def build_cells(layers=None, db_path=CELLS_DB, batch_rows=50_000, zoom_radius=ZOOM_RADIUS):
+    '''
+    Precompute the cells of every layer and (re)write them to `db_path`,
+    indexed on (layer, zoom, slice, slice_value) so a page reads exactly the
+    cells it draws. Returns the number of cells written per layer.
+    '''
+    written = {}
+    conn = connect(db_path)
+    try:
+        for layer in layers or LAYERS:
+            cells = layer_cells(layer, batch_rows, zoom_radius)
+            cells['slice_value'] = cells['slice_value'].astype(np.int64)
+            with conn:
+                if _table_exists(conn, CELLS_TABLE):
+                    conn.execute(f'DELETE FROM {CELLS_TABLE} WHERE layer = ?', (layer,))
+                else:
+                    create_table(conn, cells, CELLS_TABLE)
+                insert_rows(conn, cells, CELLS_TABLE)
+            written[layer] = cells.shape[0]
+        with conn:
+            conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{CELLS_TABLE}_lookup '
+                         f'ON {CELLS_TABLE} (layer, zoom, slice, slice_value)')
+            conn.execute('ANALYZE')
+    finally:
+        conn.close()
+    return written
+
+
+def nearest_zoom(zoom, zoom_radius=ZOOM_RADIUS):
+    '''Precomputed zoom level closest to the requested map zoom.'''
+    return min(zoom_radius, key=lambda level: abs(level - zoom))
+
+
+def read_cells(layer, zoom=10, slice='all', slice_value=None, db_path=CELLS_DB):
+    '''
+    Cells of `layer` at the precomputed zoom level closest to `zoom`, for one
+    slice. With `slice_value=None` every value of the slice is returned,
+    ordered by it (e.g. all the ages, for an animation).
+    '''
+    query = (f'SELECT slice_value, longitude, latitude, count, value_sum, value_mean '
+             f'FROM {CELLS_TABLE} WHERE layer = ? AND zoom = ? AND slice = ?')
+    params = [layer, nearest_zoom(zoom), slice]
+    if slice_value is not None:
+        query += ' AND slice_value = ?'
+        params.append(int(slice_value))
+    query += ' ORDER BY slice_value'
+
+    conn = connect(db_path)
+    try:
+        return pd.read_sql(query, conn, params=params)
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Precompute the hexagon cells of the map pages.')
+    parser.add_argument('--layers', nargs='*', choices=list(LAYERS), default=None)
+    parser.add_argument('--db', default=CELLS_DB)
+    args = parser.parse_args()
+
+    for layer, n_cells in build_cells(args.layers, args.db).items():
+        print(f'{layer}: {n_cells} cells')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,88 +1,211 @@
-import pandas as pd
-import numpy as np
-<<<<<<< Updated upstream
-import data.extract_data as extract_data
-from data.extract_data import extract_data
-=======
+import json
 import os
-import src
 
-from src.data.fetch_data import extract_data
->>>>>>> Stashed changes
+import pandas as pd
+import numpy as np
 
+from src.data.schema import apply_schema
+from src.data.storage import read_table, write_table
+from src.instrumentation import stage
+
+# columns to keep from the raw break data (the raw export stores the point
+# coordinates as X/Y)
+RAW_COLUMNS = ['X', 'Y', 'OBJECTID', 'WATBREAKINCIDENTID', 'INCIDENT_DATE',
+               'BREAK_TYPE', 'BREAK_NATURE', 'BREAK_APPARENT_CAUSE', 'POSITIVE_PRESSURE_MAINTANED',
+               'AIR_GAP_MAINTANED', 'MECHANICAL_REMOVAL', 'FLUSHING_EXCAVATION', 'HIGHER_VELOCITY_FLUSHING',
+               'ANODE_INSTALLED', 'BREAK_CATEGORIZATION', 'ROADSEGMENTID', 'STREET', 'ASSETID',
+               'ASSET_SIZE', 'ASSET_YEAR_INSTALLED', 'ASSET_MATERIAL', 'ASSET_EXISTS']
+
+BINARY_COLS = ['positive_pressure_maintaned', 'air_gap_maintaned', 'mechanical_removal',
+               'flushing_excavation', 'higher_velocity_flushing', 'anode_installed', 'asset_exists']
+
+CAT_COLS = ['break_type', 'break_nature', 'break_apparent_cause', 'break_categorization',
+            'asset_material']
+
+# features the model is trained on, in order, followed by the target
+FEATURE_COLS = ['break_type', 'break_nature', 'break_apparent_cause', 'break_categorization',
+                'asset_size', 'asset_material', 'num_breaks', 'age_at_break'] + BINARY_COLS
+TARGET_COL = 'failure_rate'
+
+# grouping of the break natures/causes used in the feature engineering notebook
+REPLACEMENTS = {
+    'break_nature': {'OTHER': 'UNKNOWN',
+                     'OTHER: WATER SERVICE': 'WATER SERVICE',
+                     'CIRCUMFERENTIAL AND FITTING/JOINT': 'CIRCUMFERENTIAL',
+                     'CORROSION AND CIRCUMFERENTIAL': 'CORROSION',
+                     'CORROSION AND LONGITUDINAL': 'CORROSION',
+                     'CORROSION AND FITTING/JOINT': 'CORROSION',
+                     'CORROSION - ROBAR SADDLE CORRODED AT SEAM': 'CORROSION',
+                     'FITTING/JOINT AND LONGITUDINAL': 'FITTING/JOINT'},
+    'break_apparent_cause': {'UNKNOWN': 'OTHER'},
+}
+
+ENCODINGS_PATH = 'data/processed/encodings.json'
 
-# Load the data
-df = pd.read_csv('../data/raw/Nov_10_22_Water_Main_Breaks.csv')
 
-# colummns to keep
-df = df[['LONGITUDE', 'LATITUDE', 'OBJECTID', 'WATBREAKINCIDENTID', 'INCIDENT_DATE',
-        'BREAK_TYPE', 'BREAK_NATURE', 'BREAK_APPARENT_CAUSE', 'POSITIVE_PRESSURE_MAINTANED', 
-        'AIR_GAP_MAINTANED', 'MECHANICAL_REMOVAL', 'FLUSHING_EXCAVATION', 'HIGHER_VELOCITY_FLUSHING', 
-        'ANODE_INSTALLED', 'BREAK_CATEGORIZATION', 'ROADSEGMENTID', 'STREET', 'ASSETID', 
-        'ASSET_SIZE', 'ASSET_YEAR_INSTALLED', 'ASSET_MATERIAL', 'ASSET_EXISTS']]
+def fill_nulls(df, cols, value):
+    """Fill null values of the specified columns with a specified value, in place."""
+    for col in np.atleast_1d(cols):
+        if isinstance(df[col].dtype, pd.CategoricalDtype) and value not in df[col].cat.categories:
+            df[col] = df[col].cat.add_categories([value])
+        df[col] = df[col].fillna(value)
+    return df
 
-# lowercase the cols
-df.columns = df.columns.str.lower()
 
-# convert INCIDENT_DATE to datetime
-df['INCIDENT_DATE'] = pd.to_datetime(df['INCIDENT_DATE']).dt.date
-df['ASSET_YEAR_INSTALLED'] = pd.to_datetime(df['ASSET_YEAR_INSTALLED'], format='%Y')
+def replace_values(df, col, mapping):
+    """Replace values in a column following `mapping`, in place."""
+    if isinstance(df[col].dtype, pd.CategoricalDtype):
+        # only the categories are mapped, then merged where they now coincide
+        df[col] = df[col].map(lambda value: mapping.get(value, value)).astype('category')
+    else:
+        df[col] = df[col].replace(mapping)
+    return df
 
 
-def fill_nulls(df, cols, value):
-    """Fill null values of a specified column with a specified value."""
-    df[cols] = df[cols].fillna(value, inplace=True)
+def num_breaks(df, asset_col='assetid', out_col='num_breaks'):
+    """Count the breaks of each asset and broadcast the count to every row of that asset"""
+    counts = df.groupby(asset_col, sort=False)[asset_col].transform('size')
+    # a break without an asset id is the only known break of its (unknown) asset
+    df[out_col] = counts.fillna(1).astype('int32')
     return df
 
-# fill nulls
-df_copy = df.copy()
-df_copy = fill_nulls(df_copy, ['BREAK_APPARENT_CAUSE', 'BREAK_NATURE', 'BREAK_CATEGORIZATION', 'STREET'], 'UNKNOWN')
-df_copy = fill_nulls(df_copy, 'ASSET_SIZE', df_copy['ASSET_SIZE'].mode()[0])
-
 
-def replace_values(df, col, original_value, new_value):
-    """Replace a value in a column with a specified value."""
-    df[col] = df[col].replace(original_value, new_value)
+def calc_age(df, date_col='incident_date', year_col='asset_year_installed', out_col='age'):
+    """
+    Age of the asset in whole years (365.25 days) at `date_col`, counting from
+    the 1st of January of the installation year. Rows without a date or an
+    installation year get NaN.
+    """
+    dates = df[date_col]
+    if not pd.api.types.is_datetime64_any_dtype(dates):
+        dates = pd.to_datetime(dates)
+    if dates.dt.tz is not None:
+        dates = dates.dt.tz_convert(None)
+    dates = dates.to_numpy(dtype='datetime64[D]')
+
+    years = pd.to_numeric(df[year_col], errors='coerce').to_numpy(dtype='float64')
+    valid = ~np.isnan(years) & ~np.isnat(dates)
+    installed = np.full(len(df), np.datetime64('NaT'), dtype='datetime64[D]')
+    installed[valid] = (years[valid].astype(np.int64) - 1970).astype('datetime64[Y]')
+
+    days = (dates - installed).astype('float64')
+    days[~valid] = np.nan
+    df[out_col] = np.floor(days / 365.25)
     return df
 
-df_copy = replace_values(df_copy, 'BREAK_NATURE', 'OTHER', 'UNKNOWN')
-df_copy = replace_values(df_copy, 'BREAK_NATURE', 'OTHER: WATER SERVICE', 'WATER SERVICE')
 
-def num_breaks(df):
-    """Calculate and return the number of breaks per year for each asset"""
-    num_breaks = {}
-    
-    for pipe in df_copy['assetid']:
-        if pipe in num_breaks:
-            num_breaks[pipe] += 1
+def encode_binary_cols(df, cols=BINARY_COLS):
+    """Replace Y/N flags with 1/0, in place."""
+    for col in cols:
+        if pd.api.types.is_bool_dtype(df[col]):
+            df[col] = df[col].fillna(False).astype('int8')
         else:
-            num_breaks[pipe] = 1
-    
-    df_copy['num_breaks'] = df_copy['assertid'].map(num_breaks)
+            df[col] = df[col].eq('Y').astype('int8')
     return df
 
-df_copy = num_breaks(df_copy)
 
-def calc_age(df):
-    """Calculate and return the age of each asset"""
-    df_copy['age'] = (np.floor((pd.to_datetime(df_copy['incident_date']) - 
-                        pd.to_datetime(df_copy['asset_year_installed'])).dt.days / 365.25)).astype(int)
-    return df
-
-df_copy = calc_age(df_copy)
-
-def process_cat_cols(df):
-    binary_cols = ['positive_pressure_maintaned', 'air_gap_maintaned', 'mechanical_removal', 
-                    'flushing_excavation', 'higher_velocity_flushing', 'anode_installed', 'asset_exists']
-    
-    df = pd.get_dummies(df, columns=binary_cols, drop_first=True)
-
-    # fix the names of the columns modified
-    df = df.rename(columns={'positive_pressure_maintaned_Y': 'positive_pressure_maintaned',
-                            'air_gap_maintaned_Y': 'air_gap_maintaned',
-                            'mechanical_removal_Y': 'mechanical_removal',
-                            'flushing_excavation_Y': 'flushing_excavation',
-                            'higher_velocity_flushing_Y': 'higher_velocity_flushing',
-                            'anode_installed_Y': 'anode_installed',
-                            'asset_exists_Y': 'asset_exists'})
-    return df
\ No newline at end of file
+def encode_cat_cols(df, cols=CAT_COLS, encodings=None):
+    """
+    Replace categorical columns with their integer codes, in place. The codes
+    follow the sorted categories (like `astype('category').cat.codes`) unless
+    `encodings` gives the categories of each column, e.g. the ones saved when
+    the model data was built, in which case unseen values get -1.
+    """
+    encodings = {} if encodings is None else encodings
+    used = {}
+    for col in cols:
+        source = df[col]
+        if isinstance(source.dtype, pd.CategoricalDtype) and col not in encodings:
+            # the same codes as plain text: the categories present, sorted
+            source = source.cat.remove_unused_categories()
+            source = source.cat.reorder_categories(sorted(source.cat.categories))
+        if col in encodings:
+            values = pd.Categorical(source, categories=encodings[col])
+        else:
+            values = pd.Categorical(source)
+        used[col] = [str(c) for c in values.categories]
+        df[col] = values.codes
+    return df, used
+
+
+def load_encodings(path=ENCODINGS_PATH):
+    """Categories of each encoded column, as saved by `process_data`."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_encodings(encodings, path=ENCODINGS_PATH):
+    """Save the categories of each encoded column for `load_encodings`."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(encodings, f, indent=2)
+
+
+def process_data(df=None, write=True):
+    """
+    Build the model data from the raw break data in one pass.
+
+    Every step assigns its columns on the same frame, so the only copy made
+    is the final selection of the kept rows and the model columns.
+
+    Parameters
+    ----------
+    df : pd.DataFrame, optional
+        Raw break data with the columns of `RAW_COLUMNS`; it is modified in
+        place. By default it's read from the raw `Water_Main_Breaks` table.
+    write : bool
+        Save the result as the processed `model_data` table (and CSV) and
+        the category encodings next to it.
+
+    Returns
+    -------
+    model_data : pd.DataFrame
+        `FEATURE_COLS` and the `failure_rate` target.
+    """
+    with stage('features.process_data') as run:
+        with stage('features.read'):
+            if df is None:
+                df = read_table('Water_Main_Breaks', 'raw', columns=RAW_COLUMNS,
+                                parse_dates=['INCIDENT_DATE'])
+            # compact dtypes (a no-op for the table read above)
+            apply_schema(df)
+            df.columns = [{'X': 'longitude', 'Y': 'latitude'}.get(col, col.lower())
+                          for col in df.columns]
+        run.rows_in = df.shape[0]
+
+        with stage('features.clean', df.shape[0]):
+            # fill nulls
+            fill_nulls(df, ['break_apparent_cause', 'break_nature', 'break_categorization',
+                            'street', 'asset_material'], 'UNKNOWN')
+            fill_nulls(df, 'asset_size', df['asset_size'].mode()[0])
+
+            for col, mapping in REPLACEMENTS.items():
+                replace_values(df, col, mapping)
+
+        with stage('features.derive', df.shape[0]):
+            # breaks are counted over every incident, before any row is dropped
+            num_breaks(df)
+            calc_age(df, out_col='age_at_break')
+
+        with stage('features.encode', df.shape[0]):
+            encode_binary_cols(df)
+            df, encodings = encode_cat_cols(df)
+
+        # keep existing assets with a positive age (a zero age would give an
+        # infinite failure rate)
+        keep = (df['asset_exists'] == 1) & (df['age_at_break'] > 0)
+        model_data = df.loc[keep, FEATURE_COLS].reset_index(drop=True)
+        model_data['age_at_break'] = model_data['age_at_break'].astype('int32')
+        model_data[TARGET_COL] = (model_data['num_breaks'] / model_data['age_at_break']).round(4)
+        run.rows_out = model_data.shape[0]
+
+        if write:
+            with stage('features.write', model_data.shape[0]):
+                write_table(model_data, 'model_data', 'processed', csv=True)
+                save_encodings(encodings)
+
+    return model_data
+
+
+if __name__ == '__main__':
+    process_data()
@@ -0,0 +1,219 @@
+import contextlib
+import cProfile
+import functools
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+
+# Every finished stage is appended to this JSON lines file
+METRICS_PATH = os.environ.get('PIPELINE_METRICS', 'data/metrics/stages.jsonl')
+
+# Opt-in profiling of the outermost stages: 'cprofile', 'tracemalloc' or
+# 'all', written next to the metrics
+PROFILE = os.environ.get('PIPELINE_PROFILE', '')
+PROFILE_DIR = os.path.join(os.path.dirname(METRICS_PATH), 'profiles')
+
+# Identifies the stages of one pipeline run in the metrics file
+RUN_ID = uuid.uuid4().hex[:12]
+
+_lock = threading.Lock()
+# Stages running in each thread, outermost first. A counter is credited to
+# the stages of the thread incrementing it, so concurrent stages (e.g. the
+# ingestion of several cities) don't count each other's work; worker
+# threads `attach` to the stages of the thread that started them.
+_local = threading.local()
+# Stages running in any thread: only the first one profiles
+_running = 0
+
+
+class Stage:
+    '''Measurements of one running stage; set `rows_out` (or `rows_in`) on it.'''
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.counters = {}
+        self.extra = {}
+
+    def record(self):
+        record = {'run_id': RUN_ID, 'stage': self.name, 'rows_in': self.rows_in,
+                  'rows_out': self.rows_out}
+        record.update(self.counters)
+        record.update(self.extra)
+        return record
+
+
+def _active():
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+def active_stages():
+    '''The stages running in this thread, to `attach` a worker thread to.'''
+    return list(_active())
+
+
+@contextlib.contextmanager
+def attach(stages):
+    '''Credit the counters of this thread to `stages` (from `active_stages`) too.'''
+    previous = _active()
+    _local.stages = list(stages) + previous
+    try:
+        yield
+    finally:
+        _local.stages = previous
+
+
+def bind(func):
+    '''`func` running attached to the stages of the calling thread, for an executor.'''
+    stages = active_stages()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with attach(stages):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def count(name, value=1):
+    '''Add `value` to counter `name` (e.g. 'http_requests') of this thread's stages.'''
+    stages = _active()
+    with _lock:
+        for stage_ in stages:
+            stage_.counters[name] = stage_.counters.get(name, 0) + value
+
+
+def num_rows(obj):
+    '''Number of rows of a DataFrame/array result, None for anything else.'''
+    shape = getattr(obj, 'shape', None)
+    return int(shape[0]) if shape else None
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    '''
+    Measure the block as stage `name`: wall and CPU time, rows in/out, the
+    counters incremented while it runs and the peak memory. The record is
+    written to `METRICS_PATH` and, inside an MLflow run, logged as metrics.
+    '''
+    global _running
+
+    current = Stage(name, rows_in)
+    _active().append(current)
+    with _lock:
+        outermost = not _running
+        _running += 1
+
+    profiler = None
+    if outermost and PROFILE in ('cprofile', 'all'):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    tracing = outermost and PROFILE in ('tracemalloc', 'all') and not tracemalloc.is_tracing()
+    if tracing:
+        tracemalloc.start(25)
+    elif tracemalloc.is_tracing() and outermost:
+        tracemalloc.reset_peak()
+
+    start, cpu_start = time.perf_counter(), time.process_time()
+    try:
+        yield current
+    finally:
+        current.extra['wall_seconds'] = round(time.perf_counter() - start, 6)
+        current.extra['cpu_seconds'] = round(time.process_time() - cpu_start, 6)
+        # the process high-water mark, i.e. the peak up to the end of the stage
+        current.extra['peak_rss_mb'] = round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+        if tracemalloc.is_tracing():
+            current.extra['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / 1024 ** 2, 1)
+
+        _active().remove(current)
+        with _lock:
+            _running -= 1
+        if profiler is not None:
+            profiler.disable()
+            _dump_profile(profiler, name)
+        if tracing:
+            _dump_snapshot(tracemalloc.take_snapshot(), name)
+            tracemalloc.stop()
+        emit(current.record())
+
+
+def instrumented(name=None):
+    '''
+    Decorator running the function as a `stage`, with the rows of its first
+    argument as rows in and the rows of its result as rows out.
+    '''
+    def decorator(func):
+        stage_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name, num_rows(args[0]) if args else None) as current:
+                result = func(*args, **kwargs)
+                current.rows_out = num_rows(result)
+                return result
+        return wrapper
+    return decorator
+
+
+def emit(record, path=None):
+    '''Append `record` to the metrics file and log it to the active MLflow run.'''
+    path = path or METRICS_PATH
+    record = dict(record, timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'))
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with _lock, open(path, 'a') as f:
+        f.write(json.dumps(record, default=str) + '\n')
+
+    # only when the caller already uses MLflow: importing it costs seconds
+    mlflow = sys.modules.get('mlflow')
+    if mlflow is not None and mlflow.active_run() is not None:
+        mlflow.log_metrics({f"{record['stage']}.{key}": value for key, value in record.items()
+                            if isinstance(value, (int, float)) and not isinstance(value, bool)})
+
+
+def _profile_path(name, suffix):
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    return os.path.join(PROFILE_DIR, f'{RUN_ID}-{name}{suffix}')
+
+
+def _dump_profile(profiler, name):
+    path = _profile_path(name, '.prof')
+    profiler.dump_stats(path)
+    print(f'cProfile of {name} written to {path} (inspect with `python -m pstats {path}`)')
+
+
+def _dump_snapshot(snapshot, name, limit=30):
+    path = _profile_path(name, '.tracemalloc.txt')
+    with open(path, 'w') as f:
+        for stat in snapshot.statistics('traceback')[:limit]:
+            f.write(f'{stat.size / 1024:.1f} KiB in {stat.count} blocks\n')
+            f.write('\n'.join(stat.traceback.format()) + '\n\n')
+    print(f'Allocations of {name} written to {path}')
+
+
+def summarize(path=None, run_id=None):
+    '''Stage records of `run_id` (by default the last run) from the metrics file.'''
+    path = path or METRICS_PATH
+    with open(path) as f:
+        records = [json.loads(line) for line in f if line.strip()]
+    run_id = run_id or (records[-1]['run_id'] if records else None)
+    return [r for r in records if r['run_id'] == run_id]
+
+
+if __name__ == '__main__':
+    # print where the last (or a given) run spent its time
+    records = summarize(run_id=sys.argv[1] if len(sys.argv) > 1 else None)
+    for r in records:
+        counters = {k: v for k, v in r.items() if k not in
+                    ('run_id', 'stage', 'rows_in', 'rows_out', 'wall_seconds', 'cpu_seconds',
+                     'peak_rss_mb', 'peak_traced_mb', 'timestamp')}
+        print(f"{r['stage']:32s} {r['wall_seconds']:9.2f} s  cpu {r['cpu_seconds']:8.2f} s  "
+              f"rows {r['rows_in']} -> {r['rows_out']}  peak RSS {r['peak_rss_mb']} MB  "
+              f"{counters or ''}")
@@ -0,0 +1,319 @@
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from sklearn.ensemble import HistGradientBoostingRegressor
+from sklearn.metrics import mean_poisson_deviance
+
+from src.data.database import connect, load_table
+from src.data.schema import apply_schema
+from src.data.storage import write_table
+from src.features.exposure import (MAX_AGE, MAX_PRIOR_BREAKS, N_SIZE_BANDS, exposure_panel,
+                                   main_covariates)
+from src.instrumentation import stage
+
+# Covariates of the rate model, in order; the first two are categorical
+HAZARD_FEATURES = ['material', 'size_band', 'prior_breaks', 'age']
+# The rate never decreases with the prior breaks or the age (categorical
+# covariates can't be constrained)
+MONOTONIC_CST = [0, 0, 1, 1]
+
+# Ages pooled together in the cells the rate is fitted on
+AGE_BAND = 5
+
+# Years ahead the mains are scored for
+HORIZONS = (1, 5, 10)
+
+MAINS_QUERY_COLUMNS = ['OBJECTID', 'WATMAINID', 'MATERIAL', 'PIPE_SIZE', 'INSTALLATION_DATE',
+                       'Shape__Length']
+
+
+class HazardModel:
+    '''
+    Break rate (breaks per km-year) of a main given its material, size band,
+    prior breaks and age: a Poisson model of the asset-years, i.e. a
+    piecewise-constant hazard of the time to the next failure.
+
+    The rate only depends on a few small categorical covariates and the
+    age, so it's evaluated once on the whole grid of them (`rate_grid`) and
+    every main is scored by looking up its cells, not by running the
+    estimator on every main and year.
+    '''
+
+    def __init__(self, estimator, materials, start_year, end_year, age_band=1):
+        self.estimator = estimator
+        self.materials = materials
+        self.start_year = start_year
+        self.end_year = end_year
+        self.age_band = age_band
+
+    def rate(self, material, size_band, prior_breaks, age):
+        X = np.column_stack([material, size_band, prior_breaks, age]).astype(np.float64)
+        return self.estimator.predict(X)
+
+    def rate_grid(self, max_age):
+        '''Rates of every (material, size band, prior breaks, age <= max_age) cell.'''
+        shape = (len(self.materials), N_SIZE_BANDS, MAX_PRIOR_BREAKS + 1, max_age + 1)
+        grid = np.indices(shape).reshape(len(shape), -1)
+        return self.rate(*grid).reshape(shape)
+
+    def score(self, mains, break_counts, as_of_year, horizons=HORIZONS):
+        '''
+        Expected breaks of every main over the `horizons` years following
+        `as_of_year`, and the probability of at least one break
+        (1 - exp(-cumulative hazard)), holding the prior breaks at their
+        current count. Mains without an installation date get NaN.
+
+        Returns
+        -------
+        scores : pd.DataFrame
+            One row per main, in the order of `mains`.
+        '''
+        covariates = main_covariates(mains, break_counts, as_of_year, self.materials)
+        max_age = MAX_AGE + max(horizons) + 1
+        # cumulative[..., a] is the hazard accumulated over ages 0..a-1
+        rates = self.rate_grid(max_age)
+        cumulative = np.concatenate([np.zeros(rates.shape[:-1] + (1,)),
+                                     np.cumsum(rates, axis=-1)], axis=-1)
+
+        age = covariates['age']
+        known = ~np.isnan(age)
+        # the next year is at age + 1
+        first = np.clip(np.nan_to_num(age, nan=0).astype(np.int64) + 1, 0, max_age)
+        cells = (covariates['material'], covariates['size_band'], covariates['prior_breaks'])
+        scores = pd.DataFrame({
+            'OBJECTID': mains['OBJECTID'].to_numpy() if 'OBJECTID' in mains else None,
+            'WATMAINID': mains['WATMAINID'].to_numpy(),
+            'age': age.astype(np.float32),
+            'num_breaks': covariates['num_breaks'].astype(np.int32),
+            'length_km': covariates['length_km'].astype(np.float32),
+        })
+        for h in horizons:
+            last = np.minimum(first + h, max_age + 1)
+            expected = covariates['length_km'] * (cumulative[cells + (last,)] -
+                                                  cumulative[cells + (first,)])
+            expected[~known] = np.nan
+            scores[f'expected_breaks_{h}y'] = expected.astype(np.float32)
+            scores[f'p_break_{h}y'] = (1 - np.exp(-expected)).astype(np.float32)
+        return scores
+
+    def metadata(self):
+        return {'materials': self.materials, 'start_year': self.start_year,
+                'end_year': self.end_year, 'features': HAZARD_FEATURES,
+                'max_prior_breaks': MAX_PRIOR_BREAKS, 'max_age': MAX_AGE,
+                'age_band': self.age_band}
+
+
+def pooled_cells(panel, age_band=AGE_BAND):
+    '''
+    The cells of `panel` with the ages of every material, size band and
+    prior breaks pooled into bands of `age_band` years: their exposure and
+    breaks are summed and the age of the band is their exposure-weighted
+    mean age.
+    '''
+    cells = panel.cells()
+    if age_band <= 1:
+        return cells
+    cells['age_exposure'] = cells['age'] * cells['exposure']
+    cells['band'] = cells['age'] // age_band
+    pooled = (cells.groupby(['material', 'size_band', 'prior_breaks', 'band'], sort=False)
+              [['exposure', 'breaks', 'age_exposure']].sum().reset_index())
+    pooled['age'] = pooled['age_exposure'] / pooled['exposure']
+    return pooled[HAZARD_FEATURES + ['exposure', 'breaks']]
+
+
+def fit_hazard(panel, max_iter=200, learning_rate=0.1, max_leaf_nodes=31,
+               l2_regularization=1.0, min_samples_leaf=40, age_band=AGE_BAND,
+               random_state=42):
+    '''
+    Fit the break rate of the cells of `panel` with a Poisson loss, every
+    cell weighted by its exposure (the usual way of giving a Poisson model
+    an exposure offset).
+
+    A cell of a few metres of main with one break has a rate in the
+    hundreds, which an unregularized fit reproduces and the scores then
+    compound over the horizon. So the ages are pooled into bands of
+    `age_band` years before fitting, every leaf covers at least
+    `min_samples_leaf` cells, and `l2_regularization` (in expected breaks,
+    the Poisson hessian of a cell being its weighted rate) shrinks the
+    leaves backed by little exposure. The rate is also kept non-decreasing
+    in the prior breaks and the age (`MONOTONIC_CST`).
+    '''
+    cells = pooled_cells(panel, age_band)
+    estimator = HistGradientBoostingRegressor(loss='poisson', categorical_features=[0, 1],
+                                              monotonic_cst=MONOTONIC_CST,
+                                              max_iter=max_iter, learning_rate=learning_rate,
+                                              max_leaf_nodes=max_leaf_nodes,
+                                              l2_regularization=l2_regularization,
+                                              min_samples_leaf=min_samples_leaf,
+                                              random_state=random_state)
+    estimator.fit(cells[HAZARD_FEATURES].to_numpy(dtype=np.float64),
+                  cells['breaks'] / cells['exposure'], sample_weight=cells['exposure'])
+    return HazardModel(estimator, panel.materials, panel.start_year, panel.end_year,
+                       age_band)
+
+
+def evaluate(model, panel, train_rate):
+    '''
+    Exposure-weighted Poisson deviance of `model` on the cells of `panel`,
+    against a constant rate `train_rate`, and predicted against recorded
+    breaks.
+    '''
+    cells = panel.cells()
+    if cells.shape[0] == 0 or cells['breaks'].sum() == 0:
+        return {}
+    rate = model.rate(*(cells[col].to_numpy() for col in HAZARD_FEATURES))
+    observed = cells['breaks'] / cells['exposure']
+    deviance = mean_poisson_deviance(observed, rate, sample_weight=cells['exposure'])
+    baseline = mean_poisson_deviance(observed, np.full(len(rate), train_rate),
+                                     sample_weight=cells['exposure'])
+    return {
+        'holdout_deviance': deviance,
+        'holdout_baseline_deviance': baseline,
+        'holdout_deviance_explained': 1 - deviance / baseline,
+        'holdout_breaks': int(cells['breaks'].sum()),
+        'holdout_predicted_breaks': float((rate * cells['exposure']).sum()),
+    }
+
+
+def _columns(conn, table_name):
+    return [row[1] for row in conn.execute(f'PRAGMA table_info({table_name})')]
+
+
+def read_inventory(conn, mains_table='mains', breaks_table='breaks'):
+    '''The mains columns the hazard model uses, and the break dates of every asset.'''
+    available = set(_columns(conn, mains_table))
+    columns = ', '.join(f'"{col}"' for col in MAINS_QUERY_COLUMNS if col in available)
+    mains = apply_schema(pd.read_sql(f'SELECT {columns} FROM {mains_table}', conn))
+    breaks = apply_schema(pd.read_sql(f'SELECT ASSETID, INCIDENT_DATE FROM {breaks_table}',
+                                      conn))
+    return mains, breaks
+
+
+def train_hazard(db_name='water_data.db', mains_table='mains', breaks_table='breaks',
+                 output_table='main_hazard', holdout_years=3, horizons=HORIZONS, as_of=None,
+                 max_iter=200, learning_rate=0.1, log=True):
+    '''
+    Fit the break hazard of the mains and score every main of the inventory.
+
+    The model is first fitted without the last `holdout_years` years of
+    breaks and evaluated on them, then refitted on every year. The expected
+    breaks and break probabilities over `horizons` are written to
+    `output_table` in SQLite and as a processed table.
+
+    Parameters
+    ----------
+    db_name : string
+        SQLite database with the mains and breaks tables.
+    mains_table, breaks_table : string
+        Source tables, e.g. the partitions of one city.
+    output_table : string
+        Table receiving the scores.
+    holdout_years : int
+        Years held out for the evaluation, 0 to skip it.
+    horizons : tuple of int
+        Years ahead every main is scored for.
+    as_of : datetime-like, optional
+        The scores cover the years after this date's year, by default the
+        year of the last recorded break.
+    log : bool
+        Log the run, the evaluation and the model to MLflow.
+
+    Returns
+    -------
+    summary : dict
+        Panel size, evaluation and timings.
+    '''
+    conn = connect(db_name)
+    try:
+        with stage('hazard.read') as current:
+            mains, breaks = read_inventory(conn, mains_table, breaks_table)
+            current.rows_out = mains.shape[0] + breaks.shape[0]
+    finally:
+        conn.close()
+
+    summary = {'mains': mains.shape[0], 'breaks': breaks.shape[0]}
+    start = time.perf_counter()
+    with stage('hazard.panel', mains.shape[0]) as current:
+        panel = exposure_panel(mains, breaks)
+        current.rows_out = int((panel.exposure > 0).sum())
+    summary.update(panel_cells=current.rows_out, panel_mb=panel.nbytes / 1024 ** 2,
+                   start_year=panel.start_year, end_year=panel.end_year,
+                   panel_seconds=time.perf_counter() - start)
+
+    if holdout_years and panel.end_year - panel.start_year > holdout_years:
+        split = panel.end_year - holdout_years
+        with stage('hazard.evaluate'):
+            train = exposure_panel(mains, breaks, panel.start_year, split,
+                                   materials=panel.materials)
+            holdout = exposure_panel(mains, breaks, split + 1, panel.end_year,
+                                     history_start=panel.start_year, materials=panel.materials)
+            model = fit_hazard(train, max_iter=max_iter, learning_rate=learning_rate)
+            train_rate = train.breaks.sum() / train.exposure.sum()
+            summary.update(evaluate(model, holdout, train_rate))
+
+    start = time.perf_counter()
+    with stage('hazard.fit', summary['panel_cells']):
+        model = fit_hazard(panel, max_iter=max_iter, learning_rate=learning_rate)
+    summary['fit_seconds'] = time.perf_counter() - start
+
+    as_of_year = panel.end_year if as_of is None else pd.Timestamp(as_of).year
+    start = time.perf_counter()
+    with stage('hazard.score', mains.shape[0]) as current:
+        break_counts = breaks.groupby('ASSETID', sort=False).size()
+        scores = model.score(mains, break_counts, as_of_year, horizons)
+        current.rows_out = scores.shape[0]
+    summary['score_seconds'] = time.perf_counter() - start
+    summary['as_of_year'] = as_of_year
+
+    with stage('hazard.write', scores.shape[0]):
+        load_table(scores, output_table, db_name)
+        write_table(scores, output_table, 'processed')
+
+    if log:
+        _log_run(model, summary, horizons)
+    return summary
+
+
+def _log_run(model, summary, horizons):
+    import mlflow
+    import mlflow.sklearn
+
+    with mlflow.start_run():
+        for name in ['max_iter', 'learning_rate', 'max_leaf_nodes', 'l2_regularization',
+                     'min_samples_leaf']:
+            mlflow.log_param(name, getattr(model.estimator, name))
+        mlflow.log_param('age_band', model.age_band)
+        mlflow.log_param('horizons', ','.join(str(h) for h in horizons))
+        mlflow.log_param('years', f"{summary['start_year']}-{summary['end_year']}")
+        for name, value in summary.items():
+            if name.startswith('holdout_') or name.endswith('_seconds') or name == 'panel_cells':
+                mlflow.log_metric(name, value)
+        mlflow.sklearn.log_model(model.estimator, 'hazard-model')
+        mlflow.log_dict(model.metadata(), 'hazard_metadata.json')
+        mlflow.set_tag('hazard_model', 'true')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Fit the break hazard and score every main')
+    parser.add_argument('--db', default='water_data.db')
+    parser.add_argument('--mains-table', default='mains')
+    parser.add_argument('--breaks-table', default='breaks')
+    parser.add_argument('--output-table', default='main_hazard')
+    parser.add_argument('--holdout-years', type=int, default=3)
+    parser.add_argument('--horizons', type=int, nargs='+', default=list(HORIZONS))
+    parser.add_argument('--as-of', default=None)
+    parser.add_argument('--no-log', action='store_true', help="don't log the run to MLflow")
+    args = parser.parse_args()
+
+    summary = train_hazard(args.db, args.mains_table, args.breaks_table, args.output_table,
+                           args.holdout_years, tuple(args.horizons), args.as_of,
+                           log=not args.no_log)
+    for name, value in summary.items():
+        print(f'{name:28s} {value:.4g}' if isinstance(value, float) else f'{name:28s} {value}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,295 @@
+import os
+import resource
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.pipeline import make_pipeline
+
+from src.data.storage import iter_table
+from src.features.process_data import FEATURE_COLS, TARGET_COL
+# aliased: `stage` is also the storage stage of the model data
+from src.instrumentation import stage as pipeline_stage
+from src.models.search import available_cpus
+
+WORK_DIR = 'data/cache/train'
+
+# Default peak memory budget of a training run
+MEMORY_BUDGET_MB = 2048
+
+# Rows are assigned to the test set when their hash falls in the first
+# `test_size` of this many buckets
+SPLIT_BUCKETS = 10_000
+
+# Working memory of one tree per training sample: the sample indices, the
+# copied feature values and the target/weights used by the splitter
+TREE_BYTES_PER_SAMPLE = 32
+
+# Share of the budget given to the chunk being read, which pandas/pyarrow
+# hold several copies of while it's converted
+CHUNK_BUDGET_SHARE = 0.1
+CHUNK_COPIES = 4
+
+# Fewest rows a chunk, or a tree's sample, may be cut to before the budget
+# is deemed too small to train in
+MIN_ROWS = 1_000
+
+
+def peak_rss_mb():
+    '''Peak resident set size of this process so far, in MB.'''
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def rss_mb():
+    '''Resident set size of this process now, in MB (the peak without /proc).'''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 ** 2
+    except (OSError, ValueError):
+        return peak_rss_mb()
+
+
+def hash_split(chunk, test_size=0.2, columns=None):
+    '''
+    Boolean mask of the rows of `chunk` that belong to the test set.
+
+    The assignment only depends on the content of the row, so it's the same
+    whatever the chunking or the order of the rows, and no shuffle of the
+    whole dataset is needed. Identical rows always land on the same side.
+    '''
+    columns = columns or FEATURE_COLS + [TARGET_COL]
+    hashes = pd.util.hash_pandas_object(chunk[columns], index=False).values
+    return (hashes % SPLIT_BUCKETS) < int(test_size * SPLIT_BUCKETS)
+
+
+def _chunk_rows(budget_mb, n_columns):
+    row_bytes = n_columns * 8 * CHUNK_COPIES
+    return int(budget_mb * 1024 ** 2 * CHUNK_BUDGET_SHARE / row_bytes)
+
+
+def spool_split(chunks, directory, test_size=0.2, memory_limit_mb=None):
+    '''
+    Stream `chunks` into float32 feature files and float64 target files, one
+    pair for each side of the hash split, then memory-map them.
+
+    A feature scaler is fitted on the training rows along the way and the
+    memory-mapped training/test features are scaled in place, a block at a
+    time, so no full copy of the data is ever held in memory. A side
+    without rows is an empty array.
+
+    Raises MemoryError as soon as the resident memory exceeds
+    `memory_limit_mb` MB after a chunk.
+
+    Returns
+    -------
+    arrays : dict
+        'X_train', 'X_test', 'y_train', 'y_test' as memory-mapped arrays.
+    scaler : StandardScaler
+    '''
+    scaler = StandardScaler()
+    files = {name: open(os.path.join(directory, f'{name}.bin'), 'wb')
+             for name in ['X_train', 'X_test', 'y_train', 'y_test']}
+    rows = {'train': 0, 'test': 0}
+    try:
+        for chunk in chunks:
+            test = hash_split(chunk, test_size)
+            X = np.ascontiguousarray(chunk[FEATURE_COLS].to_numpy(dtype=np.float32))
+            y = chunk[TARGET_COL].to_numpy(dtype=np.float64)
+            for side, mask in [('train', ~test), ('test', test)]:
+                if mask.any():
+                    files[f'X_{side}'].write(X[mask].tobytes())
+                    files[f'y_{side}'].write(y[mask].tobytes())
+                    rows[side] += int(mask.sum())
+            if (~test).any():
+                scaler.partial_fit(X[~test])
+            del X, y
+            if memory_limit_mb is not None and rss_mb() > memory_limit_mb:
+                raise MemoryError(f'Spooling the model data took {rss_mb():.0f} MB, over '
+                                  f'the {memory_limit_mb:.0f} MB budget')
+    finally:
+        for f in files.values():
+            f.close()
+
+    arrays = {}
+    for side in ['train', 'test']:
+        n = rows[side]
+        arrays[f'X_{side}'] = _open(directory, f'X_{side}', np.float32, (n, len(FEATURE_COLS)))
+        arrays[f'y_{side}'] = _open(directory, f'y_{side}', np.float64, (n,))
+    if rows['train'] == 0:
+        raise ValueError('No training rows: the model data is empty')
+
+    for name in ['X_train', 'X_test']:
+        X = arrays[name]
+        for start in range(0, X.shape[0], 65_536):
+            block = X[start:start + 65_536]
+            block[:] = scaler.transform(block)
+        # an empty side isn't mapped (see `_open`)
+        if isinstance(X, np.memmap):
+            X.flush()
+    return arrays, scaler
+
+
+def _open(directory, name, dtype, shape):
+    # a file can't be mapped with a length of 0
+    if shape[0] == 0:
+        return np.empty(shape, dtype=dtype)
+    return np.memmap(os.path.join(directory, f'{name}.bin'), dtype=dtype, mode='r+', shape=shape)
+
+
+def tree_sample_limit(budget_mb, n_jobs):
+    '''Most samples a tree may be fitted on so `n_jobs` trees fit in the budget.'''
+    # whatever remains after the streamed chunk is shared by the trees
+    free = budget_mb * 1024 ** 2 * (1 - CHUNK_BUDGET_SHARE) / 2
+    return int(free / (n_jobs * TREE_BYTES_PER_SAMPLE))
+
+
+def plan_budget(memory_budget_mb, n_jobs, n_columns):
+    '''
+    Chunk rows, trees fitted in parallel and samples per tree that fit in
+    `memory_budget_mb` beside the memory this process already holds. Fewer
+    trees are fitted in parallel when each would get under `MIN_ROWS`
+    samples; a budget too small for even that raises ValueError.
+    '''
+    in_use = rss_mb()
+    available = memory_budget_mb - in_use
+    n_jobs = max(1, min(n_jobs, tree_sample_limit(max(available, 0), 1) // MIN_ROWS))
+    batch_rows = _chunk_rows(max(available, 0), n_columns)
+    sample_limit = tree_sample_limit(max(available, 0), n_jobs)
+    if min(batch_rows, sample_limit) < MIN_ROWS:
+        raise ValueError(f'A memory budget of {memory_budget_mb:.0f} MB leaves '
+                         f'{available:.0f} MB beside the {in_use:.0f} MB in use, too little '
+                         f'for chunks and trees of {MIN_ROWS} rows')
+    return batch_rows, n_jobs, sample_limit
+
+
+def streamed_score(model, X, y, block_rows=65_536):
+    '''R^2 of `model` on memory-mapped `X`/`y`, predicted a block at a time.'''
+    n, sum_y, sum_y2, ss_res = 0, 0.0, 0.0, 0.0
+    for start in range(0, X.shape[0], block_rows):
+        y_block = np.asarray(y[start:start + block_rows])
+        residual = y_block - model.predict(X[start:start + block_rows])
+        n += y_block.shape[0]
+        sum_y += y_block.sum()
+        sum_y2 += np.square(y_block).sum()
+        ss_res += np.square(residual).sum()
+    if n == 0:
+        return float('nan')
+    ss_tot = sum_y2 - sum_y ** 2 / n
+    return 1 - ss_res / ss_tot if ss_tot else float('nan')
+
+
+def train_out_of_core(n_estimators=100, max_depth=7, min_samples_split=2,
+                      min_samples_leaf=1, test_size=0.2, memory_budget_mb=MEMORY_BUDGET_MB,
+                      n_jobs=None, table='model_data', stage='processed',
+                      work_dir=WORK_DIR, random_state=42, log=True):
+    '''
+    Train the random forest without ever loading the model data in memory.
+
+    The processed table is streamed in chunks sized from the budget and
+    split by row hash (`hash_split`) into memory-mapped float32 arrays on
+    disk. The forest is fitted on those arrays, each tree on at most
+    `tree_sample_limit` bootstrap samples so the concurrent trees stay
+    within the budget, and scored on the test rows a block at a time.
+
+    Parameters
+    ----------
+    n_estimators, max_depth, min_samples_split, min_samples_leaf : int
+        Hyperparameters of the forest.
+    test_size : float
+        Share of the rows in the test set.
+    memory_budget_mb : float
+        Peak memory budget of the run, including what the process already
+        holds. The chunk size, the number of samples per tree and the trees
+        fitted in parallel are derived from it (`plan_budget`), and the
+        spooling stops with a MemoryError if it's exceeded anyway. The
+        memory-mapped pages counted in the RSS while fitting can be
+        reclaimed by the OS, so the peak may still exceed the budget
+        without memory pressure.
+    n_jobs : int, optional
+        Most trees fitted in parallel, by default the number of CPUs.
+    table, stage : string
+        Table of model data to stream.
+    work_dir : string
+        Directory of the memory-mapped arrays, on disk rather than in a
+        RAM-backed temporary directory.
+    log : bool
+        Log the run, the peak RSS and the fitted pipeline to MLflow.
+
+    Returns
+    -------
+    summary : dict
+        Rows of each side, test score, timings and peak RSS against the budget.
+    '''
+    batch_rows, n_jobs, sample_limit = plan_budget(memory_budget_mb,
+                                                   n_jobs or available_cpus(),
+                                                   len(FEATURE_COLS) + 1)
+    start = time.perf_counter()
+    os.makedirs(work_dir, exist_ok=True)
+    directory = tempfile.mkdtemp(prefix='run-', dir=work_dir)
+    try:
+        chunks = iter_table(table, stage, columns=FEATURE_COLS + [TARGET_COL],
+                            batch_rows=batch_rows)
+        with pipeline_stage('train.spool') as current:
+            arrays, scaler = spool_split(chunks, directory, test_size, memory_budget_mb)
+            current.rows_out = arrays['X_train'].shape[0] + arrays['X_test'].shape[0]
+        spooled = time.perf_counter()
+
+        n_train = arrays['X_train'].shape[0]
+        max_samples = min(n_train, sample_limit)
+        rf = RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth,
+                                   min_samples_split=min_samples_split,
+                                   min_samples_leaf=min_samples_leaf,
+                                   max_samples=max_samples if max_samples < n_train else None,
+                                   n_jobs=n_jobs, random_state=random_state)
+        with pipeline_stage('train.fit', n_train):
+            rf.fit(arrays['X_train'], arrays['y_train'])
+        fitted = time.perf_counter()
+
+        with pipeline_stage('train.score', arrays['X_test'].shape[0]):
+            score = streamed_score(rf, arrays['X_test'], arrays['y_test'])
+        summary = {
+            'train_rows': n_train,
+            'test_rows': arrays['X_test'].shape[0],
+            'chunk_rows': batch_rows,
+            'max_samples': max_samples,
+            'n_jobs': n_jobs,
+            'score': score,
+            'spool_seconds': spooled - start,
+            'fit_seconds': fitted - spooled,
+            'peak_rss_mb': peak_rss_mb(),
+            'memory_budget_mb': memory_budget_mb,
+        }
+        del arrays
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if summary['peak_rss_mb'] > memory_budget_mb:
+        print(f"Peak RSS {summary['peak_rss_mb']:.0f} MB exceeded the "
+              f"{memory_budget_mb:.0f} MB budget")
+
+    if log:
+        _log_run(summary, make_pipeline(scaler, rf))
+    return summary
+
+
+def _log_run(summary, pipeline):
+    import mlflow
+    import mlflow.sklearn
+
+    rf = pipeline[-1]
+    with mlflow.start_run():
+        for name in ['n_estimators', 'max_depth', 'min_samples_split', 'min_samples_leaf']:
+            mlflow.log_param(name, getattr(rf, name))
+        mlflow.log_param("max_samples", summary['max_samples'])
+        mlflow.log_param("memory_budget_mb", summary['memory_budget_mb'])
+        mlflow.log_metric("score", summary['score'])
+        mlflow.log_metric("peak_rss_mb", summary['peak_rss_mb'])
+        mlflow.log_metric("train_rows", summary['train_rows'])
+        mlflow.sklearn.log_model(pipeline, "rf-model")
+        mlflow.set_tag("rf_model", "true")
+        mlflow.set_tag("training", "out_of_core")
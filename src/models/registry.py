@@ -0,0 +1,377 @@
+'''
+Registry of the promoted failure rate models.
+
+Training logs a pickled pipeline for every kept trial; only the runs that
+are promoted here are meant to be served. Promoting a run exports its
+pipeline (a StandardScaler and a random forest) once into flat arrays, one
+`.npy` file each under `data/models/<run_id>/`: the scaler, and the nodes
+of every tree concatenated (children, split feature, threshold, value).
+Loading memory-maps those files instead of unpickling the object graph,
+and predictions walk all the trees at once with NumPy. Loaded models are
+kept in an in-process LRU cache keyed by run ID.
+
+    python -m src.models.registry promote            # the best logged run
+    python -m src.models.registry list
+    python -m src.models.registry prune --dry-run    # drop unpromoted pickles
+'''
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from src.features.process_data import FEATURE_COLS
+
+REGISTRY_DIR = 'data/models'
+INDEX_FILE = 'registry.json'
+MODEL_FILE = 'model.json'
+FORMAT_VERSION = 2
+
+# Models kept loaded in this process
+MODEL_CACHE_SIZE = 4
+
+# Rows pushed through the trees at once: bounds the (trees x rows) node
+# index array
+PREDICT_BLOCK_ROWS = 16_384
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def _accepts_nan(forest, n_features):
+    '''Whether `forest` predicts missing values rather than rejecting them.'''
+    try:
+        forest.predict(np.full((1, n_features), np.nan))
+    except ValueError:
+        return False
+    return True
+
+
+class CompactForest:
+    '''
+    A fitted `StandardScaler` + random forest regressor as flat arrays.
+
+    Leaves point to themselves and split on +inf, so every tree can be
+    walked `max_depth` steps from its root without checking for leaves and
+    lands on the same leaf as scikit-learn. The features are compared as
+    float32 like scikit-learn's trees do, and a missing (NaN) feature goes
+    to the child the tree sends missing values to, so the predictions
+    match. Forests of a scikit-learn without missing value support reject
+    NaN, like the pipeline would.
+    '''
+
+    ARRAYS = ('mean', 'scale', 'roots', 'left', 'right', 'feature', 'threshold',
+              'missing_left', 'value')
+
+    def __init__(self, arrays, metadata):
+        for name in self.ARRAYS:
+            setattr(self, name, arrays[name])
+        self.metadata = metadata
+        self.max_depth = metadata['max_depth']
+
+    @classmethod
+    def from_pipeline(cls, model, **metadata):
+        '''Export a fitted `make_pipeline(StandardScaler(), forest)` (or a bare forest).'''
+        from sklearn.preprocessing import StandardScaler
+
+        steps = [step for _, step in model.steps] if hasattr(model, 'steps') else [model]
+        forest, transforms = steps[-1], steps[:-1]
+        if len(transforms) > 1 or (transforms and not isinstance(transforms[0], StandardScaler)):
+            raise ValueError('Only a StandardScaler followed by a forest can be exported')
+        if getattr(forest, 'n_outputs_', 1) != 1 or not hasattr(forest, 'estimators_'):
+            raise ValueError('Only single-output forests can be exported')
+
+        n_features = forest.n_features_in_
+        mean, scale = np.zeros(n_features), np.ones(n_features)
+        if transforms:
+            scaler = transforms[0]
+            # the fitted mean is kept even when the scaler doesn't center
+            if scaler.with_mean:
+                mean = np.asarray(scaler.mean_, dtype=np.float64)
+            if scaler.with_std:
+                scale = np.asarray(scaler.scale_, dtype=np.float64)
+
+        trees = [estimator.tree_ for estimator in forest.estimators_]
+        offsets = np.concatenate([[0], np.cumsum([tree.node_count for tree in trees])])
+        n_nodes = int(offsets[-1])
+        arrays = {
+            'mean': mean,
+            'scale': scale,
+            'roots': offsets[:-1].astype(np.int32),
+            'left': np.empty(n_nodes, dtype=np.int32),
+            'right': np.empty(n_nodes, dtype=np.int32),
+            'feature': np.empty(n_nodes, dtype=np.int32),
+            'threshold': np.empty(n_nodes, dtype=np.float64),
+            'missing_left': np.zeros(n_nodes, dtype=bool),
+            'value': np.empty(n_nodes, dtype=np.float64),
+        }
+        for tree, offset in zip(trees, offsets[:-1]):
+            nodes = slice(offset, offset + tree.node_count)
+            own = np.arange(offset, offset + tree.node_count)
+            leaf = tree.children_left == -1
+            arrays['left'][nodes] = np.where(leaf, own, tree.children_left + offset)
+            arrays['right'][nodes] = np.where(leaf, own, tree.children_right + offset)
+            arrays['feature'][nodes] = np.where(leaf, 0, tree.feature)
+            arrays['threshold'][nodes] = np.where(leaf, np.inf, tree.threshold)
+            if hasattr(tree, 'missing_go_to_left'):
+                arrays['missing_left'][nodes] = tree.missing_go_to_left.astype(bool)
+            arrays['value'][nodes] = tree.value[:, 0, 0]
+
+        metadata = dict(metadata, format=FORMAT_VERSION, n_features=int(n_features),
+                        n_trees=len(trees), n_nodes=n_nodes,
+                        missing_values=_accepts_nan(forest, n_features),
+                        max_depth=int(max(tree.max_depth for tree in trees)))
+        return cls(arrays, metadata)
+
+    def predict(self, X, block_rows=PREDICT_BLOCK_ROWS):
+        X = np.asarray(X, dtype=np.float64)
+        if not self.metadata['missing_values'] and np.isnan(X).any():
+            raise ValueError('Input contains NaN: the model was trained with a scikit-learn '
+                             'version without missing value support')
+        predictions = np.empty(X.shape[0])
+        for start in range(0, X.shape[0], block_rows):
+            block = ((X[start:start + block_rows] - self.mean) / self.scale).astype(np.float32)
+            rows = np.arange(block.shape[0])
+            nodes = np.repeat(self.roots[:, None], block.shape[0], axis=1)
+            for _ in range(self.max_depth):
+                values = block[rows, self.feature[nodes]]
+                go_left = np.where(np.isnan(values), self.missing_left[nodes],
+                                   values <= self.threshold[nodes])
+                nodes = np.where(go_left, self.left[nodes], self.right[nodes])
+            predictions[start:start + block_rows] = self.value[nodes].mean(axis=0)
+        return predictions
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        for name in self.ARRAYS:
+            np.save(os.path.join(directory, f'{name}.npy'), getattr(self, name))
+        with open(os.path.join(directory, MODEL_FILE), 'w') as f:
+            json.dump(self.metadata, f, indent=2)
+
+    @classmethod
+    def load(cls, directory, mmap=True):
+        '''Load an exported forest, memory-mapping its arrays unless `mmap` is False.'''
+        with open(os.path.join(directory, MODEL_FILE)) as f:
+            metadata = json.load(f)
+        if metadata.get('format') != FORMAT_VERSION:
+            raise ValueError(f'{directory}: unsupported model format {metadata.get("format")}')
+        arrays = {name: np.load(os.path.join(directory, f'{name}.npy'),
+                                mmap_mode='r' if mmap else None)
+                  for name in cls.ARRAYS}
+        return cls(arrays, metadata)
+
+
+def _index_path(registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, INDEX_FILE)
+
+
+def read_index(registry_dir=REGISTRY_DIR):
+    '''The registry index: the current run ID and every promoted model.'''
+    path = _index_path(registry_dir)
+    if not os.path.exists(path):
+        return {'current': None, 'models': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_index(index, registry_dir=REGISTRY_DIR):
+    os.makedirs(registry_dir, exist_ok=True)
+    path = _index_path(registry_dir)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f, indent=2)
+    # readers see the old or the new index, never half of one
+    os.replace(path + '.tmp', path)
+
+
+def model_dir(run_id, registry_dir=REGISTRY_DIR):
+    return os.path.join(registry_dir, run_id)
+
+
+def best_run_id(experiment_ids=None):
+    '''ID of the best-scoring run that logged an `rf-model` pipeline.'''
+    import mlflow
+
+    runs = mlflow.search_runs(experiment_ids=experiment_ids,
+                              filter_string="tags.rf_model = 'true'",
+                              order_by=['metrics.score DESC'], max_results=1)
+    if runs.shape[0] == 0:
+        raise LookupError('No MLflow run with a logged rf-model was found, '
+                          'run src/models/train.py first')
+    return runs['run_id'].iloc[0]
+
+
+def load_pipeline(run_id):
+    '''Unpickle the `rf-model` pipeline logged by run `run_id`.'''
+    import mlflow.sklearn
+
+    return mlflow.sklearn.load_model(f'runs:/{run_id}/rf-model')
+
+
+def promote(run_id=None, registry_dir=REGISTRY_DIR):
+    '''
+    Export the pipeline of `run_id` (by default the best logged run) to the
+    registry and make it the current model.
+
+    Returns
+    -------
+    entry : dict
+        The registry entry of the model.
+    '''
+    import mlflow
+
+    run_id = run_id or best_run_id()
+    forest = CompactForest.from_pipeline(load_pipeline(run_id), run_id=run_id,
+                                         features=FEATURE_COLS)
+    forest.save(model_dir(run_id, registry_dir))
+
+    run = mlflow.get_run(run_id)
+    entry = {
+        'score': run.data.metrics.get('score'),
+        'params': run.data.params,
+        'n_trees': forest.metadata['n_trees'],
+        'n_nodes': forest.metadata['n_nodes'],
+        'promoted_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    index = read_index(registry_dir)
+    index['models'][run_id] = entry
+    index['current'] = run_id
+    _write_index(index, registry_dir)
+    mlflow.MlflowClient().set_tag(run_id, 'promoted', 'true')
+    evict(run_id)
+    return entry
+
+
+def demote(run_id, registry_dir=REGISTRY_DIR):
+    '''
+    Remove `run_id` from the registry. The most recently promoted of the
+    remaining models becomes the current one.
+    '''
+    index = read_index(registry_dir)
+    if index['models'].pop(run_id, None) is None:
+        raise LookupError(f'{run_id} is not a promoted model')
+    if index['current'] == run_id:
+        remaining = sorted(index['models'], key=lambda r: index['models'][r]['promoted_at'])
+        index['current'] = remaining[-1] if remaining else None
+    _write_index(index, registry_dir)
+    shutil.rmtree(model_dir(run_id, registry_dir), ignore_errors=True)
+    evict(run_id)
+
+
+def prune(registry_dir=REGISTRY_DIR, dry_run=False):
+    '''
+    Delete the logged `rf-model` pipelines of every run that isn't promoted,
+    keeping their parameters and metrics. Their `rf_model` tag becomes
+    'pruned' so `best_run_id` no longer picks them. Only runs stored on the
+    local file system are pruned.
+
+    Returns
+    -------
+    pruned : list
+        Run IDs whose pipeline was (or, with `dry_run`, would be) deleted.
+    '''
+    import mlflow
+    from urllib.parse import urlparse
+    from urllib.request import url2pathname
+
+    promoted = set(read_index(registry_dir)['models'])
+    runs = mlflow.search_runs(search_all_experiments=True,
+                              filter_string="tags.rf_model = 'true'")
+    client = mlflow.MlflowClient()
+    pruned = []
+    for run_id, artifact_uri in zip(runs['run_id'], runs['artifact_uri']):
+        if run_id in promoted:
+            continue
+        uri = urlparse(artifact_uri)
+        if uri.scheme not in ('', 'file'):
+            print(f'Skipping {run_id}: artifacts stored at {artifact_uri}')
+            continue
+        pruned.append(run_id)
+        if not dry_run:
+            shutil.rmtree(os.path.join(url2pathname(uri.path), 'rf-model'), ignore_errors=True)
+            client.set_tag(run_id, 'rf_model', 'pruned')
+    return pruned
+
+
+def current_run_id(registry_dir=REGISTRY_DIR):
+    return read_index(registry_dir)['current']
+
+
+def _load(run_id, registry_dir):
+    directory = model_dir(run_id, registry_dir)
+    if os.path.exists(os.path.join(directory, MODEL_FILE)):
+        return CompactForest.load(directory)
+    # not promoted: the logged pipeline
+    return load_pipeline(run_id)
+
+
+def load_model(run_id=None, registry_dir=REGISTRY_DIR):
+    '''
+    The model of `run_id`, by default the current promoted model or, when
+    nothing was promoted yet, the best logged run. Promoted models load from
+    their compact export, others are unpickled from MLflow; either way the
+    model is cached, the least recently used one being dropped beyond
+    `MODEL_CACHE_SIZE` models.
+    '''
+    run_id = run_id or current_run_id(registry_dir) or best_run_id()
+    with _cache_lock:
+        if run_id in _cache:
+            _cache.move_to_end(run_id)
+            return _cache[run_id]
+    # loaded outside the lock, so a slow load doesn't hold up cached models
+    model = _load(run_id, registry_dir)
+    with _cache_lock:
+        _cache[run_id] = model
+        _cache.move_to_end(run_id)
+        while len(_cache) > MODEL_CACHE_SIZE:
+            _cache.popitem(last=False)
+    return model
+
+
+def evict(run_id=None):
+    '''Drop `run_id` (by default every model) from the cache.'''
+    with _cache_lock:
+        if run_id is None:
+            _cache.clear()
+        else:
+            _cache.pop(run_id, None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Manage the promoted models.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    promote_parser = commands.add_parser('promote', help='export a run and make it current')
+    promote_parser.add_argument('--run-id', default=None, help='by default the best logged run')
+    demote_parser = commands.add_parser('demote', help='remove a model from the registry')
+    demote_parser.add_argument('run_id')
+    commands.add_parser('list', help='list the promoted models')
+    prune_parser = commands.add_parser('prune', help="delete the unpromoted runs' pipelines")
+    prune_parser.add_argument('--dry-run', action='store_true')
+    args = parser.parse_args()
+
+    if args.command == 'promote':
+        run_id = args.run_id or best_run_id()
+        entry = promote(run_id)
+        start = time.perf_counter()
+        CompactForest.load(model_dir(run_id))
+        print(f"Promoted {run_id} (score {entry['score']}, {entry['n_trees']} trees, "
+              f"{entry['n_nodes']} nodes), loads in {(time.perf_counter() - start) * 1000:.1f} ms")
+    elif args.command == 'demote':
+        demote(args.run_id)
+        print(f'Demoted {args.run_id}, current model: {current_run_id()}')
+    elif args.command == 'list':
+        index = read_index()
+        for run_id, entry in index['models'].items():
+            marker = '*' if run_id == index['current'] else ' '
+            print(f"{marker} {run_id}  score {entry['score']}  {entry['n_trees']} trees  "
+                  f"promoted {entry['promoted_at']}")
+    else:
+        pruned = prune(dry_run=args.dry_run)
+        print(f"{'Would prune' if args.dry_run else 'Pruned'} {len(pruned)} runs")
+
+
+if __name__ == '__main__':
+    main()
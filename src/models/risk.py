@@ -0,0 +1,149 @@
+import argparse
+import time
+
+import pandas as pd
+
+from src.data.database import connect, insert_rows
+from src.data.storage import write_table
+from src.features.process_data import load_encodings
+from src.features.mains_features import mains_features, iter_mains_with_breaks
+from src.models.score import load_model, assemble_features, predict_known_age
+from src.instrumentation import stage
+
+RISK_COLUMNS = {
+    'OBJECTID': 'INTEGER',
+    'WATMAINID': 'INTEGER',
+    'ROADSEGMENTID': 'INTEGER',
+    'city': 'TEXT',
+    'material': 'TEXT',
+    'pipe_size': 'REAL',
+    'age': 'REAL',
+    'missing_age': 'INTEGER',
+    'num_breaks': 'INTEGER',
+    'last_break_date': 'TEXT',
+    'risk_score': 'REAL',
+}
+
+
+def _create_staging(conn, table_name):
+    columns_sql = ', '.join(f'"{col}" {typ}' for col, typ in RISK_COLUMNS.items())
+    conn.execute(f'DROP TABLE IF EXISTS {table_name}')
+    conn.execute(f'CREATE TABLE {table_name} ({columns_sql})')
+
+
+def score_network(db_name='water_data.db', chunk_rows=20000, run_id=None,
+                  mains_table='mains', breaks_table='breaks', output_table='main_risk',
+                  city=None, as_of=None, top_n=1000):
+    '''
+    Score every main of the network, not only those that already broke, and
+    write a ranked risk table. Mains without an installation date can't be
+    scored: they get no risk score, `missing_age` 1 and the last ranks.
+
+    The mains are streamed out of SQLite `chunk_rows` at a time, already
+    joined with the per-asset break aggregates, so only one chunk is held
+    in memory whatever the size of the inventory. Each scored chunk is
+    appended to a staging table and SQLite does the final ranking, spilling
+    its sort to disk when it doesn't fit in memory.
+
+    Parameters
+    ----------
+    db_name : string
+        SQLite database with the mains and breaks tables.
+    chunk_rows : int
+        Number of mains scored at a time; bounds the memory used.
+    run_id : string, optional
+        MLflow run of the model, by default the best logged run.
+    mains_table, breaks_table : string
+        Source tables, e.g. the per-city partitions.
+    output_table : string
+        Table receiving the ranked scores.
+    city : string, optional
+        Stored with every row so several municipalities can be compared.
+    as_of : datetime-like, optional
+        Date the ages are computed at, by default today.
+    top_n : int
+        Number of highest-risk mains also exported to the processed
+        `<output_table>_top` table for the app.
+
+    Returns
+    -------
+    summary : dict
+        Rows scored and throughput.
+    '''
+    with stage('risk.load_model'):
+        model = load_model(run_id)
+        encodings = load_encodings()
+    staging = f'{output_table}_staging'
+
+    start = time.perf_counter()
+    n_rows = 0
+    read_conn = connect(db_name)
+    write_conn = connect(db_name)
+    # the final sort may not fit in memory for a large inventory
+    write_conn.execute('PRAGMA temp_store = FILE')
+    try:
+        with write_conn:
+            _create_staging(write_conn, staging)
+
+        with stage('risk.score_mains') as current:
+            for chunk in iter_mains_with_breaks(read_conn, chunk_rows, mains_table, breaks_table):
+                features = mains_features(chunk, encodings, as_of=as_of)
+                scored = pd.DataFrame({
+                    'OBJECTID': chunk['OBJECTID'].values,
+                    'WATMAINID': chunk['WATMAINID'].values,
+                    'ROADSEGMENTID': chunk['ROADSEGMENTID'].values,
+                    'city': city,
+                    'material': chunk['MATERIAL'].values,
+                    'pipe_size': features['asset_size'].values,
+                    'age': features['age_at_break'].values,
+                    'missing_age': features['age_at_break'].isna().astype('int8').values,
+                    'num_breaks': features['num_breaks'].values,
+                    'last_break_date': chunk['last_break_date'].values,
+                    # NULL (ranked last) for the mains without an age
+                    'risk_score': predict_known_age(model, assemble_features(features)),
+                })
+                with write_conn:
+                    insert_rows(write_conn, scored, staging)
+                n_rows += scored.shape[0]
+            current.rows_out = n_rows
+
+        with stage('risk.rank', n_rows), write_conn:
+            write_conn.execute(f'DROP TABLE IF EXISTS {output_table}')
+            write_conn.execute(f'''
+            CREATE TABLE {output_table} AS
+            SELECT ROW_NUMBER() OVER (ORDER BY risk_score DESC, WATMAINID) AS risk_rank, *
+            FROM {staging}
+            ''')
+            write_conn.execute(f'DROP TABLE {staging}')
+            write_conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{output_table}_rank '
+                               f'ON {output_table} (risk_rank)')
+            write_conn.execute(f'CREATE INDEX IF NOT EXISTS idx_{output_table}_watmainid '
+                               f'ON {output_table} (WATMAINID)')
+
+        top = pd.read_sql(f'SELECT * FROM {output_table} WHERE risk_rank <= ? '
+                          f'ORDER BY risk_rank', read_conn, params=(top_n,))
+    finally:
+        read_conn.close()
+        write_conn.close()
+
+    write_table(top, f'{output_table}_top', 'processed')
+    elapsed = time.perf_counter() - start
+    return {'rows': n_rows, 'seconds': elapsed,
+            'rows_per_sec': n_rows / elapsed if elapsed else 0.0}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Rank every water main by predicted failure rate.')
+    parser.add_argument('--db', default='water_data.db')
+    parser.add_argument('--chunk-rows', type=int, default=20000)
+    parser.add_argument('--run-id', default=None)
+    parser.add_argument('--top-n', type=int, default=1000)
+    args = parser.parse_args()
+
+    summary = score_network(args.db, args.chunk_rows, args.run_id, top_n=args.top_n)
+    print(f"Scored {summary['rows']} mains in {summary['seconds']:.1f} s "
+          f"({summary['rows_per_sec']:,.0f} rows/s)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,380 @@
+import argparse
+import json
+import queue
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+
+from src.data.database import connect
+from src.data.storage import iter_table, write_table
+from src.features.process_data import ENCODINGS_PATH, FEATURE_COLS, load_encodings
+from src.features.mains_features import mains_features, iter_mains_with_breaks
+from src.instrumentation import stage as pipeline_stage
+# the scoring entry points load their model from the registry
+from src.models.registry import load_model
+
+
+# Column of the age in the feature matrix
+AGE_COLUMN = FEATURE_COLS.index('age_at_break')
+
+
+def category_codes(encodings):
+    '''Code of every category of every encoded column, from `encodings`.'''
+    return {col: {cat: code for code, cat in enumerate(cats)}
+            for col, cats in encodings.items()}
+
+
+def load_codes(path=ENCODINGS_PATH):
+    '''`category_codes` of the encodings saved by `process_data`.'''
+    return category_codes(load_encodings(path))
+
+
+def assemble_features(records, codes=None):
+    '''
+    Build the float64 feature matrix the model expects, columns in
+    `FEATURE_COLS` order, from a DataFrame or a list of dicts.
+
+    Categorical features may be given either as their codes or as the
+    original labels, which are encoded with `codes` (from
+    `category_codes`); unknown labels get -1 like in training. Missing
+    features are NaN.
+    '''
+    codes = codes or {}
+    if isinstance(records, pd.DataFrame):
+        columns = {col: records[col].to_numpy() if col in records else None
+                   for col in FEATURE_COLS}
+        n = records.shape[0]
+    else:
+        if not all(isinstance(r, dict) for r in records):
+            raise ValueError('every record must be a JSON object of features')
+        columns = {col: [r.get(col, np.nan) for r in records] for col in FEATURE_COLS}
+        n = len(records)
+
+    X = np.empty((n, len(FEATURE_COLS)), dtype=np.float64)
+    for j, col in enumerate(FEATURE_COLS):
+        values = columns[col]
+        if values is None:
+            X[:, j] = np.nan
+            continue
+        numeric = getattr(values, 'dtype', None) is not None and values.dtype.kind in 'biuf'
+        if col in codes and not numeric and any(isinstance(v, str) for v in values):
+            values = [codes[col].get(v, -1) if isinstance(v, str) else v for v in values]
+        X[:, j] = np.asarray(values, dtype=np.float64)
+    return X
+
+
+class LatencyStats:
+    '''Rows scored and latency of every batch/request, for the throughput report.'''
+
+    def __init__(self):
+        self.rows = 0
+        self.busy = 0.0
+        self.latencies = []
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, rows, seconds, latencies=None):
+        with self._lock:
+            self.rows += rows
+            self.busy += seconds
+            self.latencies.extend([seconds] if latencies is None else latencies)
+
+    def summary(self):
+        with self._lock:
+            latencies = np.asarray(self.latencies) * 1000
+            elapsed = time.perf_counter() - self.started
+            return {
+                'rows': self.rows,
+                'rows_per_sec': self.rows / self.busy if self.busy else 0.0,
+                'wall_rows_per_sec': self.rows / elapsed if elapsed else 0.0,
+                'p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+                'p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            }
+
+
+def predict_known_age(model, X):
+    '''
+    Predictions of `model` for the feature matrix `X`, NaN for the rows
+    without an age (mains without an installation date). The model data
+    leaves out the breaks without one (see `process_data`), so the model
+    has nothing to say about them, and scikit-learn's forests reject NaN.
+    '''
+    known = ~np.isnan(X[:, AGE_COLUMN])
+    predictions = np.full(X.shape[0], np.nan)
+    if known.any():
+        predictions[known] = model.predict(X[known])
+    return predictions
+
+
+def score_frames(model, frames, codes=None, stats=None):
+    '''Score an iterable of frames, yielding `(frame, predictions)` pairs.'''
+    for frame in frames:
+        start = time.perf_counter()
+        predictions = predict_known_age(model, assemble_features(frame, codes))
+        if stats is not None:
+            stats.record(frame.shape[0], time.perf_counter() - start)
+        yield frame, predictions
+
+
+def mains_frames(db_name='water_data.db', chunk_rows=5000, encodings=None, as_of=None):
+    '''
+    Feature frames for the whole mains inventory, read from `water_data.db`
+    `chunk_rows` mains at a time. Each frame keeps the WATMAINID.
+    '''
+    encodings = encodings if encodings is not None else load_encodings()
+    conn = connect(db_name)
+    try:
+        for chunk in iter_mains_with_breaks(conn, chunk_rows):
+            features = mains_features(chunk, encodings, as_of=as_of)
+            features.insert(0, 'WATMAINID', chunk['WATMAINID'].values)
+            yield features
+    finally:
+        conn.close()
+
+
+def score_batch(source='mains', stage='processed', chunk_rows=5000, run_id=None,
+                db_name='water_data.db', output='mains_predictions'):
+    '''
+    Score the mains inventory (`source='mains'`) or a stored table of model
+    features in chunks and write the predictions as table `output`.
+    '''
+    model = load_model(run_id)
+    codes = load_codes()
+    stats = LatencyStats()
+
+    if source == 'mains':
+        frames = mains_frames(db_name, chunk_rows)
+        id_col = 'WATMAINID'
+    else:
+        frames = iter_table(source, stage, batch_rows=chunk_rows)
+        id_col = None
+
+    with pipeline_stage(f'score.{source}') as current:
+        parts = []
+        for frame, predictions in score_frames(model, frames, codes, stats):
+            part = frame[[id_col]].copy() if id_col else pd.DataFrame(index=frame.index)
+            part['predictions'] = predictions
+            parts.append(part)
+
+        if parts:
+            write_table(pd.concat(parts, ignore_index=True), output, 'processed')
+        current.rows_out = stats.rows
+    return stats.summary()
+
+
+class MicroBatcher:
+    '''
+    Collects scoring requests from several callers into micro-batches: a
+    batch is scored as soon as it reaches `max_batch` rows or its oldest
+    request has waited `max_wait` seconds, whichever comes first. One
+    background thread owns the model, so it's loaded and used once.
+    '''
+
+    def __init__(self, model, codes, max_batch=256, max_wait=0.005):
+        self.model = model
+        self.codes = codes
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.stats = LatencyStats()
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, records, callback=None):
+        '''
+        Score `records` (a list of dicts). Blocks and returns the predictions,
+        or, with `callback`, returns right away and calls `callback` with
+        them from the batching thread, in submission order. Predictions of
+        records without an age are None (see `predict_known_age`).
+
+        A request whose records can't be scored fails alone: `submit` raises
+        its exception, or `callback` is called with the exception instead of
+        the predictions.
+        '''
+        item = {'records': records, 'submitted': time.perf_counter(),
+                'callback': callback, 'done': threading.Event(), 'result': None,
+                'error': None}
+        self._queue.put(item)
+        if callback is None:
+            item['done'].wait()
+            if item['error'] is not None:
+                raise item['error']
+            return item['result']
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            rows = len(batch[0]['records'])
+            deadline = batch[0]['submitted'] + self.max_wait
+            while rows < self.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                rows += len(item['records'])
+
+            start = time.perf_counter()
+            valid = []
+            for item in batch:
+                try:
+                    item['X'] = assemble_features(item['records'], self.codes)
+                    valid.append(item)
+                except Exception as exc:
+                    item['error'] = exc
+            self._predict(valid)
+            finished = time.perf_counter()
+
+            for item in batch:
+                if item['callback'] is not None:
+                    try:
+                        item['callback'](item['result'] if item['error'] is None
+                                         else item['error'])
+                    except Exception:
+                        traceback.print_exc()
+                item['done'].set()
+            self.stats.record(rows, finished - start,
+                              [finished - item['submitted'] for item in batch])
+
+    def _predict(self, items):
+        '''
+        Predict the feature matrices of `items` as one batch. If that fails,
+        retry them one by one so only the request at fault gets the error.
+        '''
+        if not items:
+            return
+        try:
+            predictions = predict_known_age(self.model, np.vstack([item['X'] for item in items]))
+        except Exception as exc:
+            if len(items) == 1:
+                items[0]['error'] = exc
+            else:
+                for item in items:
+                    self._predict([item])
+            return
+
+        offset = 0
+        for item in items:
+            n = item['X'].shape[0]
+            item['result'] = [None if np.isnan(p) else float(p)
+                              for p in predictions[offset:offset + n]]
+            offset += n
+
+
+def serve_stdin(batcher, stdin=sys.stdin, stdout=sys.stdout):
+    '''
+    Score JSON records read from `stdin`, one per line, writing one JSON
+    line `{"prediction": ...}` per record to `stdout` in the same order, or
+    `{"error": ...}` for a line that isn't a valid record.
+    '''
+    lock = threading.Lock()
+
+    def write(result):
+        if isinstance(result, Exception):
+            payload = {'error': str(result)}
+        else:
+            payload = {'prediction': result[0]}
+        with lock:
+            stdout.write(json.dumps(payload) + '\n')
+            stdout.flush()
+
+    for line in stdin:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except json.JSONDecodeError as exc:
+            # through the batcher too, so the error line keeps its place
+            batcher.submit([], callback=lambda _, exc=exc: write(exc))
+        else:
+            batcher.submit([record], callback=write)
+    # wait for the last micro-batch before returning
+    done = threading.Event()
+    batcher.submit([], callback=lambda _: done.set())
+    done.wait()
+
+
+def make_handler(batcher):
+    class ScoreHandler(BaseHTTPRequestHandler):
+        def _send(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_POST(self):
+            if self.path != '/score':
+                return self._send(404, {'error': 'not found'})
+            length = int(self.headers.get('Content-Length', 0))
+            try:
+                payload = json.loads(self.rfile.read(length) or b'[]')
+                records = payload if isinstance(payload, list) else [payload]
+                predictions = batcher.submit(records)
+            except (ValueError, TypeError) as exc:
+                # malformed JSON or records that aren't valid features
+                return self._send(400, {'error': str(exc)})
+            except Exception as exc:
+                return self._send(500, {'error': str(exc)})
+            self._send(200, {'predictions': predictions})
+
+        def do_GET(self):
+            if self.path != '/stats':
+                return self._send(404, {'error': 'not found'})
+            self._send(200, batcher.stats.summary())
+
+        def log_message(self, format, *args):
+            pass
+
+    return ScoreHandler
+
+
+def serve_http(batcher, host='127.0.0.1', port=8080):
+    '''Serve `POST /score` (a record or a list of records) and `GET /stats`.'''
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f'Scoring on http://{host}:{port}/score', file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score water mains with the best logged model.')
+    parser.add_argument('mode', choices=['batch', 'stdin', 'http'])
+    parser.add_argument('--source', default='mains',
+                        help="'mains' for the whole inventory, or a processed feature table")
+    parser.add_argument('--chunk-rows', type=int, default=5000)
+    parser.add_argument('--run-id', default=None)
+    parser.add_argument('--max-batch', type=int, default=256)
+    parser.add_argument('--max-wait-ms', type=float, default=5.0)
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    if args.mode == 'batch':
+        summary = score_batch(args.source, chunk_rows=args.chunk_rows, run_id=args.run_id)
+    else:
+        batcher = MicroBatcher(load_model(args.run_id), load_codes(),
+                               args.max_batch, args.max_wait_ms / 1000)
+        if args.mode == 'stdin':
+            serve_stdin(batcher)
+        else:
+            serve_http(batcher, port=args.port)
+        summary = batcher.stats.summary()
+    print(json.dumps(summary), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+import itertools
+import math
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from sklearn.preprocessing import StandardScaler
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.pipeline import make_pipeline
+
+from src.instrumentation import stage, count
+
+# Arrays shared with the worker processes, memory-mapped from .npy files
+_SHARED = {}
+
+
+def _share_arrays(arrays, directory):
+    '''
+    Save `arrays` as .npy files in `directory` so every worker can
+    memory-map them instead of receiving a pickled copy with each task.
+    Features are stored as C-contiguous float32, the dtype the trees use
+    internally, so fitting doesn't copy them either.
+    '''
+    paths = {}
+    for name, array in arrays.items():
+        path = os.path.join(directory, f'{name}.npy')
+        np.save(path, array)
+        paths[name] = path
+    return paths
+
+
+def _init_worker(paths):
+    for name, path in paths.items():
+        _SHARED[name] = np.load(path, mmap_mode='r')
+
+
+def _fit_trial(params, random_state):
+    '''Fit one forest on the shared training data and score it on the test data.'''
+    rf = RandomForestRegressor(random_state=random_state, n_jobs=1, **params)
+    rf.fit(_SHARED['X_train'], _SHARED['y_train'])
+    return rf.score(_SHARED['X_test'], _SHARED['y_test'])
+
+
+def available_cpus():
+    '''
+    CPUs this process can actually use: its affinity mask, capped by the
+    cgroup CPU quota of a container. `os.cpu_count()` counts the host's.
+    '''
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            cpus = min(cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass
+    return cpus
+
+
+def _cost(params):
+    # fitting time grows with the trees and (roughly) with their depth
+    return params['n_estimators'] * (params['max_depth'] or 32)
+
+
+def _run_rung(executor, configs, budgets, random_state, name):
+    '''Fit every configuration with every number of trees of `budgets`.'''
+    with stage(name, len(configs) * len(budgets)):
+        params = [dict(config, n_estimators=n) for n in budgets for config in configs]
+        # the longest fits are queued first, so the pool doesn't end up
+        # waiting on one of them while the other workers are idle
+        order = sorted(range(len(params)), key=lambda i: -_cost(params[i]))
+        futures = {i: executor.submit(_fit_trial, params[i], random_state) for i in order}
+        count('trials', len(params))
+        return [(p, futures[i].result()) for i, p in enumerate(params)]
+
+
+def search(X_train, X_test, y_train, y_test, n_estimators, max_depth,
+           min_samples_split, min_samples_leaf, max_workers=None, halving=True,
+           eta=3, top_k=3, random_state=42, log=True):
+    '''
+    Search the random forest hyperparameters over a pool of processes.
+
+    The scaler is fitted once on the training data and the scaled arrays are
+    memory-mapped by every worker. With `halving`, the `n_estimators` values
+    are used as budgets for successive halving: every configuration of the
+    other hyperparameters is fitted with the smallest number of trees, only
+    the best `1/eta` of them move on to the next budget, and so on up to the
+    largest one. Without it the full grid is fitted.
+
+    Parameters
+    ----------
+    X_train, X_test, y_train, y_test : array-like
+        Train/test split of the model data.
+    n_estimators, max_depth, min_samples_split, min_samples_leaf : list
+        Values to search.
+    max_workers : int, optional
+        Number of worker processes, by default the CPUs available to this
+        process (`available_cpus`).
+    halving : bool
+        Use successive halving instead of the full grid.
+    eta : int
+        Fraction of the configurations dropped at every halving rung.
+    top_k : int
+        Number of best configurations whose fitted pipeline is logged as a
+        model artifact. Every trial's parameters and score are logged.
+    random_state : int
+        Seed of every forest, so a logged model can be refitted exactly.
+    log : bool
+        Log the trials to MLflow.
+
+    Returns
+    -------
+    results : pd.DataFrame
+        One row per trial with its parameters and score, best first.
+    '''
+    # fitted on plain arrays (columns in `FEATURE_COLS` order) so the logged
+    # pipelines score the arrays the scoring service assembles
+    X_train = np.asarray(X_train, dtype=np.float64)
+    X_test = np.asarray(X_test, dtype=np.float64)
+    scaler = StandardScaler().fit(X_train)
+    arrays = {
+        'X_train': np.ascontiguousarray(scaler.transform(X_train), dtype=np.float32),
+        'X_test': np.ascontiguousarray(scaler.transform(X_test), dtype=np.float32),
+        'y_train': np.asarray(y_train, dtype=np.float64),
+        'y_test': np.asarray(y_test, dtype=np.float64),
+    }
+
+    configs = [dict(zip(['max_depth', 'min_samples_split', 'min_samples_leaf'], values))
+               for values in itertools.product(max_depth, min_samples_split, min_samples_leaf)]
+    budgets = sorted(n_estimators)
+
+    trials = []
+    tmp_dir = tempfile.mkdtemp(prefix='rf-search-')
+    try:
+        paths = _share_arrays(arrays, tmp_dir)
+        with ProcessPoolExecutor(max_workers=max_workers or available_cpus(),
+                                 initializer=_init_worker, initargs=(paths,)) as executor:
+            if halving:
+                for rung, budget in enumerate(budgets):
+                    results = _run_rung(executor, configs, [budget], random_state,
+                                        f'search.rung_{budget}')
+                    trials += [dict(p, score=s, rung=rung) for p, s in results]
+                    results.sort(key=lambda r: r[1], reverse=True)
+                    n_keep = max(1, math.ceil(len(results) / eta))
+                    configs = [{k: v for k, v in p.items() if k != 'n_estimators'}
+                               for p, _ in results[:n_keep]]
+            else:
+                # the whole grid at once: no pool-draining wait between budgets
+                results = _run_rung(executor, configs, budgets, random_state, 'search.grid')
+                trials += [dict(p, score=s, rung=0) for p, s in results]
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    results = (pd.DataFrame(trials)
+               .sort_values(['rung', 'score'], ascending=False)
+               .reset_index(drop=True))
+
+    if log:
+        with stage('search.log_trials', results.shape[0]):
+            _log_trials(results, scaler, X_train, y_train, top_k, random_state)
+    return results
+
+
+def _log_trials(results, scaler, X_train, y_train, top_k, random_state):
+    '''
+    Log every trial's parameters and score, and the fitted pipeline of the
+    `top_k` best trials only. Those are refitted here with the same seed
+    rather than shipped back from the workers.
+    '''
+    import mlflow
+    import mlflow.sklearn
+
+    best = set(results.index[:top_k])
+    for i, trial in results.iterrows():
+        params = {k: int(trial[k]) for k in ['n_estimators', 'max_depth',
+                                             'min_samples_split', 'min_samples_leaf']}
+        with mlflow.start_run():
+            for name, value in params.items():
+                mlflow.log_param(name, value)
+            mlflow.log_param("halving_rung", int(trial['rung']))
+            mlflow.log_metric("score", trial['score'])
+
+            if i in best:
+                rf = RandomForestRegressor(random_state=random_state, **params)
+                pipeline = make_pipeline(scaler, rf)
+                # the scaler is already fitted, only the forest is trained
+                rf.fit(scaler.transform(X_train), y_train)
+                mlflow.sklearn.log_model(pipeline, "rf-model")
+                mlflow.set_tag("rf_model", "true")
@@ -1,45 +1,15 @@
-import pandas as pd
-import numpy as np
-import src
+import argparse
 
 # import the data and features from the src folder
-<<<<<<< HEAD
-from src.data.extract_data import extract_data
-=======
-<<<<<<< HEAD
-from src.data.fetch_data import fetch_data
-=======
-from src.data.extract_data import extract_data
->>>>>>> 4649fdb0e1726d876555435d5b0a4ea8f52c024e
->>>>>>> 51214857bcc071c461d59c12700ae1b6cd216ef7
-from src.features.process_data import process_data
+from src.features.feature_store import load_features
+from src.models.search import search
+from src.models.out_of_core import train_out_of_core, MEMORY_BUDGET_MB
+from src.instrumentation import stage
 
 # from data import extract_data
 # from features import process_data
 
-import sklearn
 from sklearn.model_selection import train_test_split
-from sklearn.preprocessing import StandardScaler
-from sklearn.ensemble import RandomForestRegressor
-from sklearn.pipeline import make_pipeline
-
-import mlflow
-import mlflow.sklearn
-
-# Collect the data
-# data = extract_data()
-
-# Process the data
-data = process_data()
-
-# Grabbing the model data that was just processed
-data = pd.read_csv('data/processed/model_data.csv')
-
-# Split the data
-X = data.drop('failure_rate', axis=1)
-y = data['failure_rate']
-
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.2, random_state=42)
 
 # Define the hyperparameters
 n_estimators = [10, 50, 100, 150]
@@ -47,47 +17,64 @@ max_depth = [1, 3, 5, 7]
 min_samples_split = [2, 5, 10, 15]
 min_samples_leaf = [1, 2, 4, 6]
 
-def train_rf(X_train, X_test, y_train, y_test, n_estimators, max_depth, min_samples_split, min_samples_leaf):
-    with mlflow.start_run():
-
-        # Create the model
-        rf = RandomForestRegressor(n_estimators=n_estimators, max_depth=max_depth, min_samples_split=min_samples_split, min_samples_leaf=min_samples_leaf)
-
-        # Create the pipeline
-        pipeline = make_pipeline(StandardScaler(), rf)
-
-        # Fit the model
-        pipeline.fit(X_train, y_train)
-
-        # Evaluate the model
-        # y_pred = pipeline.predict(X_test)
-
-        # Calculate the accuracy
-        score = pipeline.score(X_test, y_test)
-
-        # Log the parameters
-        mlflow.log_param("n_estimators", rf.n_estimators)
-        mlflow.log_param("max_depth", rf.max_depth)
-        mlflow.log_param("min_samples_split", rf.min_samples_split)
-        mlflow.log_param("min_samples_leaf", rf.min_samples_leaf)
-
-        # Log the score
-        mlflow.log_metric("score", score)
-
-        # Log the model
-        mlflow.sklearn.log_model(pipeline, "rf-model")
-
-        # print the results
-        print(f"n_estimators: {rf.n_estimators}")
-        print(f"max_depth: {rf.max_depth}")
-        print(f"min_samples_split: {rf.min_samples_split}")
-        print(f"min_samples_leaf: {rf.min_samples_leaf}")
-        print(f"score: {score}")
-
-# call the function for each combination of hyperparameters
-for n in n_estimators:
-    for d in max_depth:
-        for s in min_samples_split:
-            for l in min_samples_leaf:
-                train_rf(X_train, X_test, y_train, y_test, n, d, s, l)
-
+def load_split():
+    # Collect the data
+    # data = extract_data()
+
+    # Process the data, or load the cached model data if neither the raw data
+    # nor the feature pipeline changed since the last run
+    data = load_features()
+
+    # Split the data
+    X = data.drop('failure_rate', axis=1)
+    y = data['failure_rate']
+
+    return train_test_split(X, y, test_size=0.2, random_state=42)
+
+
+def main(halving=True, max_workers=None, top_k=3):
+    with stage('train.load_split') as current:
+        X_train, X_test, y_train, y_test = load_split()
+        current.rows_out = X_train.shape[0] + X_test.shape[0]
+
+    # search the hyperparameters over a process pool. With successive halving
+    # the weak configurations are dropped after being fitted with the
+    # smallest n_estimators, and only the best `top_k` models are logged
+    with stage('train.search', X_train.shape[0]) as current:
+        results = search(X_train, X_test, y_train, y_test, n_estimators, max_depth,
+                         min_samples_split, min_samples_leaf, max_workers=max_workers,
+                         halving=halving, top_k=top_k)
+        current.rows_out = results.shape[0]
+
+    # print the results
+    print(results.head(top_k).to_string(index=False))
+    return results
+
+
+# the guard matters: worker processes may re-import this module
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train the failure rate model.')
+    parser.add_argument('--out-of-core', action='store_true',
+                        help='stream the model data instead of loading it, for datasets '
+                             'larger than memory (one configuration, no search)')
+    parser.add_argument('--memory-budget-mb', type=float, default=MEMORY_BUDGET_MB)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--no-halving', action='store_true')
+    parser.add_argument('--promote', action='store_true',
+                        help='export the best run to the model registry and serve it')
+    args = parser.parse_args()
+
+    if args.out_of_core:
+        summary = train_out_of_core(memory_budget_mb=args.memory_budget_mb, n_jobs=args.workers)
+        print(f"score: {summary['score']:.4f} on {summary['test_rows']} test rows, "
+              f"{summary['train_rows']} training rows, peak RSS {summary['peak_rss_mb']:.0f} MB "
+              f"(budget {summary['memory_budget_mb']:.0f} MB)")
+    else:
+        main(halving=not args.no_halving, max_workers=args.workers)
+
+    if args.promote:
+        from src.models.registry import best_run_id, promote
+
+        run_id = best_run_id()
+        promote(run_id)
+        print(f'Promoted {run_id}')
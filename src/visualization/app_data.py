@@ -0,0 +1,97 @@
+# Data access for the Streamlit app. Datasets are loaded on the first page
+# that needs them and kept with `st.cache_resource`, one read-only frame
+# shared by every session (pages must not modify them in place). Each load
+# is keyed on the version of its sources, so a new flow run is picked up
+# on the next rerun without restarting the app.
+import os
+
+import streamlit as st
+
+from src.data.storage import find_table, read_table
+from src.features.feature_store import fingerprint_file
+from src.features.map_cells import CELLS_DB, read_cells
+
+# Hash the source content instead of trusting the modification time, for
+# file systems that don't keep it (e.g. files copied into an image)
+HASH_SOURCES = os.environ.get('APP_DATA_HASH') == '1'
+
+# Versions of the loaded datasets kept per loader; older ones are evicted
+MAX_VERSIONS = 2
+
+# Datasets every page of `st_app.py` draws, as (kind, name, options)
+PAGE_DATASETS = {
+    'Home': [],
+    'Scatterplot': [('cells', 'breaks', {})],
+    'Heatmap': [('cells', 'breaks', {})],
+    'Break Predictions': [('cells', 'predictions', {})],
+    'Predictions by Age': [('cells', 'predictions', {'slice': 'age'})],
+    'Predictions by Hexagon Layer': [('cells', 'predictions', {})],
+}
+
+# (path, mtime, size) -> content hash, so a file is only hashed once per change
+_HASHES = {}
+
+
+def _file_version(path):
+    if not os.path.exists(path):
+        return (path, None)
+    stat = os.stat(path)
+    version = (path, stat.st_mtime_ns, stat.st_size)
+    if not HASH_SOURCES:
+        return version
+    if version not in _HASHES:
+        _HASHES[version] = fingerprint_file(path)
+    return (path, _HASHES[version])
+
+
+def source_version(paths):
+    '''
+    Version of a dataset's source files, which changes whenever one of them
+    is rewritten. A SQLite database in WAL mode is only checkpointed into
+    its main file later, so its -wal file is part of its version too.
+    '''
+    parts = []
+    for path in paths:
+        parts.append(_file_version(path))
+        if path.endswith('.db'):
+            parts.append(_file_version(path + '-wal'))
+    return tuple(parts)
+
+
+@st.cache_resource(max_entries=MAX_VERSIONS * 8, show_spinner=False)
+def _load_cells(layer, zoom, slice, version):
+    return read_cells(layer, zoom, slice)
+
+
+@st.cache_resource(max_entries=MAX_VERSIONS * 8, show_spinner=False)
+def _load_table(name, stage, columns, version):
+    return read_table(name, stage, columns=list(columns) if columns else None)
+
+
+def get_cells(layer, zoom=12, slice='all'):
+    '''Precomputed map cells of `layer` (see `src.features.map_cells`).'''
+    return _load_cells(layer, zoom, slice, source_version([CELLS_DB]))
+
+
+def get_table(name, stage='processed', columns=None):
+    '''Table `name` of `stage`, e.g. the ranked risk of the mains.'''
+    columns = tuple(columns) if columns else None
+    return _load_table(name, stage, columns, source_version([find_table(name, stage)]))
+
+
+def get_dataset(kind, name, **options):
+    if kind == 'cells':
+        return get_cells(name, **options)
+    return get_table(name, **options)
+
+
+def load_page(page):
+    '''Load (or reuse) every dataset `page` draws, in `PAGE_DATASETS` order.'''
+    return [get_dataset(kind, name, **options) for kind, name, options in PAGE_DATASETS[page]]
+
+
+def invalidate():
+    '''Drop every loaded dataset, e.g. from a flow that just rewrote them all.'''
+    _load_cells.clear()
+    _load_table.clear()
+    _HASHES.clear()
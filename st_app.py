@@ -1,10 +1,14 @@
 import streamlit as st
-import pandas as pd
 import numpy as np
 import pydeck as pdk
 import plotly.express as px
 
-DATA_PATH = ("data/processed/cleaned_break_data.csv")
+from src.features.map_cells import ZOOM_RADIUS, nearest_zoom
+from src.visualization.app_data import PAGE_DATASETS, load_page
+
+MAP_CENTER = dict(lat=43.4643, lon=-80.5204)
+# zoom of the cells `load_page` reads (`app_data.get_cells` default)
+MAP_ZOOM = 12
 
 # st.title("Water Main Breaks in Kitchener-Waterloo")
 
@@ -17,41 +21,15 @@ with header_container:
     st.markdown("<h3 style='text-align: center;'>A Streamlit app to visualize and predict water main breaks</h3>", unsafe_allow_html=True)
 
 
-@st.cache(persist=True) # this prevents having to load the data every time there is a change in the dataset
-def load_data():
-    data = pd.read_csv(DATA_PATH, parse_dates=['INCIDENT_DATE'])
-    data = data.dropna(subset=['LATITUDE', 'LONGITUDE', 'ASSET_EXISTS'])
-    data = data[data['ASSET_EXISTS'] != 'N']
-    data['INCIDENT_DATE'] = pd.to_datetime(data['INCIDENT_DATE'], format='%Y-%m-%d').dt.date
-
-    data['year'] = pd.DatetimeIndex(data['INCIDENT_DATE']).year
-    lowercase = lambda x: str(x).lower()
-    data.rename(lowercase, axis='columns', inplace=True)
-
-    num_breaks = {}
-    for pipe in data['assetid']:
-        if pipe in num_breaks:
-            num_breaks[pipe] += 1
-        else:
-            num_breaks[pipe] = 1
-    data['num_breaks'] = data['assetid'].map(num_breaks)
-
-    data['age'] = (np.floor((pd.to_datetime(data['incident_date']) - 
-                        pd.to_datetime(data['asset_year_installed'])).dt.days / 365.25)).astype(int)
-    return data
-
-
-data = load_data()
-# load in the test data
-test_prediction_data = pd.read_csv("data/processed/test_predict_data.csv")
-
 # create a sidebar menu and put each of the below charts on a new page
 # st.sidebar.title("Menu")
 # Add a custom sidebar header
 st.sidebar.markdown("<h3 style='text-align: left; font-weight: bold;'>Menu</h3>", unsafe_allow_html=True)
 st.sidebar.markdown("---")
 
-page = st.sidebar.radio("Go to", ["Home", "Scatterplot", "Heatmap", "Break Predictions", "Predictions by Age", "Predictions by Hexagon Layer"])
+page = st.sidebar.radio("Go to", list(PAGE_DATASETS))
+# the datasets the page draws, loaded once and shared by every session
+datasets = load_page(page)
 
 if page == "Home":
     st.write("""The data was collected by the City of Kitchener and is available on [Kitchener's Open Data Portal](https://data.kitchener.ca/dataset/water-main-breaks).""")
@@ -73,43 +51,57 @@ if page == "Home":
 
 elif page == "Scatterplot":
     st.header("Scatterplot of Water Main Breaks")
-    st.write("This scatterplot shows the location of water main breaks in Kitchener-Waterloo. Each location is a unique water main break incident.")
-    # show the scatterplot but with smaller points
-    st.plotly_chart(px.scatter_mapbox(data, lat='latitude', lon='longitude', zoom=10, mapbox_style="carto-positron"))
+    st.write("This scatterplot shows the location of water main breaks in Kitchener-Waterloo. Each point is an area of a few blocks, sized by the number of break incidents in it.")
+    cells = datasets[0]
+    st.plotly_chart(px.scatter_mapbox(cells, lat='latitude', lon='longitude', size='count', size_max=15,
+                                      hover_data=['count'], zoom=10, mapbox_style="carto-positron"))
 elif page == "Heatmap":
     st.header("Heatmap of Water Main Breaks")
     st.write("This heatmap shows the location of water main breaks in Kitchener-Waterloo. The darker the colour, the more breaks at that location.")
-    st.plotly_chart(px.density_mapbox(data, lat='latitude', lon='longitude', z='num_breaks', radius=10,
-                                    center=dict(lat=43.4643, lon=-80.5204), zoom=10, mapbox_style="carto-positron"))
+    cells = datasets[0]
+    st.plotly_chart(px.density_mapbox(cells, lat='latitude', lon='longitude', z='count', radius=10,
+                                    center=MAP_CENTER, zoom=10, mapbox_style="carto-positron"))
 elif page == "Break Predictions":
     st.header("Predicted Water Main Breaks")
     st.write("This heatmap shows the predicted location of water main breaks in Kitchener-Waterloo. The darker the colour, the more breaks at that location.")
-    st.plotly_chart(px.density_mapbox(test_prediction_data, lat='latitude', lon='longitude', z='predictions', radius=10,
-                                    center=dict(lat=43.4643, lon=-80.5204), zoom=10, mapbox_style="carto-positron"))
+    # a cell weighs the sum of its predictions, like its points did on their own
+    cells = datasets[0]
+    st.plotly_chart(px.density_mapbox(cells, lat='latitude', lon='longitude', z='value_sum', radius=10,
+                                    center=MAP_CENTER, zoom=10, mapbox_style="carto-positron",
+                                    labels={'value_sum': 'predictions'}))
 elif page == "Predictions by Age":
     st.header("Predicted Water Main Breaks by Age")
     st.write("This heatmap shows the predicted location of water main breaks in Kitchener-Waterloo. The darker the colour, the more breaks at that location. The animation shows the predicted breaks by age of the pipe.")
-    st.plotly_chart(px.density_mapbox(test_prediction_data, lat='latitude', lon='longitude', z='predictions', radius=10,
-                                    center=dict(lat=43.4643, lon=-80.5204), zoom=10, mapbox_style="carto-positron", animation_frame=test_prediction_data['age_at_break'].sort_values(ascending=True)))
+    # one slice of cells per age, already ordered by age
+    cells = datasets[0]
+    st.plotly_chart(px.density_mapbox(cells, lat='latitude', lon='longitude', z='value_sum', radius=10,
+                                    center=MAP_CENTER, zoom=10, mapbox_style="carto-positron",
+                                    animation_frame='slice_value',
+                                    labels={'value_sum': 'predictions', 'slice_value': 'age_at_break'}))
 elif page == "Predictions by Hexagon Layer":
     st.header("Predicted Water Main Breaks by Hexagon Layer")
     st.write("This heatmap is a fun visual that shows the pipe breaks as a hexagonal point. The darker and higher the hexagon, the more breaks occurred at that location")
+    cells = datasets[0]
+    # the cells are sized in Web Mercator metres, the columns in ground metres
+    radius = ZOOM_RADIUS[nearest_zoom(MAP_ZOOM)] * np.cos(np.radians(MAP_CENTER['lat']))
     st.pydeck_chart(pdk.Deck(
         map_style='mapbox://styles/mapbox/light-v9',
         initial_view_state=pdk.ViewState(
-            latitude=43.4643,
-            longitude=-80.5204,
+            latitude=MAP_CENTER['lat'],
+            longitude=MAP_CENTER['lon'],
             zoom=10,
             pitch=50,
         ),
         layers=[
             pdk.Layer(
-                'HexagonLayer',
-                data=test_prediction_data,
+                'ColumnLayer',
+                data=cells,
                 get_position='[longitude, latitude]',
-                radius=150,
-                elevation_scale=4,
-                elevation_range=[0, 1000],
+                get_elevation='count',
+                disk_resolution=6,
+                radius=radius,
+                elevation_scale=40,
+                get_fill_color=[255, 140, 0, 200],
                 pickable=True,
                 extruded=True,
             ),
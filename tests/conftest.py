@@ -0,0 +1,57 @@
+import pytest
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''Run in an empty directory: the pipeline reads and writes under ./data.'''
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'data' / 'processed').mkdir(parents=True)
+    return tmp_path
+
+
+@pytest.fixture
+def model_data():
+    '''A small table of model features and target, shaped like `model_data`.'''
+    np = pytest.importorskip('numpy')
+    pd = pytest.importorskip('pandas')
+    from src.features.process_data import BINARY_COLS, FEATURE_COLS, TARGET_COL
+
+    rng = np.random.default_rng(0)
+    n = 400
+    data = pd.DataFrame({col: rng.integers(0, 6, n) for col in FEATURE_COLS[:4]})
+    data['asset_size'] = rng.choice([100.0, 150.0, 200.0, 300.0], n)
+    data['asset_material'] = rng.integers(0, 5, n)
+    data['num_breaks'] = rng.integers(1, 8, n)
+    data['age_at_break'] = rng.integers(1, 90, n)
+    for col in BINARY_COLS:
+        data[col] = rng.integers(0, 2, n)
+    data[TARGET_COL] = (data['num_breaks'] / data['age_at_break']).round(4)
+    return data
+
+
+@pytest.fixture
+def pipeline(model_data):
+    '''A fitted StandardScaler + random forest, like the logged `rf-model`s.'''
+    pytest.importorskip('sklearn')
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    from src.features.process_data import FEATURE_COLS, TARGET_COL
+
+    model = make_pipeline(StandardScaler(),
+                          RandomForestRegressor(n_estimators=20, max_depth=6, random_state=0))
+    model.fit(model_data[FEATURE_COLS].to_numpy(dtype='float64'), model_data[TARGET_COL])
+    return model
+
+
+@pytest.fixture
+def run_id(pipeline):
+    '''The run ID `pipeline` is served under, through the registry's model cache.'''
+    from src.models import registry
+
+    registry.evict()
+    with registry._cache_lock:
+        registry._cache['test-run'] = pipeline
+    yield 'test-run'
+    registry.evict()
@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+import src.features.process_data as process_data_module  # noqa: E402
+from src.data.storage import read_table, write_table  # noqa: E402
+from src.features.feature_store import load_features  # noqa: E402
+from src.features.process_data import ENCODINGS_PATH, load_encodings  # noqa: E402
+
+
+@pytest.fixture
+def built(model_data, monkeypatch):
+    '''Stand-in for `process_data` writing `model_data`, counting its runs.'''
+    runs = []
+    encodings = {'asset_material': ['CI', 'DI', 'PVC']}
+
+    def process_data():
+        runs.append(1)
+        write_table(model_data, 'model_data', 'processed', csv=True)
+        process_data_module.save_encodings(encodings)
+        return model_data
+
+    monkeypatch.setattr(process_data_module, 'process_data', process_data)
+    return runs, encodings
+
+
+def test_cache_hit_restores_the_processed_files(workdir, model_data, built):
+    runs, encodings = built
+    cache_dir = str(workdir / 'cache')
+
+    load_features(['raw-1'], cache_dir=cache_dir)
+    os.remove('data/processed/model_data.parquet')
+    process_data_module.save_encodings({'asset_material': ['PVC']})
+    cached = load_features(['raw-1'], cache_dir=cache_dir)
+
+    assert len(runs) == 1
+    pd.testing.assert_frame_equal(cached, model_data)
+    assert load_encodings(ENCODINGS_PATH) == encodings
+    pd.testing.assert_frame_equal(read_table('model_data', 'processed'), model_data,
+                                  check_dtype=False)
+
+
+def test_new_input_rebuilds(workdir, built):
+    runs, _ = built
+    cache_dir = str(workdir / 'cache')
+
+    load_features(['raw-1'], cache_dir=cache_dir)
+    load_features(['raw-2'], cache_dir=cache_dir)
+
+    assert len(runs) == 2
@@ -0,0 +1,56 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+
+from src.features.exposure import exposure_panel  # noqa: E402
+from src.models.hazard import evaluate, fit_hazard  # noqa: E402
+
+FIRST_YEAR, SPLIT, LAST_YEAR = 1990, 2016, 2020
+
+
+@pytest.fixture
+def inventory():
+    '''Mains breaking at a known rate rising with age, and their breaks by year.'''
+    rng = np.random.default_rng(0)
+    n = 3000
+    materials = np.array(['CI', 'DI', 'PVC'])
+    factor = np.array([3.0, 1.0, 0.5])
+    material = rng.integers(0, 3, n)
+    installed = rng.integers(1930, 2010, n)
+    # a few very short mains, the cells that blow up an unregularized fit
+    length = np.where(rng.random(n) < 0.05, rng.uniform(1, 10, n), rng.uniform(50, 500, n))
+    mains = pd.DataFrame({
+        'WATMAINID': np.arange(n),
+        'MATERIAL': materials[material],
+        'PIPE_SIZE': rng.choice([150, 200, 300], n),
+        'INSTALLATION_DATE': [f'{year}-01-01' for year in installed],
+        'Shape__Length': length,
+    })
+
+    ids, dates = [], []
+    for year in range(FIRST_YEAR, LAST_YEAR + 1):
+        age = year - installed
+        rate = np.where(age >= 0, 0.05 * factor[material] * np.exp(0.02 * (age - 40)), 0)
+        counts = rng.poisson(rate * length / 1000)
+        ids.append(np.repeat(mains['WATMAINID'].to_numpy(), counts))
+        dates.append(np.full(counts.sum(), f'{year}-06-01'))
+    breaks = pd.DataFrame({'ASSETID': np.concatenate(ids), 'INCIDENT_DATE': np.concatenate(dates)})
+    return mains, breaks
+
+
+def test_holdout_breaks_match_the_prediction(inventory):
+    mains, breaks = inventory
+    train = exposure_panel(mains, breaks, FIRST_YEAR, SPLIT)
+    holdout = exposure_panel(mains, breaks, SPLIT + 1, LAST_YEAR, history_start=FIRST_YEAR,
+                             materials=train.materials)
+
+    model = fit_hazard(train)
+    result = evaluate(model, holdout, train.breaks.sum() / train.exposure.sum())
+
+    observed, predicted = result['holdout_breaks'], result['holdout_predicted_breaks']
+    assert observed > 100
+    assert abs(predicted - observed) <= 0.2 * observed
+    # no cell is given an absurd rate
+    assert model.rate_grid(100).max() < 10
@@ -0,0 +1,71 @@
+import threading
+
+import pytest
+
+from src import instrumentation
+from src.instrumentation import active_stages, attach, bind, count, stage
+
+
+@pytest.fixture(autouse=True)
+def metrics_path(tmp_path, monkeypatch):
+    monkeypatch.setattr(instrumentation, 'METRICS_PATH', str(tmp_path / 'stages.jsonl'))
+
+
+def test_concurrent_stages_only_count_their_own_thread():
+    ready = threading.Barrier(2)
+    stages = {}
+
+    def ingest(city, rows):
+        with stage(f'ingest.{city}') as current:
+            # both stages are open while the other thread counts
+            ready.wait()
+            count('rows', rows)
+            ready.wait()
+        stages[city] = current
+
+    threads = [threading.Thread(target=ingest, args=args)
+               for args in [('kitchener', 10), ('waterloo', 3)]]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert stages['kitchener'].counters == {'rows': 10}
+    assert stages['waterloo'].counters == {'rows': 3}
+
+
+def test_nested_stages_all_count():
+    with stage('outer') as outer:
+        with stage('inner') as inner:
+            count('http_requests', 2)
+        count('http_requests')
+    assert inner.counters == {'http_requests': 2}
+    assert outer.counters == {'http_requests': 3}
+
+
+def test_bound_workers_count_towards_the_calling_stages():
+    with stage('fetch') as current:
+        worker = threading.Thread(target=bind(count), args=('http_requests', 5))
+        worker.start()
+        worker.join()
+        # an unbound thread isn't attached to anything
+        stray = threading.Thread(target=count, args=('http_requests', 100))
+        stray.start()
+        stray.join()
+    assert current.counters == {'http_requests': 5}
+
+
+def test_attach_is_undone():
+    with stage('parent') as parent:
+        stages = active_stages()
+    seen = []
+
+    def child():
+        with attach(stages):
+            seen.append(active_stages())
+        seen.append(active_stages())
+
+    worker = threading.Thread(target=child)
+    worker.start()
+    worker.join()
+    assert seen == [[parent], []]
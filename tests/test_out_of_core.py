@@ -0,0 +1,37 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pandas')
+pytest.importorskip('sklearn')
+
+from src.features.process_data import FEATURE_COLS, TARGET_COL  # noqa: E402
+from src.models.out_of_core import (TREE_BYTES_PER_SAMPLE, plan_budget, rss_mb,  # noqa: E402
+                                    spool_split)
+
+
+def test_spool_split_without_test_rows(tmp_path, model_data):
+    chunks = [model_data.iloc[:150], model_data.iloc[150:]]
+
+    arrays, scaler = spool_split(chunks, str(tmp_path), test_size=0)
+
+    assert arrays['X_train'].shape == (model_data.shape[0], len(FEATURE_COLS))
+    assert arrays['X_test'].shape == (0, len(FEATURE_COLS))
+    np.testing.assert_allclose(arrays['y_train'], model_data[TARGET_COL])
+    np.testing.assert_allclose(np.asarray(arrays['X_train']).mean(axis=0), 0, atol=1e-4)
+
+
+def test_spool_split_stops_over_the_budget(tmp_path, model_data):
+    with pytest.raises(MemoryError):
+        spool_split([model_data], str(tmp_path), memory_limit_mb=1)
+
+
+def test_plan_budget_fits_beside_the_memory_in_use():
+    budget = rss_mb() + 256
+    batch_rows, n_jobs, sample_limit = plan_budget(budget, 64, len(FEATURE_COLS) + 1)
+
+    assert 1 <= n_jobs <= 64
+    assert batch_rows >= 1_000 and sample_limit >= 1_000
+    # the trees fitted in parallel stay within what the budget left
+    assert n_jobs * sample_limit * TREE_BYTES_PER_SAMPLE <= 256 * 1024 ** 2
+    with pytest.raises(ValueError):
+        plan_budget(rss_mb() / 2, 4, len(FEATURE_COLS) + 1)
@@ -0,0 +1,69 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from src.features.process_data import FEATURE_COLS, TARGET_COL  # noqa: E402
+from src.models import registry  # noqa: E402
+from src.models.registry import CompactForest  # noqa: E402
+
+
+@pytest.fixture
+def X(model_data):
+    return model_data[FEATURE_COLS].to_numpy(dtype='float64')
+
+
+def with_missing_ages(X, every=5):
+    X = X.copy()
+    X[::every, FEATURE_COLS.index('age_at_break')] = np.nan
+    return X
+
+
+def test_compact_forest_matches_the_pipeline(pipeline, X, tmp_path):
+    CompactForest.from_pipeline(pipeline, run_id='test').save(tmp_path / 'model')
+    forest = CompactForest.load(tmp_path / 'model')
+    # small blocks so several are predicted
+    np.testing.assert_allclose(forest.predict(X, block_rows=37), pipeline.predict(X))
+
+
+def test_compact_forest_treats_nan_like_the_pipeline(pipeline, X):
+    forest = CompactForest.from_pipeline(pipeline)
+    X = with_missing_ages(X)
+    try:
+        expected = pipeline.predict(X)
+    except ValueError:
+        # scikit-learn without missing value support
+        with pytest.raises(ValueError):
+            forest.predict(X)
+    else:
+        np.testing.assert_allclose(forest.predict(X), expected)
+
+
+def test_compact_forest_follows_the_learned_missing_value_splits(model_data, X):
+    from sklearn.ensemble import RandomForestRegressor
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import StandardScaler
+
+    X = with_missing_ages(X, every=3)
+    model = make_pipeline(StandardScaler(),
+                          RandomForestRegressor(n_estimators=10, max_depth=5, random_state=0))
+    try:
+        model.fit(X, model_data[TARGET_COL])
+    except ValueError:
+        pytest.skip('this scikit-learn can\'t fit forests on missing values')
+    forest = CompactForest.from_pipeline(model)
+    np.testing.assert_allclose(forest.predict(X), model.predict(X))
+
+
+def test_load_model_caches_the_promoted_export(pipeline, X, tmp_path, monkeypatch):
+    CompactForest.from_pipeline(pipeline, run_id='promoted').save(
+        registry.model_dir('promoted', str(tmp_path)))
+    registry._write_index({'current': 'promoted', 'models': {'promoted': {}}}, str(tmp_path))
+    monkeypatch.setattr(registry, 'MODEL_CACHE_SIZE', 1)
+    registry.evict()
+    try:
+        model = registry.load_model(registry_dir=str(tmp_path))
+        assert isinstance(model, CompactForest)
+        assert registry.load_model('promoted', str(tmp_path)) is model
+        np.testing.assert_allclose(model.predict(X), pipeline.predict(X))
+    finally:
+        registry.evict()
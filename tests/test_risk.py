@@ -0,0 +1,64 @@
+import json
+import sqlite3
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pd = pytest.importorskip('pandas')
+pytest.importorskip('pyarrow')
+
+from src.data.database import load_table  # noqa: E402
+from src.features.mains_features import mains_features  # noqa: E402
+from src.features.process_data import ENCODINGS_PATH  # noqa: E402
+from src.models.risk import score_network  # noqa: E402
+
+ENCODINGS = {
+    'break_type': ['HYDRANT', 'MAIN', 'SERVICE'],
+    'break_nature': ['CIRCUMFERENTIAL', 'CORROSION', 'UNKNOWN'],
+    'break_apparent_cause': ['FROST', 'OTHER'],
+    'break_categorization': ['CATEGORY 1', 'CATEGORY 2'],
+    'asset_material': ['CI', 'DI', 'PVC', 'UNKNOWN'],
+}
+
+
+@pytest.fixture
+def inventory(workdir):
+    mains = pd.DataFrame({
+        'OBJECTID': [1, 2, 3, 4],
+        'WATMAINID': [10, 20, 30, 40],
+        'ROADSEGMENTID': [100, 200, 300, 400],
+        'PIPE_SIZE': [150.0, 200.0, 150.0, 300.0],
+        'MATERIAL': ['CI', 'PVC', None, 'DI'],
+        # the real inventory has mains without an installation date
+        'INSTALLATION_DATE': pd.to_datetime(['1950-06-01', '1990-01-01', None, None]),
+    })
+    breaks = pd.DataFrame({
+        'OBJECTID': [1, 2, 3],
+        'ASSETID': [10, 10, 30],
+        'INCIDENT_DATE': pd.to_datetime(['2001-02-03', '2010-01-15', '2015-03-01']),
+    })
+    load_table(mains, 'mains', 'test.db')
+    load_table(breaks, 'breaks', 'test.db')
+    with open(ENCODINGS_PATH, 'w') as f:
+        json.dump(ENCODINGS, f)
+    return mains
+
+
+def test_mains_features_leave_the_age_of_undated_mains_missing(inventory):
+    features = mains_features(inventory, ENCODINGS, break_counts=pd.Series({10: 2, 30: 1}),
+                              as_of='2020-01-01')
+    assert features['age_at_break'].isna().tolist() == [False, False, True, True]
+    assert features['num_breaks'].tolist() == [2, 0, 1, 0]
+
+
+def test_score_network_flags_the_mains_without_an_age(inventory, run_id):
+    summary = score_network('test.db', chunk_rows=3, run_id=run_id, as_of='2020-01-01')
+    assert summary['rows'] == 4
+
+    conn = sqlite3.connect('test.db')
+    ranked = pd.read_sql('SELECT * FROM main_risk ORDER BY risk_rank', conn)
+    conn.close()
+    # the dated mains are scored and ranked first, the others flagged
+    assert ranked['WATMAINID'].tolist()[:2] in ([10, 20], [20, 10])
+    assert ranked['risk_score'].notna().tolist() == [True, True, False, False]
+    assert ranked['missing_age'].tolist() == [0, 0, 1, 1]
@@ -0,0 +1,68 @@
+import io
+import json
+import threading
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('pyarrow')
+
+from src.data.storage import read_table, write_table  # noqa: E402
+from src.features.process_data import ENCODINGS_PATH, FEATURE_COLS  # noqa: E402
+from src.models.score import MicroBatcher, score_batch, serve_stdin  # noqa: E402
+
+
+def test_score_batch_scores_a_stored_table(workdir, model_data, pipeline, run_id):
+    write_table(model_data[FEATURE_COLS], 'features_to_score', 'processed')
+    with open(ENCODINGS_PATH, 'w') as f:
+        json.dump({}, f)
+
+    summary = score_batch('features_to_score', chunk_rows=64, run_id=run_id,
+                          output='scored')
+
+    assert summary['rows'] == model_data.shape[0]
+    scored = read_table('scored', 'processed')
+    expected = pipeline.predict(model_data[FEATURE_COLS].to_numpy(dtype='float64'))
+    np.testing.assert_allclose(scored['predictions'].to_numpy(), expected)
+
+
+def test_micro_batcher_fails_only_the_bad_request(model_data, pipeline):
+    batcher = MicroBatcher(pipeline, {}, max_batch=64, max_wait=0.05)
+    records = model_data[FEATURE_COLS].head(3).to_dict('records')
+    no_age = dict(records[0], age_at_break=None)
+    results = {}
+    done = threading.Event()
+
+    def collect(name):
+        def callback(result):
+            results[name] = result
+            if len(results) == 3:
+                done.set()
+        return callback
+
+    # submitted together, so they share one micro-batch
+    batcher.submit(records, callback=collect('good'))
+    batcher.submit([{'asset_size': 'wide'}], callback=collect('bad'))
+    batcher.submit([no_age], callback=collect('no_age'))
+    done.wait()
+
+    expected = pipeline.predict(model_data[FEATURE_COLS].head(3).to_numpy(dtype='float64'))
+    np.testing.assert_allclose(results['good'], expected)
+    assert isinstance(results['bad'], ValueError)
+    assert results['no_age'] == [None]
+    with pytest.raises(ValueError):
+        batcher.submit(['not a record'])
+    # the batching thread survived the failures
+    np.testing.assert_allclose(batcher.submit(records), expected)
+
+
+def test_serve_stdin_reports_bad_lines_in_order(model_data, pipeline):
+    batcher = MicroBatcher(pipeline, {}, max_wait=0.001)
+    record = model_data[FEATURE_COLS].iloc[0].to_dict()
+    stdin = io.StringIO('\n'.join([json.dumps(record), '{not json', json.dumps(record)]))
+    stdout = io.StringIO()
+
+    serve_stdin(batcher, stdin, stdout)
+
+    lines = [json.loads(line) for line in stdout.getvalue().splitlines()]
+    assert [sorted(line) for line in lines] == [['prediction'], ['error'], ['prediction']]
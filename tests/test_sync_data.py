@@ -0,0 +1,54 @@
+import sqlite3
+from types import SimpleNamespace
+
+import pytest
+
+pd = pytest.importorskip('pandas')
+pytest.importorskip('geopandas')
+
+from src.data import sync_data  # noqa: E402
+
+URL = 'https://example.com/FeatureServer/0/'
+
+
+@pytest.fixture
+def layer(monkeypatch):
+    '''A feature server layer whose features the test sets, without the network.'''
+    features = {'frame': pd.DataFrame()}
+
+    def fetch_features(url, object_ids=None, **kwargs):
+        frame = features['frame']
+        if object_ids is not None:
+            frame = frame[frame['OBJECTID'].isin(object_ids)]
+        return frame, 'OBJECTID', frame.get('OBJECTID', pd.Series(dtype='int64')).to_numpy()
+
+    monkeypatch.setattr(sync_data, 'make_session', lambda max_workers: None)
+    monkeypatch.setattr(sync_data, 'get_layer_definition',
+                        lambda session, url: {'objectIdField': 'OBJECTID'})
+    monkeypatch.setattr(sync_data, 'get_object_ids',
+                        lambda session, url, fid, where=None: fetch_features(url)[2])
+    monkeypatch.setattr(sync_data, 'fetch_features', fetch_features)
+    monkeypatch.setattr(sync_data, 'verify_features',
+                        lambda frame, *args, **kwargs: (frame, SimpleNamespace(ok=True)))
+    return features
+
+
+def test_first_sync_of_an_empty_layer_creates_nothing(tmp_path, layer):
+    db_name = str(tmp_path / 'water.db')
+
+    summary = sync_data.sync_layer(URL, 'mains', db_name)
+
+    assert summary['upserted'] == 0 and not summary['rebuilt']
+    assert sync_data.read_sync_state('mains', db_name) is None
+    conn = sqlite3.connect(db_name)
+    try:
+        assert not sync_data._table_exists(conn, 'mains')
+    finally:
+        conn.close()
+
+    # once the layer has features, the next sync builds the table
+    layer['frame'] = pd.DataFrame({'OBJECTID': [1, 2], 'MATERIAL': ['CI', 'PVC']})
+    summary = sync_data.sync_layer(URL, 'mains', db_name)
+
+    assert summary['rebuilt'] and summary['upserted'] == 2
+    assert sync_data.read_sync_state('mains', db_name)['max_objectid'] == 2